@@ -3,6 +3,10 @@ ASGI config for SafeChatPlus project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Serve the project through this module (e.g. ``uvicorn SafeChatPlus.asgi:application``)
+to enable the /api/stream/ Server-Sent Events endpoint that pushes new alerts
+and locations to parent dashboards; WSGI deployments answer it with 503.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 """
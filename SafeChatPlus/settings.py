@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -45,6 +46,8 @@ STATICFILES_DIRS = [
 ]
 
 MIDDLEWARE = [
+    # First, so that it times everything below it
+    'api.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -82,6 +85,26 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Reuse connections across requests instead of reopening (and re-running
+        # the pragmas below) every time
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            # Seconds to wait for the write lock before "database is locked"
+            'timeout': 10,
+            # Take the write lock at BEGIN: upgrading a read transaction to a
+            # write one cannot wait for the lock and fails at once instead
+            'transaction_mode': 'IMMEDIATE',
+            # WAL lets reads run alongside the writer; with it, synchronous=NORMAL
+            # only syncs at checkpoints and stays consistent after a crash
+            'init_command': (
+                'PRAGMA journal_mode=WAL;'
+                'PRAGMA synchronous=NORMAL;'
+                'PRAGMA cache_size=-32000;'
+                'PRAGMA temp_store=MEMORY;'
+                'PRAGMA mmap_size=134217728'
+            ),
+        },
     }
 }
 
@@ -136,3 +159,176 @@ MEDIA_ROOT = BASE_DIR / 'media'
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# VigilEye ingest settings
+
+# Maximum number of messages accepted by /api/analyze/batch/ in one request
+VIGILEYE_BATCH_MAX_ITEMS = 500
+
+# 'sync' scores and stores messages inside the request; 'queue' validates,
+# queues and answers 202 with a ticket while background workers write in bulk
+VIGILEYE_INGEST_MODE = 'sync'
+VIGILEYE_INGEST_QUEUE_SIZE = 10000
+VIGILEYE_INGEST_WORKERS = 2
+VIGILEYE_INGEST_BATCH_SIZE = 200
+VIGILEYE_INGEST_LINGER = 0.05  # seconds a worker waits to fill a micro-batch
+VIGILEYE_INGEST_TICKET_HISTORY = 10000
+
+# Seconds between bulk writes of coalesced device heartbeats (0 writes through)
+VIGILEYE_HEARTBEAT_FLUSH_INTERVAL = 5
+
+# Bounded LRU cache resolving kindred_id to device id and tracking flag
+VIGILEYE_DEVICE_CACHE_SIZE = 10000
+VIGILEYE_DEVICE_CACHE_TTL = 30  # seconds, bounds staleness across processes
+
+# Number of most recent high-risk alerts shown in the dashboard carousel
+VIGILEYE_DASHBOARD_CRITICAL_LIMIT = 20
+
+# Page size for the cursor-paginated alert and location APIs
+VIGILEYE_API_PAGE_SIZE = 50
+VIGILEYE_API_MAX_PAGE_SIZE = 500
+
+# Server-Sent Events stream of new alerts and locations (ASGI only)
+VIGILEYE_STREAM_QUEUE_SIZE = 256  # buffered events per client before it resyncs
+VIGILEYE_STREAM_REPLAY_LIMIT = 500  # rows per table replayed on reconnect
+VIGILEYE_STREAM_KEEPALIVE = 15  # seconds between keepalive comments
+VIGILEYE_STREAM_RETRY_MS = 3000
+
+# Parent notifications: delivered in the background, one digest per parent per window
+VIGILEYE_NOTIFICATION_BACKEND = 'api.notifications.ConsoleBackend'
+VIGILEYE_NOTIFICATION_FILE = BASE_DIR / 'notifications.log'  # used by FileBackend
+VIGILEYE_NOTIFICATION_WINDOW = 30  # seconds
+VIGILEYE_NOTIFICATION_MAX_BATCH = 50
+VIGILEYE_NOTIFICATION_MAX_ATTEMPTS = 5
+VIGILEYE_NOTIFICATION_RETRY_DELAY = 2  # seconds, doubled on every retry
+VIGILEYE_NOTIFICATION_QUEUE_SIZE = 10000
+
+# Largest gzip request body (Content-Encoding: gzip) accepted once inflated
+VIGILEYE_MAX_INFLATED_BODY = 10 * 1024 * 1024
+
+# Bulk location ingest (/api/location/bulk/): redundant fixes are dropped
+VIGILEYE_LOCATION_BULK_MAX_FIXES = 5000
+VIGILEYE_LOCATION_MIN_JITTER = 10  # meters; movement within accuracy or this is jitter
+VIGILEYE_LOCATION_SIMPLIFY_TOLERANCE = 15  # meters, Douglas-Peucker tolerance
+VIGILEYE_LOCATION_MAX_GAP = 600  # seconds; a stationary device still stores a fix this often
+VIGILEYE_LOCATION_MAX_CLOCK_SKEW = 300  # seconds a fix may be ahead of the server clock
+
+# Area queries (/api/locations/nearby/) over the geohash cell index
+VIGILEYE_GEO_DEFAULT_WINDOW = 3600  # seconds looked back when no 'since' is given
+VIGILEYE_GEO_MAX_RADIUS = 50000  # meters
+VIGILEYE_GEO_MAX_CELLS = 400  # cells looked up per query before coarser prefixes are used
+VIGILEYE_GEO_MAX_CANDIDATES = 20000  # rows refined in memory per query
+
+# Geofences evaluated on every location fix
+VIGILEYE_GEOFENCE_ALERT_SCORE = 4  # score of enter/exit alerts (4 = medium)
+VIGILEYE_GEOFENCE_CACHE_TTL = 30  # seconds, bounds staleness across processes
+VIGILEYE_GEOFENCE_GRID = 0.01  # degrees per bucket of the in-memory fence index
+VIGILEYE_GEOFENCE_MAX_RADIUS = 50000  # meters
+VIGILEYE_GEOFENCE_MAX_VERTICES = 500
+
+# Retention: `manage.py apply_retention` archives rows older than these many
+# days (None keeps a table forever) into gzip NDJSON segments, one per table
+# and UTC day, keeps hourly rollups and deletes the raw rows in chunks
+VIGILEYE_RETENTION_MESSAGE_DAYS = 30
+VIGILEYE_RETENTION_ALERT_DAYS = 90
+VIGILEYE_RETENTION_LOCATION_DAYS = 30
+VIGILEYE_RETENTION_KEEP_UNACKNOWLEDGED = True  # never archive alerts a parent has not seen
+VIGILEYE_RETENTION_CHUNK_SIZE = 1000
+VIGILEYE_RETENTION_PAUSE = 0.05  # seconds between chunks, lets other writers in
+VIGILEYE_ARCHIVE_DIR = BASE_DIR / 'archive'
+VIGILEYE_TREND_MAX_HOURS = 24 * 366  # longest window served by /api/trends/
+
+# Conversation-level scoring: distinct flagged labels over a device's recent
+# messages; reaching the alert score raises one escalation Alert
+VIGILEYE_CONVERSATION_WINDOW = 1800  # seconds
+VIGILEYE_CONVERSATION_MAX_MESSAGES = 50
+VIGILEYE_CONVERSATION_ALERT_SCORE = 7  # 7 = high
+VIGILEYE_CONVERSATION_MIN_WEIGHT = 2  # lighter labels (e.g. 'cool') never count toward escalation
+VIGILEYE_CONVERSATION_CACHE_SIZE = 10000  # devices kept in memory
+
+# Seconds between checks of the active RiskLexicon version; a new version
+# is compiled once and swapped in without a restart
+VIGILEYE_LEXICON_POLL_INTERVAL = 10
+
+# The same text from the same device within this many seconds is not stored
+# again; it is counted on the first copy and its alert (None stores every copy)
+VIGILEYE_DUPLICATE_WINDOW = 300
+
+# Per-route request metrics (wall time, queries, scoring time) served at /metrics
+VIGILEYE_METRICS_ENABLED = True
+# Profile this fraction of requests with cProfile and keep the profiles of
+# those slower than VIGILEYE_PROFILE_SLOW_MS (0 = never profile)
+VIGILEYE_PROFILE_SAMPLE_RATE = 0.0
+VIGILEYE_PROFILE_SLOW_MS = 500
+VIGILEYE_PROFILE_DIR = BASE_DIR / 'profiles'
+
+# Logging of the api app as key=value lines; DEBUG adds a line per location
+# update and status check, which stays off (and costs nothing) by default
+VIGILEYE_LOG_LEVEL = os.environ.get('VIGILEYE_LOG_LEVEL', 'INFO')
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'structured': {
+            'format': 'time=%(asctime)s level=%(levelname)s logger=%(name)s %(message)s',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'structured',
+        },
+    },
+    'loggers': {
+        'api': {
+            'handlers': ['console'],
+            'level': VIGILEYE_LOG_LEVEL,
+            'propagate': False,
+        },
+    },
+}
+
+# Small writes (messages, location fixes, acknowledgements) are handed to one
+# writer thread that commits whatever arrives within the linger time together
+VIGILEYE_WRITE_FUNNEL = True
+VIGILEYE_WRITE_BATCH_SIZE = 64
+VIGILEYE_WRITE_LINGER = 0.002  # seconds
+
+# Optional read replica: path of a copy of the database kept current from the
+# primary (e.g. by Litestream or LiteFS). The dashboard and read-only API views
+# read from it; every write, and every read elsewhere, stays on the primary
+VIGILEYE_READ_REPLICA = os.environ.get('VIGILEYE_READ_REPLICA')
+if VIGILEYE_READ_REPLICA:
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': VIGILEYE_READ_REPLICA,
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'timeout': 10,
+            # The copy belongs to the replication tool, never write to it
+            'init_command': (
+                'PRAGMA query_only=ON;'
+                'PRAGMA cache_size=-32000;'
+                'PRAGMA temp_store=MEMORY;'
+                'PRAGMA mmap_size=134217728'
+            ),
+        },
+        'TEST': {'MIRROR': 'default'},
+    }
+DATABASE_ROUTERS = ['api.routers.ReadReplicaRouter']
+VIGILEYE_READ_REPLICA_ALIAS = 'replica' if VIGILEYE_READ_REPLICA else None
+# After a parent's own write (acknowledge, toggle, geofence edits) their reads
+# stay on the primary this long, so they see the change despite replica lag
+VIGILEYE_REPLICA_STICKY_SECONDS = 10
+
+# Message search ranks at most this many of the newest matches by relevance
+VIGILEYE_SEARCH_CANDIDATES = 1000
+
+# Exports of alerts, messages and locations: rows fetched per query, the most
+# rows streamed straight from /api/export/ (more must go through a background
+# job), and where background jobs write their files
+VIGILEYE_EXPORT_CHUNK_SIZE = 2000
+VIGILEYE_EXPORT_STREAM_MAX_ROWS = 100000
+VIGILEYE_EXPORT_DIR = BASE_DIR / 'exports'
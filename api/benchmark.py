@@ -0,0 +1,124 @@
+import json
+import platform
+import random
+import re
+
+from django.utils import timezone
+
+from .normalize import fold
+from .risk import DEFAULT_LEXICON, risk_level_for_score
+
+# Everyday chat that matches nothing in the lexicon
+FILLER = [
+    'ok', 'lol', 'yeah', 'see', 'you', 'at', 'the', 'game', 'later', 'did', 'finish', 'homework',
+    'what', 'time', 'is', 'practice', 'tomorrow', 'my', 'mom', 'said', 'we', 'can', 'go', 'to',
+    'movies', 'this', 'weekend', 'that', 'was', 'so', 'funny', 'haha', 'idk', 'maybe', 'bring',
+    'snacks', 'bus', 'stop', 'math', 'test', 'on', 'friday', 'new', 'song', 'gg', 'brb', 'thanks',
+]
+
+KEYWORDS = [keyword for category in DEFAULT_LEXICON['categories'] for keyword in category['keywords']]
+
+# Obfuscations applied to keywords in the adversarial corpus
+LEET = str.maketrans({'e': '3', 'o': '0', 'i': '1', 'a': '4', 's': '$'})
+CYRILLIC = str.maketrans({'a': 'а', 'e': 'е', 'o': 'о', 'p': 'р', 'c': 'с'})
+
+
+def _chat(rng, words, keyword_rate):
+    return ' '.join(
+        rng.choice(KEYWORDS) if rng.random() < keyword_rate else rng.choice(FILLER)
+        for _ in range(words)
+    )
+
+
+def _adversarial(rng):
+    keyword = rng.choice(KEYWORDS)
+    kind = rng.randrange(8)
+    if kind == 0:
+        return keyword.translate(LEET) + ' ' + _chat(rng, 5, 0)
+    if kind == 1:
+        return '.'.join(keyword) + ' ' + _chat(rng, 5, 0)
+    if kind == 2:
+        return _chat(rng, 5, 0) + ' ' + keyword.translate(CYRILLIC)
+    if kind == 3:
+        # Long runs the collapsing and the f+u+c+k+ style patterns must walk
+        return rng.choice('fsdam') * rng.randint(500, 5000)
+    if kind == 4:
+        # Near misses: prefixes of keywords that the trie has to back out of
+        return ' '.join(keyword[:rng.randint(1, len(keyword))] for keyword in rng.choices(KEYWORDS, k=200))
+    if kind == 5:
+        return ' '.join(str(rng.randint(0, 9999)) for _ in range(300))
+    if kind == 6:
+        return ' '.join('@' + rng.choice(FILLER) for _ in range(200))
+    return ''.join(rng.choice('ab1 .-') for _ in range(rng.randint(1000, 4000)))
+
+
+def generate_corpus(kind, count, seed=0):
+    """
+    ``count`` synthetic messages: 'short' chat lines, 'long' pasted
+    paragraphs, or 'adversarial' input built to be slow or evasive
+    (obfuscated keywords, long runs, near-miss prefixes, digit and handle
+    floods). The same seed always gives the same corpus.
+    """
+    rng = random.Random(f'{kind}:{seed}')
+    if kind == 'short':
+        return [_chat(rng, rng.randint(2, 12), 0.08) for _ in range(count)]
+    if kind == 'long':
+        return [_chat(rng, rng.randint(150, 600), 0.02) for _ in range(count)]
+    if kind == 'adversarial':
+        return [_adversarial(rng) for _ in range(count)]
+    raise ValueError(f'Unknown corpus {kind!r}')
+
+
+CORPORA = ['short', 'long', 'adversarial']
+
+
+def reference_detector(lexicon):
+    """
+    The straightforward detect_risk for ``lexicon``: a substring test per
+    keyword over the lowercased and the folded message, a search per
+    pattern. Scores and labels like the compiled matcher, which is measured
+    and checked against it.
+    """
+    keywords = [(keyword, category['weight'], category.get('label') or keyword)
+                for category in lexicon['categories'] for keyword in category['keywords']]
+    patterns = [(re.compile(p['pattern']), p['weight'], p['label']) for p in lexicon['patterns']]
+
+    def detect(message):
+        if not message or not message.strip():
+            return 0, [], 'safe'
+        text = message.lower()
+        folded = fold(message)
+        risk_score = 0
+        labels = {}
+        for keyword, weight, label in keywords:
+            if keyword in text or keyword in folded:
+                risk_score += weight
+                labels[label] = None
+        for regex, weight, label in patterns:
+            if regex.search(text):
+                risk_score += weight
+                labels[label] = None
+        return risk_score, list(labels), risk_level_for_score(risk_score)
+
+    return detect
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    """Nearest-rank percentiles of ``samples`` plus mean and max; {} when empty"""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    summary = {f'p{point}': ordered[min(len(ordered) - 1, len(ordered) * point // 100)] for point in points}
+    summary['mean'] = sum(ordered) / len(ordered)
+    summary['max'] = ordered[-1]
+    return summary
+
+
+def write_report(path, report):
+    """Write a benchmark report as JSON, stamped with when and where it was taken"""
+    report = dict(report, generated_at=timezone.now().isoformat(),
+                  python=platform.python_version(), platform=platform.platform())
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write('\n')
+    return report
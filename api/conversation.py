@@ -0,0 +1,175 @@
+import threading
+from collections import Counter, OrderedDict, deque
+
+from django.conf import settings
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+from django.utils import timezone
+
+from .models import Message
+from .risk import default_matcher
+
+
+class ConversationWindow:
+    """
+    Flagged labels of one device's recent messages, with a running score.
+
+    The score is the summed weight of the distinct labels present in the
+    window, so a pattern spread over several messages adds up while a
+    repeated word counts once. Only labels in ``weights`` are tracked. Per-
+    label counts make adding or evicting a message cost only its own labels,
+    never a re-read of the window.
+    """
+
+    def __init__(self, span, max_messages, weights):
+        self.span = span
+        self.max_messages = max_messages
+        self.weights = weights
+        self.entries = deque()
+        self.counts = Counter()
+        self.score = 0
+        self.last_id = 0
+        self.escalated = False
+
+    def add(self, message_id, timestamp, labels):
+        if message_id <= self.last_id:
+            # Already loaded from the database
+            return
+        self.last_id = message_id
+        labels = tuple({label for label in labels if label in self.weights})
+        self.entries.append((timestamp, labels))
+        for label in labels:
+            self.counts[label] += 1
+            if self.counts[label] == 1:
+                self.score += self.weights[label]
+        self.expire(timestamp)
+
+    def expire(self, now):
+        horizon = now - timezone.timedelta(seconds=self.span)
+        while self.entries and (len(self.entries) > self.max_messages or self.entries[0][0] < horizon):
+            _, labels = self.entries.popleft()
+            for label in labels:
+                self.counts[label] -= 1
+                if not self.counts[label]:
+                    del self.counts[label]
+                    self.score -= self.weights[label]
+
+    def labels(self):
+        return list(self.counts)
+
+
+class ConversationTracker:
+    """
+    Bounded LRU of per-device conversation windows.
+
+    Devices missing from memory are reloaded from their recent Message
+    rows by warm() (one query per batch); after that every message updates
+    its window in place. observe() reports when the windowed score first reaches
+    ``threshold`` without the message reaching it alone, which is when a
+    conversation-level Alert is due. Labels weighing less than
+    ``min_weight`` (friendly words like 'cool') are not counted, so
+    ordinary chat cannot add up to an escalation.
+    """
+
+    def __init__(self, span, max_messages, threshold, maxsize, weights, min_weight=0):
+        self.span = span
+        self.max_messages = max_messages
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.min_weight = min_weight
+        self.weights = weights
+        self._counted = self._counted_weights(weights)
+        self._windows = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _counted_weights(self, weights):
+        return {label: weight for label, weight in weights.items() if weight >= self.min_weight}
+
+    def _recent(self, device_ids, now, before_id=None):
+        """
+        Flagged labels of each device's last ``max_messages`` messages within
+        the window from the database, oldest first
+        """
+        rows = Message.objects.filter(
+            device_id__in=device_ids,
+            timestamp__gte=now - timezone.timedelta(seconds=self.span),
+        )
+        if before_id is not None:
+            rows = rows.filter(id__lt=before_id)
+        # The window would drop anything older anyway; don't fetch it
+        rows = rows.annotate(
+            newest=Window(RowNumber(), partition_by=F('device_id'), order_by=F('id').desc())
+        ).filter(newest__lte=self.max_messages)
+        recent = {device_id: [] for device_id in device_ids}
+        for device_id, message_id, timestamp, labels in rows.order_by('id').values_list(
+            'device_id', 'id', 'timestamp', 'flagged_keywords'
+        ):
+            recent[device_id].append((message_id, timestamp, labels or []))
+        return recent
+
+    def _install(self, device_id, rows):
+        window = ConversationWindow(self.span, self.max_messages, self._counted)
+        for message_id, timestamp, labels in rows:
+            window.add(message_id, timestamp, labels)
+        # Whatever the window already holds was escalated before, if due
+        window.escalated = window.score >= self.threshold
+        self._windows[device_id] = window
+        while len(self._windows) > self.maxsize:
+            self._windows.popitem(last=False)
+        return window
+
+    def warm(self, device_ids, now):
+        """Load the windows of any of these devices not in memory, in one query"""
+        with self._lock:
+            missing = [device_id for device_id in set(device_ids) if device_id not in self._windows]
+        if not missing:
+            return
+        recent = self._recent(missing, now)
+        with self._lock:
+            for device_id, rows in recent.items():
+                if device_id not in self._windows:
+                    self._install(device_id, rows)
+
+    def observe(self, device_id, message_id, timestamp, labels, message_score):
+        """Add a stored message; returns (window_score, window_labels, escalate)"""
+        with self._lock:
+            window = self._windows.get(device_id)
+            if window is None:
+                # Evicted since warm(); rebuild from the messages before this one
+                window = self._install(device_id, self._recent([device_id], timestamp, message_id)[device_id])
+            self._windows.move_to_end(device_id)
+            window.add(message_id, timestamp, labels)
+            escalate = False
+            if window.score < self.threshold:
+                window.escalated = False
+            elif not window.escalated:
+                window.escalated = True
+                escalate = message_score < self.threshold
+            return window.score, window.labels(), escalate
+
+    def use_weights(self, weights):
+        """Score with these label weights; windows built with others are dropped"""
+        if weights is not self.weights:
+            with self._lock:
+                if weights is not self.weights:
+                    self.weights = weights
+                    self._counted = self._counted_weights(weights)
+                    self._windows.clear()
+
+    def invalidate(self, device_id):
+        with self._lock:
+            self._windows.pop(device_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._windows.clear()
+
+
+conversations = ConversationTracker(
+    span=settings.VIGILEYE_CONVERSATION_WINDOW,
+    max_messages=settings.VIGILEYE_CONVERSATION_MAX_MESSAGES,
+    threshold=settings.VIGILEYE_CONVERSATION_ALERT_SCORE,
+    maxsize=settings.VIGILEYE_CONVERSATION_CACHE_SIZE,
+    weights=default_matcher.label_weights,
+    min_weight=settings.VIGILEYE_CONVERSATION_MIN_WEIGHT,
+)
@@ -0,0 +1,140 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Device
+
+# What the hot endpoints need to know about a device. last_heartbeat is only
+# the value at load time; api.presence holds the live one
+CachedDevice = namedtuple('CachedDevice', [
+    'id', 'kindred_id', 'owner_parent_id', 'location_tracking_enabled', 'last_heartbeat',
+])
+
+DEFAULT_DEVICE_FIELDS = {'owner_parent_id': 'default_parent'}
+
+
+class DeviceResolver:
+    """
+    Resolves kindred_id to a CachedDevice through a bounded LRU cache.
+
+    Entries expire after ``ttl`` seconds so that changes made by other worker
+    processes are picked up; changes made in this process invalidate the
+    entry straight away.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, kindred_id):
+        """Return the device, or None if it does not exist"""
+        return self.get_many([kindred_id]).get(kindred_id)
+
+    def get_or_create(self, kindred_id, defaults=None):
+        """Return (device, created), creating the Device row if needed"""
+        device = self.get(kindred_id)
+        if device is not None:
+            return device, False
+        obj, created = Device.objects.get_or_create(
+            kindred_id=kindred_id,
+            defaults=defaults or DEFAULT_DEVICE_FIELDS,
+        )
+        device = self._store(
+            obj.id, obj.kindred_id, obj.owner_parent_id, obj.location_tracking_enabled, obj.last_heartbeat
+        )
+        return device, created
+
+    def get_many(self, kindred_ids):
+        """Map each existing kindred_id to its device with at most one query"""
+        found = {}
+        missing = []
+        now = time.monotonic()
+        with self._lock:
+            for kindred_id in set(kindred_ids):
+                entry = self._entries.get(kindred_id)
+                if entry is not None and entry[1] > now:
+                    self._entries.move_to_end(kindred_id)
+                    found[kindred_id] = entry[0]
+                    self.hits += 1
+                else:
+                    missing.append(kindred_id)
+                    self.misses += 1
+        if missing:
+            rows = Device.objects.filter(kindred_id__in=missing).values_list(
+                'id', 'kindred_id', 'owner_parent_id', 'location_tracking_enabled', 'last_heartbeat'
+            )
+            for row in rows:
+                found[row[1]] = self._store(*row)
+        return found
+
+    def get_or_create_many(self, kindred_ids, defaults=None):
+        """Like get_many, but creates any devices that are missing"""
+        kindred_ids = set(kindred_ids)
+        devices = self.get_many(kindred_ids)
+        missing = kindred_ids - devices.keys()
+        if missing:
+            defaults = defaults or DEFAULT_DEVICE_FIELDS
+            Device.objects.bulk_create(
+                [Device(kindred_id=kindred_id, **defaults) for kindred_id in missing],
+                ignore_conflicts=True,
+            )
+            # Re-read so concurrently created rows also get their primary keys
+            devices.update(self.get_many(missing))
+        return devices
+
+    def invalidate(self, kindred_id):
+        with self._lock:
+            self._entries.pop(kindred_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+    def _store(self, *fields):
+        device = CachedDevice(*fields)
+        if transaction.get_connection().in_atomic_block:
+            # The row may yet be rolled back; only cache it once committed
+            transaction.on_commit(lambda: self._remember(device))
+        else:
+            self._remember(device)
+        return device
+
+    def _remember(self, device):
+        kindred_id = device.kindred_id
+        with self._lock:
+            self._entries[kindred_id] = (device, time.monotonic() + self.ttl)
+            self._entries.move_to_end(kindred_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+
+devices = DeviceResolver(settings.VIGILEYE_DEVICE_CACHE_SIZE, settings.VIGILEYE_DEVICE_CACHE_TTL)
+
+
+@receiver(post_save, sender=Device)
+@receiver(post_delete, sender=Device)
+def _invalidate_device(sender, instance, **kwargs):
+    devices.invalidate(instance.kindred_id)
@@ -0,0 +1,191 @@
+import asyncio
+import json
+import threading
+from collections import deque
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+
+from .models import Alert, Location
+
+ALERT_FIELDS = ['id', 'device__kindred_id', 'excerpt', 'score', 'risk_level', 'timestamp']
+LOCATION_FIELDS = ['id', 'device__kindred_id', 'latitude', 'longitude', 'accuracy', 'timestamp']
+
+
+def alert_payload(alert_id, kindred_id, excerpt, score, risk_level, timestamp):
+    return {
+        'id': alert_id,
+        'device_kindred_id': kindred_id,
+        'excerpt': excerpt,
+        'score': score,
+        'risk_level': risk_level,
+        'timestamp': timestamp.isoformat(),
+    }
+
+
+def location_payload(location_id, kindred_id, latitude, longitude, accuracy, timestamp):
+    return {
+        'id': location_id,
+        'kindred_id': kindred_id,
+        'latitude': float(latitude),
+        'longitude': float(longitude),
+        'accuracy': accuracy,
+        'timestamp': timestamp.isoformat(),
+        'google_maps_url': Location.google_maps_url(latitude, longitude),
+    }
+
+
+class Subscription:
+    """One connected client: a bounded queue living on the client's event loop"""
+
+    def __init__(self, loop, maxsize):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize)
+        # Set when events were dropped; the stream then catches up from the database
+        self.overflowed = False
+
+    def offer(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+
+class EventBroker:
+    """
+    In-process fan-out of newly created alerts and locations.
+
+    Publishers may run on any thread; each event is handed to every
+    subscriber's own event loop. Only clients connected to this process are
+    reached, so the stream always resumes from the database by id.
+    """
+
+    def __init__(self, queue_size):
+        self.queue_size = queue_size
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        subscription = Subscription(asyncio.get_running_loop(), self.queue_size)
+        with self._lock:
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def publish(self, kind, payloads):
+        """Deliver events once the surrounding transaction (if any) commits"""
+        if payloads:
+            transaction.on_commit(lambda: self._fan_out([(kind, payload) for payload in payloads]))
+
+    def _fan_out(self, events):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            for event in events:
+                try:
+                    subscription.loop.call_soon_threadsafe(subscription.offer, event)
+                except RuntimeError:
+                    # The client's loop has closed
+                    self.unsubscribe(subscription)
+                    break
+
+
+broker = EventBroker(settings.VIGILEYE_STREAM_QUEUE_SIZE)
+
+
+def publish_alerts(payloads):
+    broker.publish('alert', payloads)
+
+
+def publish_locations(payloads):
+    broker.publish('location', payloads)
+
+
+def parse_event_id(value):
+    """Split an 'alert_id-location_id' watermark; None if absent or malformed"""
+    try:
+        alert_id, location_id = value.split('-')
+        return int(alert_id), int(location_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def _current_watermark():
+    return (
+        Alert.objects.order_by('-id').values_list('id', flat=True).first() or 0,
+        Location.objects.order_by('-id').values_list('id', flat=True).first() or 0,
+    )
+
+
+def _missed_events(alert_id, location_id, limit):
+    events = [
+        ('alert', alert_payload(*(row[field] for field in ALERT_FIELDS)))
+        for row in Alert.objects.filter(id__gt=alert_id).order_by('id').values(*ALERT_FIELDS)[:limit]
+    ]
+    events += [
+        ('location', location_payload(*(row[field] for field in LOCATION_FIELDS)))
+        for row in Location.objects.filter(id__gt=location_id).order_by('id').values(*LOCATION_FIELDS)[:limit]
+    ]
+    events.sort(key=lambda event: event[1]['timestamp'])
+    return events
+
+
+def _format(kind, payload, watermark):
+    return f'id: {watermark[0]}-{watermark[1]}\nevent: {kind}\ndata: {json.dumps(payload)}\n\n'
+
+
+async def stream_events(last_event_id):
+    """
+    Async generator of Server-Sent Events for one dashboard client.
+
+    ``last_event_id`` is the id of the last event the client saw; anything
+    newer is replayed from the database before live events are relayed.
+    """
+    subscription = broker.subscribe()
+    try:
+        watermark = parse_event_id(last_event_id)
+        if watermark is None:
+            watermark = await sync_to_async(_current_watermark)()
+        catch_up = last_event_id is not None
+        # Replayed events can also arrive live; remember what was sent recently
+        recent = deque(maxlen=4 * settings.VIGILEYE_STREAM_REPLAY_LIMIT)
+        sent = set()
+        yield f'retry: {settings.VIGILEYE_STREAM_RETRY_MS}\n\n'
+
+        while True:
+            if catch_up or subscription.overflowed:
+                subscription.overflowed = False
+                events = await sync_to_async(_missed_events)(*watermark, settings.VIGILEYE_STREAM_REPLAY_LIMIT)
+                catch_up = len(events) >= settings.VIGILEYE_STREAM_REPLAY_LIMIT
+            else:
+                try:
+                    events = [await asyncio.wait_for(
+                        subscription.queue.get(), settings.VIGILEYE_STREAM_KEEPALIVE
+                    )]
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'
+                    continue
+
+            for kind, payload in events:
+                key = (kind, payload['id'])
+                if key in sent:
+                    continue
+                if len(recent) == recent.maxlen:
+                    sent.discard(recent[0])
+                recent.append(key)
+                sent.add(key)
+                if kind == 'alert':
+                    watermark = (max(watermark[0], payload['id']), watermark[1])
+                else:
+                    watermark = (watermark[0], max(watermark[1], payload['id']))
+                yield _format(kind, payload, watermark)
+    finally:
+        broker.unsubscribe(subscription)
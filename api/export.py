@@ -0,0 +1,295 @@
+import csv
+import io
+import json
+import logging
+import os
+import queue
+import threading
+import zlib
+from datetime import datetime
+from decimal import Decimal
+from pathlib import Path
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover - pyarrow is optional
+    pa = pq = None
+
+from django.conf import settings
+from django.db import close_old_connections, connection, router
+from django.utils import timezone
+
+from .models import Alert, ExportJob, Location, Message
+
+logger = logging.getLogger(__name__)
+
+# Exported table -> (model, fields read with values_list())
+EXPORTS = {
+    'alerts': (Alert, ['id', 'device__kindred_id', 'score', 'risk_level', 'excerpt', 'acknowledged',
+                       'occurrences', 'last_seen', 'timestamp']),
+    'messages': (Message, ['id', 'device__kindred_id', 'message_text', 'risk_score', 'risk_level',
+                           'flagged_keywords', 'duplicate_count', 'timestamp']),
+    'locations': (Location, ['id', 'device__kindred_id', 'latitude', 'longitude', 'accuracy', 'timestamp']),
+}
+
+# Format -> (file extension, content type); csv and ndjson are gzipped
+FORMATS = {
+    'csv': ('csv.gz', 'application/gzip'),
+    'ndjson': ('ndjson.gz', 'application/gzip'),
+    'parquet': ('parquet', 'application/vnd.apache.parquet'),
+}
+
+# Encoded bytes buffered before a chunk is handed on
+CHUNK_BYTES = 64 * 1024
+
+
+def columns(table):
+    return [field.replace('device__', '') for field in EXPORTS[table][1]]
+
+
+def parquet_available():
+    return pa is not None
+
+
+def export_rows(table, device_id=None, since=None, until=None):
+    """
+    Rows of ``table`` oldest first as tuples, fetched
+    VIGILEYE_EXPORT_CHUNK_SIZE at a time so memory stays flat
+    """
+    model, fields = EXPORTS[table]
+    queryset = model.objects.using(router.db_for_read(model))
+    if device_id is not None:
+        queryset = queryset.filter(device_id=device_id)
+    if since is not None:
+        queryset = queryset.filter(timestamp__gte=since)
+    if until is not None:
+        queryset = queryset.filter(timestamp__lte=until)
+    return queryset.order_by('timestamp', 'id').values_list(*fields).iterator(
+        chunk_size=settings.VIGILEYE_EXPORT_CHUNK_SIZE
+    )
+
+
+def _text(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (list, dict)):
+        return json.dumps(value)
+    return value
+
+
+def _json(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+
+def csv_chunks(table, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns(table))
+    for row in rows:
+        writer.writerow([_text(value) for value in row])
+        if buffer.tell() >= CHUNK_BYTES:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode()
+
+
+def ndjson_chunks(table, rows):
+    names = columns(table)
+    lines = []
+    size = 0
+    for row in rows:
+        line = json.dumps({name: _json(value) for name, value in zip(names, row)}, ensure_ascii=False)
+        lines.append(line)
+        size += len(line) + 1
+        if size >= CHUNK_BYTES:
+            yield ('\n'.join(lines) + '\n').encode()
+            lines = []
+            size = 0
+    if lines:
+        yield ('\n'.join(lines) + '\n').encode()
+
+
+ENCODERS = {
+    'csv': csv_chunks,
+    'ndjson': ndjson_chunks,
+}
+
+
+def gzip_chunks(chunks):
+    """Compress a stream of byte chunks into one gzip stream as it goes"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _parquet_schema(table):
+    types = {
+        'id': pa.int64(),
+        'kindred_id': pa.string(),
+        'score': pa.int32(),
+        'risk_score': pa.int32(),
+        'risk_level': pa.string(),
+        'excerpt': pa.string(),
+        'message_text': pa.string(),
+        'acknowledged': pa.bool_(),
+        'occurrences': pa.int32(),
+        'duplicate_count': pa.int32(),
+        'flagged_keywords': pa.list_(pa.string()),
+        'latitude': pa.float64(),
+        'longitude': pa.float64(),
+        'accuracy': pa.float64(),
+        'last_seen': pa.timestamp('us', tz='UTC'),
+        'timestamp': pa.timestamp('us', tz='UTC'),
+    }
+    return pa.schema([(name, types[name]) for name in columns(table)])
+
+
+def write_parquet(path, table, rows):
+    """Write rows to a Parquet file, one row group per chunk of rows"""
+    if pa is None:
+        raise ValueError('Parquet exports need pyarrow installed')
+    schema = _parquet_schema(table)
+    names = schema.names
+    chunk_size = settings.VIGILEYE_EXPORT_CHUNK_SIZE
+    with pq.ParquetWriter(path, schema, compression='zstd') as writer:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= chunk_size:
+                writer.write_batch(_record_batch(schema, names, batch))
+                batch = []
+        if batch:
+            writer.write_batch(_record_batch(schema, names, batch))
+
+
+def _record_batch(schema, names, batch):
+    data = {
+        name: [float(value) if isinstance(value, Decimal) else value for value in values]
+        for name, values in zip(names, zip(*batch))
+    }
+    return pa.RecordBatch.from_pydict(data, schema=schema)
+
+
+def export_path(job):
+    return Path(settings.VIGILEYE_EXPORT_DIR) / job.file_name
+
+
+def run_job(job_id):
+    """
+    Write one pending ExportJob to its file. The job is claimed with a
+    conditional update first, so a job queued twice (or picked up by two
+    processes) is only written once.
+    """
+    if not ExportJob.objects.filter(id=job_id, status='pending').update(status='running'):
+        return
+    job = ExportJob.objects.get(id=job_id)
+    job.file_name = f'{job.id}-{job.table}.{FORMATS[job.format][0]}'
+    path = export_path(job)
+    tmp = path.with_name(path.name + '.tmp')
+    counter = [0]
+
+    def counted(rows):
+        for row in rows:
+            counter[0] += 1
+            yield row
+
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        rows = counted(export_rows(job.table, job.device_id, job.since, job.until))
+        if job.format == 'parquet':
+            write_parquet(tmp, job.table, rows)
+        else:
+            with open(tmp, 'wb') as f:
+                for chunk in gzip_chunks(ENCODERS[job.format](job.table, rows)):
+                    f.write(chunk)
+        os.replace(tmp, path)
+    except Exception as e:
+        logger.exception('Export #%s failed', job.id)
+        tmp.unlink(missing_ok=True)
+        ExportJob.objects.filter(id=job.id).update(status='failed', error=str(e), finished_at=timezone.now())
+        return
+    ExportJob.objects.filter(id=job.id).update(
+        status='done', rows=counter[0], file_name=job.file_name, size_bytes=path.stat().st_size,
+        finished_at=timezone.now(),
+    )
+    logger.info('Export #%s done: table=%s format=%s rows=%d bytes=%d',
+                job.id, job.table, job.format, counter[0], path.stat().st_size)
+
+
+class ExportWorker:
+    """
+    Runs ExportJobs one at a time on a background thread. On start it also
+    queues the jobs an earlier process left pending. A job already waiting
+    in the queue is not queued again.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._queued = set()
+
+    def submit(self, job_id):
+        self._ensure_worker()
+        self._put(job_id)
+
+    def _put(self, job_id):
+        with self._lock:
+            if job_id in self._queued:
+                return
+            self._queued.add(job_id)
+        self._queue.put(job_id)
+
+    def join(self):
+        """Wait until every submitted job has run"""
+        self._queue.join()
+
+    def stop(self, timeout=10):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join(timeout)
+
+    def _ensure_worker(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='vigileye-export', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        try:
+            for job_id in ExportJob.objects.filter(status='pending').values_list('id', flat=True):
+                self._put(job_id)
+        except Exception:
+            logger.exception('Could not load pending exports')
+        while True:
+            job_id = self._queue.get()
+            try:
+                if job_id is None:
+                    connection.close()
+                    return
+                with self._lock:
+                    self._queued.discard(job_id)
+                close_old_connections()
+                run_job(job_id)
+            except Exception:
+                logger.exception('Export #%s crashed', job_id)
+            finally:
+                self._queue.task_done()
+
+
+exports = ExportWorker()
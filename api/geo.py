@@ -0,0 +1,264 @@
+import math
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - numpy is optional
+    np = None
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+# Mean Earth radius in meters
+EARTH_RADIUS_M = 6371008.8
+
+# Geohash length stored in Location.cell (about 150 m x 150 m), small enough
+# for nearby queries to look cells up by equality; changing it requires
+# recomputing every row
+GEOHASH_PRECISION = 7
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+# Sorts after every geohash character, giving an exclusive prefix upper bound
+GEOHASH_SENTINEL = '~'
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Great-circle distance in meters between two points in degrees"""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(min(1.0, a)))
+
+
+def haversine_many(latitude, longitude, latitudes, longitudes):
+    """Distances in meters from one point to many; vectorized when numpy is available"""
+    if np is not None:
+        phi1 = math.radians(latitude)
+        phi2 = np.radians(np.asarray(latitudes, dtype=float))
+        dlambda = np.radians(np.asarray(longitudes, dtype=float) - longitude)
+        a = np.sin((phi2 - phi1) / 2) ** 2 + math.cos(phi1) * np.cos(phi2) * np.sin(dlambda / 2) ** 2
+        return (2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(1.0, a)))).tolist()
+    return [haversine_m(latitude, longitude, lat, lon) for lat, lon in zip(latitudes, longitudes)]
+
+
+def geohash_encode(latitude, longitude, precision=GEOHASH_PRECISION):
+    """Geohash of a point, ``precision`` characters long"""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    while len(chars) < precision:
+        target, interval = (longitude, lon_range) if even else (latitude, lat_range)
+        middle = (interval[0] + interval[1]) / 2
+        value <<= 1
+        if target >= middle:
+            value |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(GEOHASH_ALPHABET[value])
+            bits = 0
+            value = 0
+    return ''.join(chars)
+
+
+def geohash_cell_size(precision):
+    """(height, width) in degrees of a geohash cell of the given length"""
+    lon_bits = (5 * precision + 1) // 2
+    lat_bits = 5 * precision // 2
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lon_bits
+
+
+def covering_cells(min_lat, min_lon, max_lat, max_lon, max_cells):
+    """
+    The longest geohash prefixes, at most ``max_cells`` of them, whose cells
+    together cover the bounding box. Boxes crossing the antimeridian are not
+    supported; pass min_lon <= max_lon.
+    """
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        height, width = geohash_cell_size(precision)
+        rows = math.floor(max_lat / height) - math.floor(min_lat / height) + 1
+        columns = math.floor(max_lon / width) - math.floor(min_lon / width) + 1
+        if rows * columns <= max_cells:
+            break
+    cells = set()
+    for row in range(rows):
+        latitude = min(min_lat + row * height, max_lat)
+        for column in range(columns):
+            longitude = min(min_lon + column * width, max_lon)
+            cells.add(geohash_encode(latitude, longitude, precision))
+        cells.add(geohash_encode(latitude, max_lon, precision))
+    for column in range(columns):
+        cells.add(geohash_encode(max_lat, min(min_lon + column * width, max_lon), precision))
+    cells.add(geohash_encode(max_lat, max_lon, precision))
+    return sorted(cells)
+
+
+def bounding_box(latitude, longitude, radius_m):
+    """(min_lat, min_lon, max_lat, max_lon) enclosing a circle, clamped to valid ranges"""
+    dlat = math.degrees(radius_m / EARTH_RADIUS_M)
+    cos_lat = math.cos(math.radians(latitude))
+    dlon = 180.0 if cos_lat < 1e-9 else math.degrees(radius_m / (EARTH_RADIUS_M * cos_lat))
+    return (
+        max(-90.0, latitude - dlat),
+        max(-180.0, longitude - dlon),
+        min(90.0, latitude + dlat),
+        min(180.0, longitude + dlon),
+    )
+
+
+def point_in_polygon(latitude, longitude, vertices):
+    """Ray casting test; ``vertices`` is a list of [lat, lon] pairs, open or closed"""
+    inside = False
+    j = len(vertices) - 1
+    for i in range(len(vertices)):
+        lat_i, lon_i = vertices[i]
+        lat_j, lon_j = vertices[j]
+        if (lat_i > latitude) != (lat_j > latitude):
+            crossing = lon_i + (latitude - lat_i) * (lon_j - lon_i) / (lat_j - lat_i)
+            if longitude < crossing:
+                inside = not inside
+        j = i
+    return inside
+
+
+def polygon_bounds(vertices):
+    """(min_lat, min_lon, max_lat, max_lon) of a polygon"""
+    latitudes = [vertex[0] for vertex in vertices]
+    longitudes = [vertex[1] for vertex in vertices]
+    return min(latitudes), min(longitudes), max(latitudes), max(longitudes)
+
+
+def _project(fixes):
+    """Equirectangular projection to meters around the first fix, good for short tracks"""
+    lat0 = math.radians(fixes[0]['latitude'])
+    scale = math.cos(lat0)
+    return [
+        (
+            math.radians(fix['longitude']) * scale * EARTH_RADIUS_M,
+            math.radians(fix['latitude']) * EARTH_RADIUS_M,
+        )
+        for fix in fixes
+    ]
+
+
+def _segment_distance(p, a, b):
+    """Distance from point p to segment ab in projected meters"""
+    dx = b[0] - a[0]
+    dy = b[1] - a[1]
+    length_sq = dx * dx + dy * dy
+    if length_sq == 0:
+        return math.hypot(p[0] - a[0], p[1] - a[1])
+    t = max(0.0, min(1.0, ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / length_sq))
+    return math.hypot(p[0] - a[0] - t * dx, p[1] - a[1] - t * dy)
+
+
+def douglas_peucker(fixes, tolerance_m):
+    """Indexes of the fixes kept by Douglas-Peucker simplification"""
+    if len(fixes) < 3:
+        return list(range(len(fixes)))
+    points = _project(fixes)
+    keep = {0, len(points) - 1}
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        farthest, distance = None, tolerance_m
+        for index in range(first + 1, last):
+            d = _segment_distance(points[index], points[first], points[last])
+            if d > distance:
+                farthest, distance = index, d
+        if farthest is not None:
+            keep.add(farthest)
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+    return sorted(keep)
+
+
+def simplify_track(fixes, tolerance_m, min_jitter_m, max_gap_s, previous=None):
+    """
+    Drop redundant fixes from a time-ordered track.
+
+    A fix closer to the last kept fix than either fix's reported accuracy
+    (or ``min_jitter_m``) is stationary jitter and is dropped, unless more
+    than ``max_gap_s`` seconds have passed, so a device that stays put still
+    reports in. The rest are simplified with Douglas-Peucker at
+    ``tolerance_m``, never across such a time gap. ``previous`` is the last
+    fix already stored for the device; it is only used for comparison.
+    Fixes are dicts with latitude, longitude, accuracy and timestamp.
+    """
+    filtered = []
+    last = previous
+    for fix in fixes:
+        if last is not None:
+            radius = max(fix['accuracy'] or 0, last['accuracy'] or 0, min_jitter_m)
+            moved = haversine_m(last['latitude'], last['longitude'], fix['latitude'], fix['longitude'])
+            elapsed = (fix['timestamp'] - last['timestamp']).total_seconds()
+            if moved <= radius and elapsed <= max_gap_s:
+                continue
+        filtered.append(fix)
+        last = fix
+
+    kept = []
+    start = 0
+    for index in range(1, len(filtered) + 1):
+        at_gap = index < len(filtered) and (
+            (filtered[index]['timestamp'] - filtered[index - 1]['timestamp']).total_seconds() > max_gap_s
+        )
+        if index == len(filtered) or at_gap:
+            segment = filtered[start:index]
+            kept.extend(segment[i] for i in douglas_peucker(segment, tolerance_m))
+            start = index
+    return kept
+
+
+def parse_fix(item):
+    """
+    Validate one client fix into a dict for simplify_track().
+
+    ``timestamp`` may be epoch milliseconds (as reported by the browser
+    Geolocation API) or an ISO 8601 string; it defaults to now. Raises
+    ValueError for anything malformed, or for a timestamp further ahead of
+    the server clock than VIGILEYE_LOCATION_MAX_CLOCK_SKEW.
+    """
+    if not isinstance(item, dict):
+        raise ValueError('Each fix must be an object')
+    try:
+        latitude = float(item['latitude'])
+        longitude = float(item['longitude'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('latitude and longitude are required numbers')
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError('latitude or longitude out of range')
+
+    accuracy = item.get('accuracy')
+    if accuracy is not None:
+        try:
+            accuracy = float(accuracy)
+        except (TypeError, ValueError):
+            raise ValueError('accuracy must be a number')
+
+    now = timezone.now()
+    timestamp = item.get('timestamp')
+    if timestamp is None:
+        timestamp = now
+    elif isinstance(timestamp, (int, float)) and not isinstance(timestamp, bool):
+        try:
+            timestamp = datetime.fromtimestamp(timestamp / 1000, tz=dt_timezone.utc)
+        except (OverflowError, OSError, ValueError):
+            raise ValueError('timestamp is out of range')
+    else:
+        parsed = parse_datetime(timestamp) if isinstance(timestamp, str) else None
+        if parsed is None:
+            raise ValueError('timestamp must be epoch milliseconds or ISO 8601')
+        timestamp = parsed if timezone.is_aware(parsed) else timezone.make_aware(parsed)
+    if timestamp > now + timedelta(seconds=settings.VIGILEYE_LOCATION_MAX_CLOCK_SKEW):
+        raise ValueError('timestamp is in the future')
+
+    return {'latitude': latitude, 'longitude': longitude, 'accuracy': accuracy, 'timestamp': timestamp}
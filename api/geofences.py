@@ -0,0 +1,209 @@
+import math
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, Value, When
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .events import alert_payload, publish_alerts
+from .geo import haversine_m, point_in_polygon
+from .models import Alert, Geofence
+from .risk import risk_level_for_score
+
+# An active fence as held in memory, with its bounding box precomputed
+Fence = namedtuple('Fence', [
+    'id', 'name', 'kind', 'center_latitude', 'center_longitude', 'radius_m', 'vertices',
+    'min_latitude', 'min_longitude', 'max_latitude', 'max_longitude',
+])
+
+FENCE_FIELDS = list(Fence._fields)
+
+
+def validate_fence(data):
+    """
+    Turn a create request into Geofence field values; raises ValueError.
+
+    Circles take ``center`` ({latitude, longitude}) and ``radius`` in meters,
+    polygons take ``vertices`` as a list of [latitude, longitude] pairs.
+    """
+    name = str(data.get('name') or '').strip()
+    if not name:
+        raise ValueError('name is required')
+    kind = data.get('kind')
+    try:
+        if kind == 'circle':
+            center = data['center']
+            fields = {
+                'center_latitude': float(center['latitude']),
+                'center_longitude': float(center['longitude']),
+                'radius_m': float(data['radius']),
+            }
+            points = [(fields['center_latitude'], fields['center_longitude'])]
+            if not 0 < fields['radius_m'] <= settings.VIGILEYE_GEOFENCE_MAX_RADIUS:
+                raise ValueError(f'radius must be between 0 and {settings.VIGILEYE_GEOFENCE_MAX_RADIUS} meters')
+        elif kind == 'polygon':
+            points = [(float(lat), float(lon)) for lat, lon in data['vertices']]
+            if not 3 <= len(points) <= settings.VIGILEYE_GEOFENCE_MAX_VERTICES:
+                raise ValueError(f'a polygon needs 3 to {settings.VIGILEYE_GEOFENCE_MAX_VERTICES} vertices')
+            fields = {'vertices': [list(point) for point in points]}
+        else:
+            raise ValueError("kind must be 'circle' or 'polygon'")
+    except (KeyError, TypeError) as e:
+        raise ValueError(f'missing or malformed field: {e}')
+    if not all(-90 <= lat <= 90 and -180 <= lon <= 180 for lat, lon in points):
+        raise ValueError('coordinates out of range')
+    return dict(fields, name=name[:100], kind=kind)
+
+
+def contains(fence, latitude, longitude):
+    """Exact containment test, after a cheap bounding box check"""
+    if not (fence.min_latitude <= latitude <= fence.max_latitude
+            and fence.min_longitude <= longitude <= fence.max_longitude):
+        return False
+    if fence.kind == 'circle':
+        return haversine_m(fence.center_latitude, fence.center_longitude, latitude, longitude) <= fence.radius_m
+    return point_in_polygon(latitude, longitude, fence.vertices)
+
+
+class DeviceFences:
+    """
+    The active fences of one device, bucketed on a lat/lon grid by bounding
+    box so that a fix is only tested against fences that can contain it.
+    """
+
+    def __init__(self, fences, states, grid):
+        self.grid = grid
+        # Ids of the fences the device is in, and of those never evaluated
+        self.inside = {fence_id for fence_id, state in states.items() if state}
+        self.unknown = {fence_id for fence_id, state in states.items() if state is None}
+        self._buckets = {}
+        self._large = []
+        for fence in fences:
+            rows = range(math.floor(fence.min_latitude / grid), math.floor(fence.max_latitude / grid) + 1)
+            columns = range(math.floor(fence.min_longitude / grid), math.floor(fence.max_longitude / grid) + 1)
+            if len(rows) * len(columns) > 64:
+                # Too big to bucket; checked against every fix by bounding box
+                self._large.append(fence)
+                continue
+            for row in rows:
+                for column in columns:
+                    self._buckets.setdefault((row, column), []).append(fence)
+        self.fences = {fence.id: fence for fence in fences}
+
+    def containing(self, latitude, longitude):
+        """Ids of the fences containing the point"""
+        key = (math.floor(latitude / self.grid), math.floor(longitude / self.grid))
+        candidates = self._buckets.get(key, []) + self._large
+        return {fence.id for fence in candidates if contains(fence, latitude, longitude)}
+
+
+class GeofenceIndex:
+    """
+    In-memory index of active fences per device, loaded on first use.
+
+    Edits made in this process invalidate the device's entry; entries also
+    expire after ``ttl`` seconds to pick up edits made by other processes.
+    The inside/outside state of every fence is kept here and written back
+    to Geofence.inside whenever it changes.
+    """
+
+    def __init__(self, ttl, grid):
+        self.ttl = ttl
+        self.grid = grid
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def invalidate(self, device_id):
+        with self._lock:
+            self._entries.pop(device_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _load(self, device_id):
+        with self._lock:
+            entry = self._entries.get(device_id)
+            if entry is not None and entry[1] > time.monotonic():
+                return entry[0]
+        rows = list(Geofence.objects.filter(device_id=device_id, active=True).values_list(*FENCE_FIELDS, 'inside'))
+        fences = DeviceFences(
+            [Fence(*row[:-1]) for row in rows],
+            {row[0]: row[-1] for row in rows},
+            self.grid,
+        )
+        with self._lock:
+            self._entries[device_id] = (fences, time.monotonic() + self.ttl)
+        return fences
+
+    def evaluate(self, device_id, kindred_id, fixes):
+        """
+        Test a device's time-ordered fixes against its fences.
+
+        Every enter or exit becomes one Alert, written with one bulk insert,
+        and the changed fence states with one UPDATE; a device without
+        fences costs no queries once loaded. Returns the created alerts.
+        """
+        fences = self._load(device_id)
+        if not fences.fences:
+            return []
+
+        events = []
+        changed = {}
+        with self._lock:
+            inside = fences.inside
+            for fix in fixes:
+                current = fences.containing(fix['latitude'], fix['longitude'])
+                # Fences never evaluated before are settled by this fix, without alerts
+                settled, fences.unknown = fences.unknown, set()
+                for fence_id in settled:
+                    changed[fence_id] = fence_id in current
+                for fence_id in inside - current:
+                    events.append((fences.fences[fence_id], False))
+                    changed[fence_id] = False
+                for fence_id in current - inside - settled:
+                    events.append((fences.fences[fence_id], True))
+                    changed[fence_id] = True
+                inside = current
+            fences.inside = inside
+
+        if not changed:
+            return []
+        try:
+            with transaction.atomic():
+                Geofence.objects.filter(id__in=list(changed)).update(inside=Case(
+                    *[When(id=fence_id, then=Value(state)) for fence_id, state in changed.items()]
+                ))
+                score = settings.VIGILEYE_GEOFENCE_ALERT_SCORE
+                alerts = Alert.objects.bulk_create([
+                    Alert(
+                        device_id=device_id,
+                        source='geofence',
+                        excerpt=f"{'Entered' if entered else 'Left'} geofence '{fence.name}'",
+                        score=score,
+                        risk_level=risk_level_for_score(score),
+                    )
+                    for fence, entered in events
+                ])
+                publish_alerts([
+                    alert_payload(alert.id, kindred_id, alert.excerpt, alert.score, alert.risk_level, alert.timestamp)
+                    for alert in alerts
+                ])
+        except Exception:
+            # Our state may now be ahead of the database; reload next time
+            self.invalidate(device_id)
+            raise
+        return alerts
+
+
+geofences = GeofenceIndex(settings.VIGILEYE_GEOFENCE_CACHE_TTL, settings.VIGILEYE_GEOFENCE_GRID)
+
+
+@receiver(post_save, sender=Geofence)
+@receiver(post_delete, sender=Geofence)
+def _invalidate_fences(sender, instance, **kwargs):
+    geofences.invalidate(instance.device_id)
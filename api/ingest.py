@@ -0,0 +1,357 @@
+import atexit
+import hashlib
+import logging
+import queue
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+from django.db import OperationalError, close_old_connections, transaction
+from django.db.models import Case, F, When
+from django.utils import timezone
+
+from .conversation import conversations
+from .devices import devices as device_resolver
+from .events import alert_payload, publish_alerts
+from .lexicon import lexicons
+from .metrics import record_risk_time
+from .models import Alert, Message
+from .notifications import send_notification
+from .risk import detect_risk, risk_level_for_score
+from .writer import writes
+
+logger = logging.getLogger(__name__)
+
+
+def content_hash(text):
+    """Short digest of a message text, for spotting repeats"""
+    return hashlib.blake2b(text.encode(), digest_size=8).hexdigest()
+
+
+def _recent_copies(keys, now, lexicon_version):
+    """
+    Latest stored message per (device_id, content_hash) of ``keys`` within
+    the duplicate window: (message_id, alert_id, risk_score, risk_level,
+    flagged_keywords), from one query on the device/hash index. Copies
+    scored by another lexicon version do not count, that one may score
+    the text differently.
+    """
+    rows = Message.objects.filter(
+        device_id__in={device_id for device_id, _ in keys},
+        content_hash__in={digest for _, digest in keys},
+        timestamp__gte=now - timezone.timedelta(seconds=settings.VIGILEYE_DUPLICATE_WINDOW),
+        lexicon_version=lexicon_version,
+    ).order_by('id').values_list(
+        'device_id', 'content_hash', 'id', 'alerts__id', 'risk_score', 'risk_level', 'flagged_keywords'
+    )
+    return {(row[0], row[1]): row[2:] for row in rows if (row[0], row[1]) in keys}
+
+
+def _count_repeats(repeats, now):
+    """Add repeats to already stored messages and their alerts: {message_id: count}"""
+    if not repeats:
+        return
+    Message.objects.filter(id__in=list(repeats)).update(duplicate_count=Case(
+        *[When(id=message_id, then=F('duplicate_count') + count) for message_id, count in repeats.items()]
+    ))
+    Alert.objects.filter(message_id__in=list(repeats)).update(
+        occurrences=Case(
+            *[When(message_id=message_id, then=F('occurrences') + count) for message_id, count in repeats.items()]
+        ),
+        last_seen=now,
+    )
+
+
+def record_messages(items):
+    """
+    Score and store a batch of (kindred_id, text) pairs.
+
+    Messages are scored in the calling thread; they and their Alerts are
+    then inserted with bulk_create in one transaction, by the write funnel.
+    Each message also feeds its device's conversation window, which can
+    raise an extra escalation Alert for risk spread over several messages.
+    Text a device already sent within VIGILEYE_DUPLICATE_WINDOW is not
+    stored again: it is counted on the first copy and folded into that
+    copy's alert. Returns one result dict per item, in the order given.
+    """
+    lexicon = lexicons.current()
+    now = timezone.now()
+    devices = device_resolver.get_or_create_many(kindred_id for kindred_id, _ in items)
+    keys = [(devices[kindred_id].id, content_hash(text)) for kindred_id, text in items]
+
+    # Split the batch into new texts and repeats of a stored or earlier one
+    copies = _recent_copies(set(keys), now, lexicon.version) if settings.VIGILEYE_DUPLICATE_WINDOW else {}
+    first = {}
+    repeats = Counter()
+    for index, key in enumerate(keys):
+        if key in copies or key in first:
+            repeats[key] += 1
+        elif settings.VIGILEYE_DUPLICATE_WINDOW:
+            first[key] = index
+    fresh = [index for index, key in enumerate(keys) if key not in copies and first.get(key, index) == index]
+    scored = {}
+    started = time.perf_counter()
+    for index in fresh:
+        kindred_id, text = items[index]
+        scored[index] = (kindred_id, text) + detect_risk(text, lexicon.matcher)
+    record_risk_time(time.perf_counter() - started)
+
+    conversations.use_weights(lexicon.matcher.label_weights)
+    conversations.warm([device.id for device in devices.values()], now)
+
+    def store():
+        with transaction.atomic():
+            message_objs = {
+                index: Message(
+                    device_id=devices[kindred_id].id,
+                    message_text=text,
+                    risk_score=risk_score,
+                    risk_level=risk_level,
+                    flagged_keywords=flagged_keywords,
+                    lexicon_version=lexicon.version,
+                    content_hash=keys[index][1],
+                    duplicate_count=repeats[keys[index]],
+                )
+                for index, (kindred_id, text, risk_score, flagged_keywords, risk_level) in scored.items()
+            }
+            Message.objects.bulk_create(list(message_objs.values()))
+
+            # Create alerts for risky messages
+            alert_objs = {}
+            for index, (kindred_id, text, risk_score, _, risk_level) in scored.items():
+                if risk_score > 0:
+                    repeated = repeats[keys[index]]
+                    alert_objs[index] = Alert(
+                        device_id=devices[kindred_id].id,
+                        message_id=message_objs[index].id,
+                        excerpt=text,
+                        score=risk_score,
+                        risk_level=risk_level,
+                        occurrences=1 + repeated,
+                        last_seen=now if repeated else None,
+                    )
+
+            # Escalate when the conversation as a whole crosses the threshold
+            windows = {}
+            escalation_objs = {}
+            for index, message in message_objs.items():
+                kindred_id, text, risk_score, flagged_keywords, _ = scored[index]
+                window_score, window_labels, escalate = conversations.observe(
+                    message.device_id, message.id, message.timestamp, flagged_keywords, risk_score
+                )
+                windows[index] = window_score
+                if escalate:
+                    escalation_objs[index] = Alert(
+                        device_id=message.device_id,
+                        source='conversation',
+                        excerpt=f"Conversation risk ({', '.join(window_labels)}): {text}",
+                        score=window_score,
+                        risk_level=risk_level_for_score(window_score),
+                    )
+
+            Alert.objects.bulk_create(list(alert_objs.values()) + list(escalation_objs.values()))
+            _count_repeats({copies[key][0]: count for key, count in repeats.items() if key in copies}, now)
+            publish_alerts([
+                alert_payload(alert.id, scored[index][0], alert.excerpt, alert.score, alert.risk_level, alert.timestamp)
+                for created in (alert_objs, escalation_objs)
+                for index, alert in created.items()
+            ])
+        return message_objs, alert_objs, escalation_objs, windows
+
+    try:
+        # Written by the single writer, together with other requests' writes
+        message_objs, alert_objs, escalation_objs, windows = writes.run(store)
+    except Exception:
+        # Windows may hold messages that were rolled back
+        for device in devices.values():
+            conversations.invalidate(device.id)
+        raise
+
+    results = []
+    for index, (kindred_id, text) in enumerate(items):
+        if index not in scored:
+            # A repeat: report the copy it was counted on
+            key = keys[index]
+            if key in copies:
+                message_id, alert_id, risk_score, risk_level, flagged_keywords = copies[key]
+            else:
+                original = first[key]
+                message_id = message_objs[original].id
+                alert_id = alert_objs[original].id if original in alert_objs else None
+                _, _, risk_score, flagged_keywords, risk_level = scored[original]
+            results.append({
+                'kindred_id': kindred_id,
+                'message_id': message_id,
+                'alert_id': alert_id,
+                'risk_score': risk_score,
+                'risk_level': risk_level,
+                'flagged_keywords': flagged_keywords,
+                'conversation_score': None,
+                'lexicon_version': lexicon.version,
+                'escalation_alert_id': None,
+                'duplicate': True,
+            })
+            continue
+
+        _, _, risk_score, flagged_keywords, risk_level = scored[index]
+        alert = alert_objs.get(index)
+        escalation = escalation_objs.get(index)
+        # Send notification for high-risk messages
+        if risk_level == 'high':
+            send_notification(
+                f"High-risk alert for device {kindred_id}: {text}",
+                risk_level,
+                parent_id=devices[kindred_id].owner_parent_id,
+            )
+        elif escalation is not None and escalation.risk_level == 'high':
+            send_notification(
+                f"High-risk conversation on device {kindred_id}: {escalation.excerpt}",
+                escalation.risk_level,
+                parent_id=devices[kindred_id].owner_parent_id,
+            )
+        results.append({
+            'kindred_id': kindred_id,
+            'message_id': message_objs[index].id,
+            'alert_id': alert.id if alert else None,
+            'risk_score': risk_score,
+            'risk_level': risk_level,
+            'flagged_keywords': flagged_keywords,
+            'conversation_score': windows[index],
+            'lexicon_version': lexicon.version,
+            'escalation_alert_id': escalation.id if escalation else None,
+            'duplicate': False,
+        })
+    return results
+
+
+class IngestQueue:
+    """
+    Bounded in-process queue between the analyze views and the database.
+
+    Views submit (kindred_id, text) pairs and get a ticket back immediately;
+    a pool of daemon threads drains the queue in micro-batches through
+    record_messages. Results for recent tickets are kept for status lookups.
+    """
+
+    def __init__(self, maxsize, workers, batch_size, linger, history):
+        self.batch_size = batch_size
+        self.linger = linger
+        self.history = history
+        self._queue = queue.Queue(maxsize)
+        self._tickets = OrderedDict()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._threads = [
+            threading.Thread(target=self._run, name=f'vigileye-ingest-{n}', daemon=True)
+            for n in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, kindred_id, text):
+        """Queue one message and return its ticket id; raises queue.Full"""
+        ticket = uuid.uuid4().hex
+        with self._lock:
+            self._remember(ticket, {'status': 'queued'})
+        try:
+            self._queue.put_nowait((ticket, kindred_id, text))
+        except queue.Full:
+            with self._lock:
+                self._tickets.pop(ticket, None)
+            raise
+        return ticket
+
+    def status(self, ticket):
+        """Return the recorded state of a ticket, or None if unknown"""
+        with self._lock:
+            return self._tickets.get(ticket)
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def stop(self, timeout=None):
+        """Drain what is queued, then stop the workers"""
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _remember(self, ticket, state):
+        self._tickets[ticket] = state
+        self._tickets.move_to_end(ticket)
+        while len(self._tickets) > self.history:
+            self._tickets.popitem(last=False)
+
+    def _next_batch(self):
+        try:
+            batch = [self._queue.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.linger
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not (self._stopping.is_set() and self._queue.empty()):
+            batch = self._next_batch()
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch, attempts=5):
+        close_old_connections()
+        pairs = [(kindred_id, text) for _, kindred_id, text in batch]
+        for attempt in range(attempts):
+            try:
+                results = record_messages(pairs)
+                states = [dict(result, status='done') for result in results]
+                break
+            except OperationalError as e:
+                # Typically "database is locked"; back off and retry the batch
+                logger.warning('Ingest batch of %d failed (attempt %d): %s', len(batch), attempt + 1, e)
+                time.sleep(0.1 * 2 ** attempt)
+            except Exception as e:
+                logger.exception('Ingest batch of %d failed', len(batch))
+                states = [{'status': 'failed', 'error': str(e)}] * len(batch)
+                break
+        else:
+            states = [{'status': 'failed', 'error': 'database unavailable'}] * len(batch)
+        close_old_connections()
+
+        with self._lock:
+            for (ticket, _, _), state in zip(batch, states):
+                if ticket in self._tickets:
+                    self._remember(ticket, state)
+
+
+_ingest_queue = None
+_ingest_queue_lock = threading.Lock()
+
+
+def ingest_enabled():
+    return settings.VIGILEYE_INGEST_MODE == 'queue'
+
+
+def get_ingest_queue():
+    """Return the process-wide ingest queue, starting its workers on first use"""
+    global _ingest_queue
+    if _ingest_queue is None:
+        with _ingest_queue_lock:
+            if _ingest_queue is None:
+                _ingest_queue = IngestQueue(
+                    maxsize=settings.VIGILEYE_INGEST_QUEUE_SIZE,
+                    workers=settings.VIGILEYE_INGEST_WORKERS,
+                    batch_size=settings.VIGILEYE_INGEST_BATCH_SIZE,
+                    linger=settings.VIGILEYE_INGEST_LINGER,
+                    history=settings.VIGILEYE_INGEST_TICKET_HISTORY,
+                )
+                atexit.register(_ingest_queue.stop, timeout=10)
+    return _ingest_queue
@@ -0,0 +1,88 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import RiskLexicon
+from .risk import compile_lexicon, default_matcher
+
+logger = logging.getLogger(__name__)
+
+# Version 0 is the built-in DEFAULT_LEXICON, used while no RiskLexicon is active
+BUILTIN_VERSION = 0
+
+ActiveLexicon = namedtuple('ActiveLexicon', ['version', 'matcher'])
+
+
+class LexiconStore:
+    """
+    The active risk lexicon of this worker, compiled once per version.
+
+    At most every ``poll_interval`` seconds the active version number is
+    read from the database (one indexed single-column query); only when it
+    differs is the lexicon loaded and compiled. The (version, matcher) pair
+    is swapped in as one object, so a request always scores with a
+    consistent pair and never waits for a compile it does not need.
+    """
+
+    # Compiled matchers kept for recently active versions
+    cache_size = 4
+
+    def __init__(self, poll_interval):
+        self.poll_interval = poll_interval
+        self._active = ActiveLexicon(BUILTIN_VERSION, default_matcher)
+        self._compiled = OrderedDict([(BUILTIN_VERSION, default_matcher)])
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def current(self):
+        """The (version, matcher) pair to score with"""
+        now = time.monotonic()
+        checked_at = self._checked_at
+        if checked_at is None or now - checked_at >= self.poll_interval:
+            # One thread refreshes; the others keep scoring with what they have
+            if self._lock.acquire(blocking=checked_at is None):
+                try:
+                    self._refresh()
+                finally:
+                    self._checked_at = time.monotonic()
+                    self._lock.release()
+        return self._active
+
+    def expire(self):
+        """Check the active version on the next call, e.g. after publishing one"""
+        self._checked_at = None
+
+    def _refresh(self):
+        version = RiskLexicon.objects.filter(active=True).values_list('version', flat=True).first()
+        if version is None:
+            version = BUILTIN_VERSION
+        if version == self._active.version:
+            return
+        matcher = default_matcher if version == BUILTIN_VERSION else self._compiled.get(version)
+        if matcher is None:
+            data = RiskLexicon.objects.filter(version=version).values_list('data', flat=True).first()
+            try:
+                matcher = compile_lexicon(data)
+            except ValueError:
+                logger.exception('Risk lexicon v%s is invalid; still scoring with v%s', version, self._active.version)
+                return
+        self._compiled[version] = matcher
+        self._compiled.move_to_end(version)
+        while len(self._compiled) > self.cache_size:
+            self._compiled.popitem(last=False)
+        self._active = ActiveLexicon(version, matcher)
+        logger.info('Risk lexicon v%s is now active', version)
+
+
+lexicons = LexiconStore(settings.VIGILEYE_LEXICON_POLL_INTERVAL)
+
+
+@receiver(post_save, sender=RiskLexicon)
+@receiver(post_delete, sender=RiskLexicon)
+def _expire_lexicon(sender, instance, **kwargs):
+    lexicons.expire()
@@ -0,0 +1,45 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from api.retention import TABLES, archive_table, cutoff_for, expired
+
+
+class Command(BaseCommand):
+    help = (
+        'Archive messages, alerts and locations past their retention age into '
+        'per-day gzip segments, keep hourly rollups and delete the raw rows. '
+        'Run it from cron, or keep it running with --every.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--table', action='append', choices=sorted(TABLES),
+                            help='Only process this table (repeatable); default all')
+        parser.add_argument('--chunk-size', type=int, help='Rows archived and deleted per transaction')
+        parser.add_argument('--dry-run', action='store_true', help='Only report how many rows are due')
+        parser.add_argument('--every', type=int, metavar='SECONDS',
+                            help='Repeat forever, sleeping this long between runs')
+
+    def handle(self, *args, **options):
+        while True:
+            self.run_once(options['table'] or list(TABLES), options['chunk_size'], options['dry_run'])
+            if not options['every']:
+                break
+            time.sleep(options['every'])
+            close_old_connections()
+
+    def run_once(self, tables, chunk_size, dry_run):
+        for table in tables:
+            cutoff = cutoff_for(table)
+            if cutoff is None:
+                self.stdout.write(f'{table}: retention disabled')
+                continue
+            if dry_run:
+                self.stdout.write(f'{table}: {expired(table, cutoff).count()} rows older than {cutoff:%Y-%m-%d %H:%M} due')
+                continue
+            stats = archive_table(table, cutoff, chunk_size)
+            self.stdout.write(self.style.SUCCESS(
+                f"{table}: archived {stats['rows']} rows in {stats['chunks']} chunks "
+                f"({stats['segments']} segment writes)"
+            ))
@@ -0,0 +1,109 @@
+import json
+import time
+from functools import partial
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.benchmark import CORPORA, generate_corpus, percentiles, reference_detector, write_report
+from api.lexicon import lexicons
+from api.risk import detect_risk
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure detect_risk throughput on generated short, long and adversarial '
+        'corpora with the active lexicon, optionally next to the per-keyword '
+        'reference scan and failing on a regression against an earlier report.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--corpus', choices=CORPORA, action='append',
+                            help='Corpus to run, repeatable (default: all)')
+        parser.add_argument('--messages', type=int, default=5000, help='Messages per corpus')
+        parser.add_argument('--rounds', type=int, default=3, help='Passes over each corpus; the fastest counts')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--reference', action='store_true',
+                            help='Also time the per-keyword reference scan and report the speedup over it')
+        parser.add_argument('--min-speedup', type=float,
+                            help='Fail when detect_risk is less than this many times as fast as the reference '
+                                 '(implies --reference)')
+        parser.add_argument('--report', help='Write the results to this JSON file')
+        parser.add_argument('--baseline', help='Earlier report to compare throughput against')
+        parser.add_argument('--max-regression', type=float, default=0.2,
+                            help='Fail when a corpus is this fraction slower than the baseline')
+
+    def handle(self, *args, **options):
+        matcher = lexicons.current().matcher
+        detect = partial(detect_risk, matcher=matcher)
+        reference = reference_detector(matcher.lexicon)
+        results = {}
+        for kind in options['corpus'] or CORPORA:
+            corpus = generate_corpus(kind, options['messages'], options['seed'])
+            results[kind] = self.measure(corpus, detect, options['rounds'])
+            result = results[kind]
+            self.stdout.write(
+                f"{kind:12} {result['messages_per_second']:>10.0f} msg/s {result['mb_per_second']:>7.1f} MB/s  "
+                f"p50 {result['us_per_message']['p50']:.1f}us  p99 {result['us_per_message']['p99']:.1f}us  "
+                f"max {result['us_per_message']['max']:.0f}us"
+            )
+            if options['reference'] or options['min_speedup'] is not None:
+                baseline = self.measure(corpus, reference, options['rounds'])
+                result['reference_messages_per_second'] = baseline['messages_per_second']
+                result['speedup'] = result['messages_per_second'] / baseline['messages_per_second']
+                self.stdout.write(
+                    f"{'':12} {baseline['messages_per_second']:>10.0f} msg/s per-keyword reference, "
+                    f"{result['speedup']:.2f}x faster"
+                )
+
+        report = {'benchmark': 'detect_risk', 'lexicon_version': lexicons.current().version,
+                  'messages': options['messages'], 'seed': options['seed'], 'corpora': results}
+        if options['report']:
+            write_report(options['report'], report)
+            self.stdout.write(f"Report written to {options['report']}")
+        if options['baseline']:
+            self.compare(results, options['baseline'], options['max_regression'])
+        if options['min_speedup'] is not None:
+            slow = [f"{kind} ({result['speedup']:.2f}x)" for kind, result in results.items()
+                    if result['speedup'] < options['min_speedup']]
+            if slow:
+                raise CommandError(f"Less than {options['min_speedup']}x the reference: {', '.join(slow)}")
+
+    def measure(self, corpus, detect, rounds):
+        """Best of ``rounds`` timed passes of ``detect``, with per-message latencies of that pass"""
+        clock = time.perf_counter_ns
+        best = None
+        for _ in range(max(1, rounds)):
+            timings = []
+            for text in corpus:
+                start = clock()
+                detect(text)
+                timings.append(clock() - start)
+            if best is None or sum(timings) < sum(best):
+                best = timings
+        seconds = sum(best) / 1e9
+        chars = sum(len(text) for text in corpus)
+        return {
+            'messages': len(corpus),
+            'chars': chars,
+            'seconds': seconds,
+            'messages_per_second': len(corpus) / seconds,
+            'mb_per_second': chars / seconds / 1e6,
+            'us_per_message': percentiles([timing / 1000 for timing in best]),
+        }
+
+    def compare(self, results, path, max_regression):
+        try:
+            with open(path) as f:
+                baseline = json.load(f)['corpora']
+        except (OSError, ValueError, KeyError) as e:
+            raise CommandError(f'Cannot read baseline {path}: {e}')
+        regressions = []
+        for kind, result in results.items():
+            if kind not in baseline:
+                continue
+            ratio = result['messages_per_second'] / baseline[kind]['messages_per_second']
+            self.stdout.write(f'{kind:12} {ratio:.2f}x baseline')
+            if ratio < 1 - max_regression:
+                regressions.append(f'{kind} ({ratio:.2f}x)')
+        if regressions:
+            raise CommandError(f"Slower than the baseline: {', '.join(regressions)}")
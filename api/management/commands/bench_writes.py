@@ -0,0 +1,90 @@
+import io
+import json
+import os
+import tempfile
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test import override_settings
+
+from api.benchmark import write_report
+from api.conversation import conversations
+from api.devices import devices
+from api.geofences import geofences
+from api.lexicon import lexicons
+from api.writer import writes
+
+# Configurations compared: SQLite defaults (rollback journal, full sync, each
+# request committing on its own), the tuned pragmas alone, and with the funnel
+CONFIGURATIONS = ['default', 'wal', 'wal+funnel']
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare concurrent ingest throughput on a scratch SQLite database with '
+        'stock settings, with the WAL pragmas, and with the write funnel, by '
+        'running load_test in-process against each.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=16, help='Simultaneous clients')
+        parser.add_argument('--requests', type=int, default=3000, help='Requests per configuration')
+        parser.add_argument('--devices', type=int, default=100)
+        parser.add_argument('--mix', default='analyze=3,location=2', help='load_test request mix')
+        parser.add_argument('--report', default='bench_writes.json', help='JSON report path')
+
+    def handle(self, *args, **options):
+        database = connections[DEFAULT_DB_ALIAS].settings_dict
+        tuned = dict(database['OPTIONS'])
+        results = {}
+        try:
+            for name in CONFIGURATIONS:
+                database['OPTIONS'] = tuned if name != 'default' else {
+                    key: value for key, value in tuned.items() if key not in ('init_command', 'transaction_mode')
+                }
+                with tempfile.TemporaryDirectory() as directory, \
+                        override_settings(VIGILEYE_WRITE_FUNNEL=name.endswith('funnel')):
+                    path = os.path.join(directory, 'report.json')
+                    call_command('load_test', concurrency=options['concurrency'], requests=options['requests'],
+                                 devices=options['devices'], mix=options['mix'], report=path,
+                                 stdout=self.stdout if options['verbosity'] > 1 else io.StringIO())
+                    with open(path) as f:
+                        report = json.load(f)
+                self.reset()
+                results[name] = {
+                    'requests_per_second': report['requests_per_second'],
+                    'errors': sum(operation['errors'] for operation in report['operations'].values()),
+                    'latency_ms': {op: operation['latency_ms'] for op, operation in report['operations'].items()},
+                }
+                self.stdout.write(
+                    f"{name:12} {report['requests_per_second']:8.0f} req/s  errors {results[name]['errors']}  "
+                    + '  '.join(f"{op} p99 {operation['latency_ms'].get('p99', 0):.1f}ms"
+                                for op, operation in report['operations'].items())
+                )
+        finally:
+            database['OPTIONS'] = tuned
+
+        baseline = results['default']['requests_per_second']
+        for name in CONFIGURATIONS[1:]:
+            results[name]['speedup'] = results[name]['requests_per_second'] / baseline if baseline else None
+        write_report(options['report'], {
+            'benchmark': 'bench_writes',
+            'concurrency': options['concurrency'],
+            'requests': options['requests'],
+            'mix': options['mix'],
+            'configurations': results,
+        })
+        self.stdout.write(self.style.SUCCESS(
+            ', '.join(f"{name} {results[name]['speedup']:.2f}x" for name in CONFIGURATIONS[1:])
+            + f" the default configuration; report written to {options['report']}"
+        ))
+
+    def reset(self):
+        """Forget state tied to the scratch database that was just dropped"""
+        writes.stop()
+        connections.close_all()
+        devices.clear()
+        conversations.clear()
+        geofences.clear()
+        lexicons.expire()
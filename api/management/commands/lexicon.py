@@ -0,0 +1,80 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Max
+
+from api.lexicon import BUILTIN_VERSION
+from api.models import RiskLexicon
+from api.risk import DEFAULT_LEXICON, compile_lexicon
+
+
+class Command(BaseCommand):
+    help = (
+        'Manage versions of the risk lexicon. Workers pick up a newly '
+        'activated version within VIGILEYE_LEXICON_POLL_INTERVAL seconds.'
+    )
+
+    def add_arguments(self, parser):
+        subcommands = parser.add_subparsers(dest='action', required=True)
+        subcommands.add_parser('list', help='List stored versions')
+        publish = subcommands.add_parser('publish', help='Store a lexicon JSON file as a new version')
+        publish.add_argument('path')
+        publish.add_argument('--activate', action='store_true', help='Make it the active version')
+        publish.add_argument('--note', default='')
+        activate = subcommands.add_parser('activate', help='Make a version active (0 = built-in lexicon)')
+        activate.add_argument('version', type=int)
+        export = subcommands.add_parser('export', help='Print a version as JSON (default: the built-in one)')
+        export.add_argument('version', type=int, nargs='?', default=BUILTIN_VERSION)
+
+    def handle(self, *args, **options):
+        getattr(self, 'handle_' + options['action'])(**options)
+
+    def handle_list(self, **options):
+        active = RiskLexicon.objects.filter(active=True).exists()
+        self.stdout.write(f"v{BUILTIN_VERSION}  built-in{'' if active else '  (active)'}")
+        for lexicon in RiskLexicon.objects.order_by('version'):
+            self.stdout.write(
+                f"v{lexicon.version}  {lexicon.created_at:%Y-%m-%d %H:%M}"
+                f"{'  (active)' if lexicon.active else ''}  {lexicon.note}"
+            )
+
+    def handle_publish(self, path, activate, note, **options):
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+            compile_lexicon(data)
+        except (OSError, ValueError) as e:
+            raise CommandError(f'Cannot publish {path}: {e}')
+        with transaction.atomic():
+            version = (RiskLexicon.objects.aggregate(latest=Max('version'))['latest'] or BUILTIN_VERSION) + 1
+            RiskLexicon.objects.create(version=version, data=data, note=note)
+            if activate:
+                self._activate(version)
+        self.stdout.write(self.style.SUCCESS(f"Published v{version}{' (active)' if activate else ''}"))
+
+    def handle_activate(self, version, **options):
+        with transaction.atomic():
+            self._activate(version)
+        self.stdout.write(self.style.SUCCESS(f'v{version} is now active'))
+
+    def handle_export(self, version, **options):
+        if version == BUILTIN_VERSION:
+            data = DEFAULT_LEXICON
+        else:
+            data = RiskLexicon.objects.filter(version=version).values_list('data', flat=True).first()
+            if data is None:
+                raise CommandError(f'No lexicon v{version}')
+        self.stdout.write(json.dumps(data, indent=2))
+
+    def _activate(self, version):
+        if version != BUILTIN_VERSION and not RiskLexicon.objects.filter(version=version).exists():
+            raise CommandError(f'No lexicon v{version}')
+        # Saved one by one so post_save fires here; other processes poll
+        for lexicon in RiskLexicon.objects.filter(active=True).exclude(version=version):
+            lexicon.active = False
+            lexicon.save(update_fields=['active'])
+        if version != BUILTIN_VERSION:
+            lexicon = RiskLexicon.objects.get(version=version)
+            lexicon.active = True
+            lexicon.save(update_fields=['active'])
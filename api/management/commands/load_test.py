@@ -0,0 +1,258 @@
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django.test import Client, override_settings
+
+from api.benchmark import generate_corpus, percentiles, write_report
+from api.models import Alert, Device, Location, Message
+
+# Request kinds and their default share of the traffic: a child device
+# sending messages, location fixes and heartbeats, and a parent on the dashboard
+DEFAULT_MIX = 'analyze=6,location=3,heartbeat=3,dashboard=1'
+DEFAULT_MIX_NAMES = [part.split('=')[0] for part in DEFAULT_MIX.split(',')]
+
+
+def parse_mix(value):
+    try:
+        mix = {name: int(weight) for name, weight in (part.split('=') for part in value.split(','))}
+    except ValueError:
+        raise CommandError(f'Malformed --mix {value!r}, expected e.g. {DEFAULT_MIX}')
+    unknown = set(mix) - set(DEFAULT_MIX_NAMES)
+    if unknown or not any(mix.values()):
+        raise CommandError(f"--mix takes positive weights for {', '.join(DEFAULT_MIX_NAMES)}")
+    return mix
+
+
+class InProcessTarget:
+    """Requests through the Django test client, counting queries per request"""
+
+    name = 'in-process'
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def request(self, method, path, body=None):
+        if not hasattr(self.local, 'client'):
+            self.local.client = Client(HTTP_HOST='localhost')
+        queries = []
+
+        def count(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        with connections[DEFAULT_DB_ALIAS].execute_wrapper(count):
+            if method == 'GET':
+                response = self.local.client.get(path)
+            else:
+                response = self.local.client.post(path, json.dumps(body), content_type='application/json')
+        return response.status_code, len(queries)
+
+    def finish_thread(self):
+        connections.close_all()
+
+
+class HttpTarget:
+    """Requests to a running server; queries per request are not visible from here"""
+
+    def __init__(self, url):
+        self.name = url
+        self.url = url.rstrip('/')
+
+    def request(self, method, path, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(self.url + path, data=data, method=method,
+                                         headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                response.read()
+                return response.status, None
+        except urllib.error.HTTPError as e:
+            return e.code, None
+        except (urllib.error.URLError, OSError):
+            return 0, None
+
+    def finish_thread(self):
+        pass
+
+
+class Command(BaseCommand):
+    help = (
+        'Generate child-device and dashboard traffic (analyze, location update, '
+        'heartbeat, dashboard) at a given concurrency and report latency '
+        'percentiles, queries per request and database growth as JSON. Runs '
+        'in-process against a scratch database unless --url names a server.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help='Base URL of a running server, e.g. http://127.0.0.1:8000')
+        parser.add_argument('--concurrency', type=int, default=8, help='Simultaneous clients')
+        parser.add_argument('--requests', type=int, default=2000, help='Total requests to send')
+        parser.add_argument('--duration', type=float, help='Stop after this many seconds instead')
+        parser.add_argument('--devices', type=int, default=50, help='Simulated child devices')
+        parser.add_argument('--mix', default=DEFAULT_MIX, help='Request weights, default %(default)s')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--report', default='load_test.json', help='JSON report path')
+
+    def handle(self, *args, **options):
+        mix = parse_mix(options['mix'])
+        if options['url']:
+            target = HttpTarget(options['url'])
+            self.run(target, mix, options)
+            return
+
+        # Never write the generated traffic into the real database
+        connection = connections[DEFAULT_DB_ALIAS]
+        if connection.vendor != 'sqlite':
+            raise CommandError('In-process runs need SQLite; use --url against a server with its own database')
+        scratch = tempfile.mkdtemp(prefix='vigileye-load-')
+        connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(scratch, 'load.sqlite3')
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            with override_settings(ALLOWED_HOSTS=['localhost']):
+                self.run(InProcessTarget(), mix, options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    def run(self, target, mix, options):
+        rng = random.Random(options['seed'])
+        devices = [f'LOAD-{options["seed"]}-{n:04d}' for n in range(options['devices'])]
+        texts = generate_corpus('short', 500, options['seed']) + generate_corpus('adversarial', 20, options['seed'])
+
+        # Every device sends a first message, which registers it
+        for kindred_id in devices:
+            target.request('POST', '/api/analyze/', {'kindredId': kindred_id, 'text': rng.choice(texts)})
+        size_before, rows_before = self.db_stats()
+
+        names = list(mix)
+        weights = [mix[name] for name in names]
+        latencies = defaultdict(list)
+        queries = defaultdict(list)
+        statuses = defaultdict(lambda: defaultdict(int))
+        lock = threading.Lock()
+        remaining = [options['requests']]
+        deadline = time.monotonic() + options['duration'] if options['duration'] else None
+
+        def take():
+            with lock:
+                if deadline is not None:
+                    return time.monotonic() < deadline
+                remaining[0] -= 1
+                return remaining[0] >= 0
+
+        def client(worker):
+            local_rng = random.Random(f"{options['seed']}:{worker}")
+            try:
+                while take():
+                    name = local_rng.choices(names, weights)[0]
+                    kindred_id = local_rng.choice(devices)
+                    if name == 'analyze':
+                        method, path, body = 'POST', '/api/analyze/', {
+                            'kindredId': kindred_id, 'text': local_rng.choice(texts)}
+                    elif name == 'location':
+                        method, path, body = 'POST', '/api/location/update/', {
+                            'kindredId': kindred_id,
+                            'latitude': 40.7 + local_rng.uniform(-0.05, 0.05),
+                            'longitude': -74.0 + local_rng.uniform(-0.05, 0.05),
+                            'accuracy': local_rng.uniform(5, 50),
+                        }
+                    elif name == 'heartbeat':
+                        method, path, body = 'POST', '/heartbeat/', {'kindredId': kindred_id}
+                    else:
+                        method, path, body = 'GET', '/dashboard/', None
+                    start = time.perf_counter()
+                    status, query_count = target.request(method, path, body)
+                    elapsed = (time.perf_counter() - start) * 1000
+                    with lock:
+                        latencies[name].append(elapsed)
+                        statuses[name][status] += 1
+                        if query_count is not None:
+                            queries[name].append(query_count)
+            finally:
+                target.finish_thread()
+
+        self.stdout.write(f"Sending {'%ss of' % options['duration'] if deadline else options['requests']} "
+                          f"requests to {target.name} with {options['concurrency']} clients")
+        started = time.perf_counter()
+        threads = [threading.Thread(target=client, args=(n,), daemon=True) for n in range(options['concurrency'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        size_after, rows_after = self.db_stats()
+
+        total = sum(len(samples) for samples in latencies.values())
+        operations = {}
+        for name in names:
+            errors = sum(count for status, count in statuses[name].items() if not 200 <= status < 300)
+            operations[name] = {
+                'requests': len(latencies[name]),
+                'errors': errors,
+                'status_codes': {str(status): count for status, count in sorted(statuses[name].items())},
+                'latency_ms': percentiles(latencies[name]),
+                'queries_per_request': percentiles(queries[name]) or None,
+            }
+            if latencies[name]:
+                summary = operations[name]['latency_ms']
+                self.stdout.write(
+                    f"{name:10} {len(latencies[name]):>7} req  p50 {summary['p50']:7.2f}ms  "
+                    f"p90 {summary['p90']:7.2f}ms  p99 {summary['p99']:7.2f}ms  errors {errors}"
+                    + (f"  queries {operations[name]['queries_per_request']['mean']:.1f}" if queries[name] else '')
+                )
+
+        database = None
+        if size_before is not None:
+            database = {
+                'size_before_bytes': size_before,
+                'size_after_bytes': size_after,
+                'growth_bytes': size_after - size_before,
+                'growth_bytes_per_request': (size_after - size_before) / total if total else None,
+                'rows_before': rows_before,
+                'rows_after': rows_after,
+            }
+            self.stdout.write(f"Database grew {(size_after - size_before) / 1e6:.2f} MB "
+                              f"({database['growth_bytes_per_request'] or 0:.0f} bytes per request)")
+        report = write_report(options['report'], {
+            'benchmark': 'load_test',
+            'target': target.name,
+            'concurrency': options['concurrency'],
+            'devices': options['devices'],
+            'mix': mix,
+            'seconds': elapsed,
+            'requests': total,
+            'requests_per_second': total / elapsed if elapsed else None,
+            'operations': operations,
+            'database': database,
+        })
+        self.stdout.write(self.style.SUCCESS(
+            f"{report['requests']} requests in {elapsed:.1f}s ({report['requests_per_second']:.0f}/s); "
+            f"report written to {options['report']}"
+        ))
+
+    def db_stats(self):
+        """Size of the SQLite file with its WAL and row counts, or (None, None) when not local"""
+        connection = connections[DEFAULT_DB_ALIAS]
+        if connection.vendor != 'sqlite':
+            return None, None
+        path = str(connection.settings_dict['NAME'])
+        if not os.path.exists(path):
+            return None, None
+        size = sum(os.path.getsize(p) for p in (path, path + '-wal') if os.path.exists(p))
+        try:
+            rows = {model._meta.db_table: model.objects.count() for model in (Device, Message, Alert, Location)}
+        except DatabaseError:
+            # A server's database this checkout has not migrated
+            rows = None
+        connections.close_all()
+        return size, rows
@@ -0,0 +1,70 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError
+from django.db.models import Max
+
+from api.models import Message
+from api.search import check_index, index_chunk, index_progress, merge_step, start_rebuild
+
+
+class Command(BaseCommand):
+    help = (
+        'Maintain the full-text index of messages: rebuild it in short chunks '
+        '(resuming an interrupted rebuild), merge its segments, or check it '
+        'against the messages table.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', help='Empty the index and refill it from the start')
+        parser.add_argument('--chunk-size', type=int, default=5000, help='Messages indexed per transaction')
+        parser.add_argument('--pause', type=float, default=0.05, help='Seconds between chunks, lets other writers in')
+        parser.add_argument('--merge', action='store_true', help='Merge index segments until none are left')
+        parser.add_argument('--merge-pages', type=int, default=500, help='Pages written per merge step')
+        parser.add_argument('--check', action='store_true', help='Run the FTS5 integrity check')
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1 or options['merge_pages'] < 1:
+            raise CommandError('--chunk-size and --merge-pages must be positive')
+        if options['rebuild']:
+            start_rebuild()
+            self.stdout.write('Index emptied, rebuilding')
+
+        progress = index_progress()
+        if progress is not None:
+            self.fill(progress, options['chunk_size'], options['pause'])
+        elif not options['rebuild']:
+            self.stdout.write('Index covers every message')
+
+        if options['merge']:
+            started = time.monotonic()
+            steps = 0
+            while merge_step(options['merge_pages']):
+                steps += 1
+                time.sleep(options['pause'])
+            self.stdout.write(f'Merged index segments in {steps} steps, {time.monotonic() - started:.1f}s')
+
+        if options['check']:
+            try:
+                check_index()
+            except DatabaseError as e:
+                raise CommandError(f'Index does not match the messages: {e}; run with --rebuild')
+            self.stdout.write(self.style.SUCCESS('Index is consistent with the messages'))
+
+    def fill(self, progress, chunk_size, pause):
+        end_id = Message.objects.aggregate(last=Max('id'))['last'] or 0
+        self.stdout.write(f'Indexing messages {progress + 1}..{end_id}')
+        started = time.monotonic()
+        indexed = 0
+        while True:
+            count = index_chunk(chunk_size)
+            indexed += count
+            if count < chunk_size:
+                break
+            elapsed = time.monotonic() - started
+            self.stderr.write(f'\r{indexed} indexed  {indexed / elapsed if elapsed else 0:,.0f} msg/s', ending='')
+            time.sleep(pause)
+        self.stderr.write('')
+        self.stdout.write(self.style.SUCCESS(
+            f'Indexed {indexed} messages in {time.monotonic() - started:.1f}s; the index is complete'
+        ))
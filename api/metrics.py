@@ -0,0 +1,175 @@
+import contextvars
+import threading
+import time
+from collections import Counter
+
+# Histogram buckets: exact below 2**SUB_BITS, then SUB_BITS - 1 bits of
+# mantissa per power of two, so every value lands within 1/16 of its bucket
+SUB_BITS = 5
+_SUB = 1 << SUB_BITS
+_HALF = _SUB >> 1
+
+
+def _bucket(value):
+    if value < _SUB:
+        return value
+    shift = value.bit_length() - SUB_BITS
+    return shift * _HALF + (value >> shift)
+
+
+def _bucket_upper(index):
+    """Largest value that lands in bucket ``index``"""
+    if index < _SUB:
+        return index
+    shift = index // _HALF - 1
+    return ((index - shift * _HALF + 1) << shift) - 1
+
+
+class Histogram:
+    """
+    HDR-style histogram: log-linear buckets, so recording is O(1), memory
+    grows with the log of the range, and quantiles are accurate to ~6%.
+    Values are multiplied by ``scale`` and stored as integers, e.g.
+    seconds in microseconds with scale=1e6.
+    """
+
+    def __init__(self, scale=1):
+        self.scale = scale
+        self.counts = Counter()
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0
+
+    def record(self, value):
+        scaled = max(0, int(value * self.scale))
+        self.counts[_bucket(scaled)] += 1
+        self.count += 1
+        self.sum += value
+        if scaled > self.max:
+            self.max = scaled
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile, in recorded units"""
+        if not self.count:
+            return 0.0
+        rank = max(1, q * self.count)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(_bucket_upper(index), self.max) / self.scale
+        return self.max / self.scale
+
+
+class RequestStats:
+    """What one request spent, filled in while it runs"""
+
+    __slots__ = ('queries', 'query_time', 'risk_time')
+
+    def __init__(self):
+        self.queries = 0
+        self.query_time = 0.0
+        self.risk_time = 0.0
+
+    def execute(self, execute, sql, params, many, context):
+        """Database execute wrapper counting and timing the request's queries"""
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.query_time += time.perf_counter() - started
+
+
+_current = contextvars.ContextVar('vigileye_request_stats', default=None)
+
+
+def start_request():
+    stats = RequestStats()
+    return stats, _current.set(stats)
+
+
+def end_request(token):
+    _current.reset(token)
+
+
+def current_stats():
+    """Stats of the request being served in this context, or None"""
+    return _current.get()
+
+
+def record_risk_time(seconds):
+    """Charge risk scoring time to the request being served, if any"""
+    stats = _current.get()
+    if stats is not None:
+        stats.risk_time += seconds
+
+
+# name -> (help text, scale of its histograms)
+HISTOGRAMS = {
+    'request_duration_seconds': ('Wall time of requests', 1e6),
+    'request_queries': ('Database queries per request', 1),
+    'request_query_seconds': ('Time per request spent in database queries', 1e6),
+    'request_risk_seconds': ('Time per request spent scoring messages', 1e6),
+}
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class RequestMetrics:
+    """Per-route request histograms and status counts of this process"""
+
+    def __init__(self):
+        self._histograms = {}
+        self._statuses = Counter()
+        self._lock = threading.Lock()
+
+    def observe(self, route, status, duration, stats):
+        values = {
+            'request_duration_seconds': duration,
+            'request_queries': stats.queries,
+            'request_query_seconds': stats.query_time,
+            'request_risk_seconds': stats.risk_time,
+        }
+        with self._lock:
+            self._statuses[(route, f'{status // 100}xx')] += 1
+            for name, value in values.items():
+                histogram = self._histograms.get((name, route))
+                if histogram is None:
+                    histogram = self._histograms[(name, route)] = Histogram(HISTOGRAMS[name][1])
+                histogram.record(value)
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+            self._statuses.clear()
+
+    def render(self, gauges=()):
+        """
+        Prometheus text exposition of the histograms (as summaries), the
+        request counts and ``gauges``, an iterable of (name, help, value).
+        """
+        lines = []
+        with self._lock:
+            for name, (help_text, _) in HISTOGRAMS.items():
+                lines.append(f'# HELP vigileye_{name} {help_text}')
+                lines.append(f'# TYPE vigileye_{name} summary')
+                for (metric, route), histogram in sorted(self._histograms.items()):
+                    if metric != name:
+                        continue
+                    for q in QUANTILES:
+                        lines.append(f'vigileye_{name}{{route="{route}",quantile="{q}"}} {histogram.quantile(q):.6g}')
+                    lines.append(f'vigileye_{name}_sum{{route="{route}"}} {histogram.sum:.6g}')
+                    lines.append(f'vigileye_{name}_count{{route="{route}"}} {histogram.count}')
+            lines.append('# HELP vigileye_requests_total Requests served, by route and status class')
+            lines.append('# TYPE vigileye_requests_total counter')
+            for (route, status), count in sorted(self._statuses.items()):
+                lines.append(f'vigileye_requests_total{{route="{route}",status="{status}"}} {count}')
+        for name, help_text, value in gauges:
+            lines.append(f'# HELP vigileye_{name} {help_text}')
+            lines.append(f'# TYPE vigileye_{name} gauge')
+            lines.append(f'vigileye_{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = RequestMetrics()
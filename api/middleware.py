@@ -0,0 +1,85 @@
+import cProfile
+import logging
+import random
+import threading
+import time
+from contextlib import ExitStack
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+from .metrics import end_request, metrics, start_request
+
+logger = logging.getLogger(__name__)
+
+# One profiled request at a time: a second active profiler fails on Python 3.12+
+_profile_lock = threading.Lock()
+
+
+def _route(request):
+    match = request.resolver_match
+    return match.url_name if match is not None and match.url_name else 'unmatched'
+
+
+class MetricsMiddleware:
+    """
+    Records wall time, database queries and their time, and risk scoring
+    time of every request into per-route histograms (served at /metrics).
+
+    With VIGILEYE_PROFILE_SAMPLE_RATE set, that fraction of requests runs
+    under cProfile and those slower than VIGILEYE_PROFILE_SLOW_MS are dumped
+    to VIGILEYE_PROFILE_DIR, for opening with pstats or snakeviz.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.VIGILEYE_METRICS_ENABLED:
+            return self.get_response(request)
+
+        stats, token = start_request()
+        profile = self._start_profile()
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(stats.execute))
+                response = self.get_response(request)
+        finally:
+            duration = time.perf_counter() - started
+            end_request(token)
+            if profile is not None:
+                self._finish_profile(profile, request, duration)
+
+        metrics.observe(_route(request), response.status_code, duration, stats)
+        return response
+
+    def _start_profile(self):
+        rate = settings.VIGILEYE_PROFILE_SAMPLE_RATE
+        if not rate or random.random() >= rate or not _profile_lock.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is already running in this process
+            _profile_lock.release()
+            return None
+        return profile
+
+    def _finish_profile(self, profile, request, duration):
+        try:
+            profile.disable()
+            if duration * 1000 < settings.VIGILEYE_PROFILE_SLOW_MS:
+                return
+            route = _route(request)
+            directory = Path(settings.VIGILEYE_PROFILE_DIR)
+            directory.mkdir(parents=True, exist_ok=True)
+            path = directory / f'{route}-{timezone.now():%Y%m%dT%H%M%S%f}-{duration * 1000:.0f}ms.prof'
+            profile.dump_stats(path)
+            logger.info('Slow request profiled: route=%s duration_ms=%.0f path=%s', route, duration * 1000, path)
+        finally:
+            _profile_lock.release()
@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_parentuser'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='alert',
+            index=models.Index(fields=['timestamp', 'id'], name='alert_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='alert',
+            index=models.Index(fields=['score', 'timestamp'], name='alert_score_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='alert',
+            index=models.Index(condition=models.Q(('score__gte', 7)), fields=['timestamp'], name='alert_high_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='alert',
+            index=models.Index(condition=models.Q(('acknowledged', False), ('score__gte', 7)), fields=['timestamp'], name='alert_high_open_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='location',
+            index=models.Index(fields=['device', 'timestamp', 'id'], name='location_device_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='location',
+            index=models.Index(fields=['timestamp', 'id'], name='location_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['device', 'timestamp', 'id'], name='message_device_timestamp_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:06
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_alert_message_location_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='location',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:30
+
+from django.db import migrations, models
+
+from api.geo import geohash_encode
+
+
+def fill_cells(apps, schema_editor):
+    Location = apps.get_model('api', 'Location')
+    batch = []
+    for location in Location.objects.filter(cell='').only('id', 'latitude', 'longitude').iterator(chunk_size=2000):
+        location.cell = geohash_encode(float(location.latitude), float(location.longitude))
+        batch.append(location)
+        if len(batch) == 2000:
+            Location.objects.bulk_update(batch, ['cell'])
+            batch = []
+    Location.objects.bulk_update(batch, ['cell'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_alter_location_timestamp'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='location',
+            name='cell',
+            field=models.CharField(blank=True, default='', max_length=12),
+        ),
+        migrations.RunPython(fill_cells, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='location',
+            index=models.Index(fields=['cell', 'timestamp'], name='location_cell_timestamp_idx'),
+        ),
+    ]
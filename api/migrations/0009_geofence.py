@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-17 22:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_location_cell'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Geofence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('kind', models.CharField(choices=[('circle', 'Circle'), ('polygon', 'Polygon')], max_length=10)),
+                ('center_latitude', models.FloatField(blank=True, null=True)),
+                ('center_longitude', models.FloatField(blank=True, null=True)),
+                ('radius_m', models.FloatField(blank=True, null=True)),
+                ('vertices', models.JSONField(blank=True, default=list)),
+                ('min_latitude', models.FloatField(default=0)),
+                ('min_longitude', models.FloatField(default=0)),
+                ('max_latitude', models.FloatField(default=0)),
+                ('max_longitude', models.FloatField(default=0)),
+                ('active', models.BooleanField(default=True)),
+                ('inside', models.BooleanField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='geofences', to='api.device')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['device', 'active'], name='geofence_device_active_idx')],
+            },
+        ),
+    ]
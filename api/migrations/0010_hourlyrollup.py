@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-17 22:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_geofence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HourlyRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField()),
+                ('message_count', models.IntegerField(default=0)),
+                ('max_risk_score', models.IntegerField(default=0)),
+                ('alert_count', models.IntegerField(default=0)),
+                ('location_count', models.IntegerField(default=0)),
+                ('centroid_latitude', models.FloatField(blank=True, null=True)),
+                ('centroid_longitude', models.FloatField(blank=True, null=True)),
+                ('device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='api.device')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('device', 'hour'), name='hourly_rollup_device_hour')],
+            },
+        ),
+    ]
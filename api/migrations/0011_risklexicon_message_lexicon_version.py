@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-17 23:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_hourlyrollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RiskLexicon',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveIntegerField(unique=True)),
+                ('data', models.JSONField()),
+                ('active', models.BooleanField(default=False)),
+                ('note', models.CharField(blank=True, max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='lexicon_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['lexicon_version', 'id'], name='message_lexicon_version_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='risklexicon',
+            constraint=models.UniqueConstraint(condition=models.Q(('active', True)), fields=('active',), name='risk_lexicon_single_active'),
+        ),
+    ]
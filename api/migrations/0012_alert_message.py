@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-17 23:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_risklexicon_message_lexicon_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='alert',
+            name='message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='alerts', to='api.message'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-17 23:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_alert_message'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='content_hash',
+            field=models.CharField(blank=True, default='', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='duplicate_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='alert',
+            name='occurrences',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='alert',
+            name='last_seen',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['device', 'content_hash', 'timestamp'], name='message_device_hash_idx'),
+        ),
+    ]
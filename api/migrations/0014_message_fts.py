@@ -0,0 +1,77 @@
+# Generated by Django 5.2.18 on 2026-10-18 00:20
+
+from django.db import migrations
+
+# External-content FTS5 index over api_message: the text is not stored twice,
+# the index holds only the tokens. device_id and risk_level are indexed as
+# tokens too, so filtering on them intersects posting lists inside the index
+# instead of discarding matches after the join. Triggers keep it in step
+# with the table for rows up to api_message_fts_state.indexed_through, which
+# is the maximum rowid except while the search_index command rebuilds it.
+CREATE_SQL = [
+    """
+    CREATE VIRTUAL TABLE api_message_fts USING fts5(
+        message_text,
+        device_id,
+        risk_level,
+        content='api_message',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2',
+        prefix='2 3'
+    )
+    """,
+    """
+    CREATE TABLE api_message_fts_state (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        indexed_through INTEGER NOT NULL
+    )
+    """,
+    "INSERT INTO api_message_fts_state (id, indexed_through) VALUES (1, 9223372036854775807)",
+    """
+    CREATE TRIGGER api_message_fts_insert AFTER INSERT ON api_message
+    WHEN new.id <= (SELECT indexed_through FROM api_message_fts_state)
+    BEGIN
+        INSERT INTO api_message_fts (rowid, message_text, device_id, risk_level)
+        VALUES (new.id, new.message_text, new.device_id, new.risk_level);
+    END
+    """,
+    """
+    CREATE TRIGGER api_message_fts_delete AFTER DELETE ON api_message
+    WHEN old.id <= (SELECT indexed_through FROM api_message_fts_state)
+    BEGIN
+        INSERT INTO api_message_fts (api_message_fts, rowid, message_text, device_id, risk_level)
+        VALUES ('delete', old.id, old.message_text, old.device_id, old.risk_level);
+    END
+    """,
+    """
+    CREATE TRIGGER api_message_fts_update AFTER UPDATE OF message_text, device_id, risk_level ON api_message
+    WHEN old.id <= (SELECT indexed_through FROM api_message_fts_state)
+    BEGIN
+        INSERT INTO api_message_fts (api_message_fts, rowid, message_text, device_id, risk_level)
+        VALUES ('delete', old.id, old.message_text, old.device_id, old.risk_level);
+        INSERT INTO api_message_fts (rowid, message_text, device_id, risk_level)
+        VALUES (new.id, new.message_text, new.device_id, new.risk_level);
+    END
+    """,
+    # Index the messages already stored
+    "INSERT INTO api_message_fts (api_message_fts) VALUES ('rebuild')",
+]
+
+DROP_SQL = [
+    'DROP TRIGGER IF EXISTS api_message_fts_update',
+    'DROP TRIGGER IF EXISTS api_message_fts_delete',
+    'DROP TRIGGER IF EXISTS api_message_fts_insert',
+    'DROP TABLE IF EXISTS api_message_fts_state',
+    'DROP TABLE IF EXISTS api_message_fts',
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_message_content_hash_alert_occurrences'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_SQL, DROP_SQL),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-18 00:47
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_message_fts'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='alert',
+            index=models.Index(fields=['device', 'timestamp', 'id'], name='alert_device_timestamp_idx'),
+        ),
+        migrations.CreateModel(
+            name='ExportJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('table', models.CharField(choices=[('alerts', 'Alerts'), ('messages', 'Messages'), ('locations', 'Locations')], max_length=10)),
+                ('format', models.CharField(choices=[('csv', 'CSV'), ('ndjson', 'NDJSON'), ('parquet', 'Parquet')], max_length=10)),
+                ('since', models.DateTimeField(blank=True, null=True)),
+                ('until', models.DateTimeField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('rows', models.PositiveIntegerField(default=0)),
+                ('file_name', models.CharField(blank=True, max_length=255)),
+                ('size_bytes', models.PositiveBigIntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('device', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='exports', to='api.device')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'id'], name='exportjob_status_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 01:05
+
+from django.db import migrations, models
+
+
+def fill_sources(apps, schema_editor):
+    Alert = apps.get_model('api', 'Alert')
+    # Earlier alerts only tell their source apart by the excerpt
+    Alert.objects.filter(message__isnull=True, excerpt__startswith='Conversation risk (').update(source='conversation')
+    Alert.objects.filter(message__isnull=True).filter(
+        models.Q(excerpt__startswith="Entered geofence '") | models.Q(excerpt__startswith="Left geofence '")
+    ).update(source='geofence')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_exportjob_alert_device_timestamp_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='alert',
+            name='source',
+            field=models.CharField(choices=[('message', 'Message'), ('conversation', 'Conversation'), ('geofence', 'Geofence')], default='message', max_length=12),
+        ),
+        migrations.RunPython(fill_sources, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='alert',
+            index=models.Index(fields=['source', 'score'], name='alert_source_score_idx'),
+        ),
+    ]
@@ -0,0 +1,183 @@
+import re
+import unicodedata
+from itertools import compress
+
+# Digits and symbols commonly typed in place of letters; only replaced in
+# words that also contain a letter, so "5:00" or "13" stay as they are
+LEET = {
+    '0': 'o', '1': 'i', '3': 'e', '4': 'a', '5': 's', '7': 't', '8': 'b',
+    '@': 'a', '$': 's', '!': 'i', '+': 't',
+}
+
+# Letters from other scripts that render like Latin ones and survive NFKC
+HOMOGLYPHS = {
+    # Cyrillic
+    'а': 'a', 'в': 'b', 'е': 'e', 'ё': 'e', 'к': 'k', 'м': 'm', 'н': 'h', 'о': 'o', 'р': 'p',
+    'с': 'c', 'т': 't', 'у': 'y', 'х': 'x', 'і': 'i', 'ї': 'i', 'ј': 'j', 'ѕ': 's', 'ԁ': 'd',
+    # Greek
+    'α': 'a', 'β': 'b', 'ε': 'e', 'η': 'n', 'ι': 'i', 'κ': 'k', 'ν': 'v', 'ο': 'o', 'ρ': 'p',
+    'τ': 't', 'υ': 'u', 'χ': 'x', 'ω': 'w',
+    # Small capitals
+    'ᴀ': 'a', 'ʙ': 'b', 'ᴄ': 'c', 'ᴅ': 'd', 'ᴇ': 'e', 'ɢ': 'g', 'ʜ': 'h', 'ɪ': 'i', 'ᴊ': 'j',
+    'ᴋ': 'k', 'ʟ': 'l', 'ᴍ': 'm', 'ɴ': 'n', 'ᴏ': 'o', 'ᴘ': 'p', 'ʀ': 'r', 'ꜱ': 's', 'ᴛ': 't',
+    'ᴜ': 'u', 'ᴠ': 'v', 'ᴡ': 'w', 'ʏ': 'y', 'ᴢ': 'z',
+}
+
+# Punctuation used to break words up ("s.e.n.d", "m-e-e-t", "don't"); dropped
+SEPARATORS = ".,-_*~'`\"^|/\\:;"
+
+# Invisible characters inserted to split words; dropped
+INVISIBLE = '­​‌‍⁠﻿'
+
+_ASCII_MAP = {chr(c): chr(c).lower() for c in range(128)}
+for _char in SEPARATORS:
+    _ASCII_MAP[_char] = ''
+for _char in '\t\n\r\x0b\x0c':
+    _ASCII_MAP[_char] = ' '
+
+
+class _FoldTable(dict):
+    """
+    str.translate() table for the whole of Unicode.
+
+    ASCII is filled in up front; any other character is folded the first
+    time it is seen (NFKD with accents dropped, NFKC, lowercase and
+    look-alike replacement) and remembered, so each costs one dict lookup
+    from then on.
+    """
+
+    def __missing__(self, codepoint):
+        char = chr(codepoint)
+        if char in INVISIBLE:
+            folded = ''
+        elif char.isspace():
+            folded = ' '
+        else:
+            decomposed = ''.join(c for c in unicodedata.normalize('NFKD', char) if not unicodedata.combining(c))
+            folded = ''
+            for c in unicodedata.normalize('NFKC', decomposed).lower():
+                c = HOMOGLYPHS.get(c, c)
+                folded += _ASCII_MAP.get(c, c)
+        self[codepoint] = folded
+        return folded
+
+
+class _WidthTable(dict):
+    """str.translate() table giving the length of each character's fold, as a character"""
+
+    def __missing__(self, codepoint):
+        width = chr(len(FOLD_TABLE[codepoint]))
+        self[codepoint] = width
+        return width
+
+
+FOLD_TABLE = _FoldTable({ord(char): folded for char, folded in _ASCII_MAP.items()})
+WIDTH_TABLE = _WidthTable()
+
+# The same for ASCII input, as bytes tables: bytes.translate() runs in C
+_BYTES_TABLE = bytes(ord(_ASCII_MAP[chr(c)] or '\0') for c in range(128)) + bytes(range(128, 256))
+_BYTES_DELETE = SEPARATORS.encode()
+_BYTES_WIDTHS = bytes(len(_ASCII_MAP[chr(c)]) for c in range(128)) + bytes(128)
+
+_LEET_TABLE = str.maketrans(LEET)
+# A word without a letter but with a leetspeak digit or symbol in it: "13", "500"
+_LEET_NUMBER = re.compile(r'(?<!\S)[^\sa-z]*[%s][^\sa-z]*(?!\S)' % re.escape(''.join(LEET)))
+
+_SPACES = re.compile(r' {2,}')
+_REPEATS = re.compile(r'(.)\1\1+')
+# Single characters split by single spaces, "s e n d": three or more are joined
+_SPACED = re.compile(r'(?<!\S)\S(?: \S){2,}(?!\S)')
+# Found in every text _SPACED matches, and much faster to search for
+_SPACED_HINT = re.compile(r' \S \S')
+
+
+def _translate(text):
+    if text.isascii():
+        return text.encode().translate(_BYTES_TABLE, _BYTES_DELETE).decode()
+    return text.translate(FOLD_TABLE)
+
+
+def _unleet(text):
+    if not any(char in text for char in LEET):
+        return text
+    # Translate everything, then put the words without a letter back; both
+    # are rare next to ordinary words, and the translation is one for one
+    translated = text.translate(_LEET_TABLE)
+    pieces = []
+    position = 0
+    for match in _LEET_NUMBER.finditer(text):
+        pieces.append(translated[position:match.start()])
+        pieces.append(match.group())
+        position = match.end()
+    if not position:
+        return translated
+    pieces.append(translated[position:])
+    return ''.join(pieces)
+
+
+def _tidy(text):
+    if '  ' in text:
+        text = _SPACES.sub(' ', text)
+    text = _REPEATS.sub(r'\1\1', text)
+    if _SPACED_HINT.search(text):
+        text = _SPACED.sub(lambda m: m.group().replace(' ', ''), text)
+    return text
+
+
+def fold(text):
+    """
+    Normalize text for keyword matching.
+
+    Lowercases and folds Unicode look-alikes and accents to ASCII letters,
+    drops separators and invisible characters, squeezes whitespace, joins
+    s-p-a-c-e-d letters, shortens runs of three or more repeated characters
+    to two ("meeeet" -> "meet") and translates leetspeak in words that mix
+    letters with digits or symbols ("m33t" -> "meet").
+    """
+    return _unleet(_tidy(_translate(text)))
+
+
+def _squeeze(regex, keep, text, offsets):
+    """One _tidy() step over text and its offsets: each match shrinks to the indices keep() picks"""
+    pieces = []
+    kept = []
+    position = 0
+    for match in regex.finditer(text):
+        pieces.append(text[position:match.start()])
+        kept += offsets[position:match.start()]
+        for index in keep(match):
+            pieces.append(text[index])
+            kept.append(offsets[index])
+        position = match.end()
+    if not position:
+        return text, offsets
+    pieces.append(text[position:])
+    kept += offsets[position:]
+    return ''.join(pieces), kept
+
+
+def fold_with_offsets(text):
+    """
+    fold(text) together with, for every character of the result, the index
+    of the character of ``text`` it came from; for mapping matches back to
+    the original message.
+    """
+    folded = _translate(text)
+    if text.isascii():
+        widths = text.encode().translate(_BYTES_WIDTHS)
+    else:
+        widths = text.translate(WIDTH_TABLE).encode('latin-1')
+    if len(folded) == len(text) - widths.count(0):
+        # Every character folds to at most one: keep the indices of the non-empty ones
+        offsets = list(compress(range(len(text)), widths))
+    else:
+        offsets = [index for index, width in enumerate(widths) for _ in range(width)]
+
+    # The same steps as _tidy(), applied to the offsets too
+    if '  ' in folded:
+        folded, offsets = _squeeze(_SPACES, lambda m: [m.start()], folded, offsets)
+    folded, offsets = _squeeze(_REPEATS, lambda m: [m.start(), m.start() + 1], folded, offsets)
+    if _SPACED_HINT.search(folded):
+        folded, offsets = _squeeze(_SPACED, lambda m: range(m.start(), m.end(), 2), folded, offsets)
+    # Leetspeak replaces characters one for one
+    return _unleet(folded), offsets
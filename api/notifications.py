@@ -0,0 +1,225 @@
+import atexit
+import heapq
+import itertools
+import json
+import logging
+import queue
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+Notification = namedtuple('Notification', ['parent_id', 'message', 'risk_level', 'created'])
+
+
+class BaseNotificationBackend:
+    """
+    Delivers digests of notifications to a parent.
+
+    Subclasses implement send_digest(); raising from it makes the dispatcher
+    retry the whole digest with backoff.
+    """
+
+    def send_digest(self, parent_id, notifications):
+        raise NotImplementedError
+
+    def format_digest(self, notifications):
+        if len(notifications) == 1:
+            notification = notifications[0]
+            return f"[{notification.risk_level.upper()} RISK] {notification.message}"
+        lines = [f"{len(notifications)} new alerts:"]
+        lines += [f"- [{n.risk_level.upper()} RISK] {n.message}" for n in notifications]
+        return '\n'.join(lines)
+
+
+class ConsoleBackend(BaseNotificationBackend):
+    """Prints digests to stdout; the development stand-in for email/SMS/push"""
+
+    def send_digest(self, parent_id, notifications):
+        print(f"Notification for {parent_id}: {self.format_digest(notifications)}")
+
+
+class NullBackend(BaseNotificationBackend):
+    """Discards digests; what the test run delivers to"""
+
+    def send_digest(self, parent_id, notifications):
+        pass
+
+
+class FileBackend(BaseNotificationBackend):
+    """Appends one JSON line per digest to VIGILEYE_NOTIFICATION_FILE"""
+
+    def __init__(self):
+        self.path = settings.VIGILEYE_NOTIFICATION_FILE
+
+    def send_digest(self, parent_id, notifications):
+        record = {
+            'parent_id': parent_id,
+            'sent': timezone.now().isoformat(),
+            'text': self.format_digest(notifications),
+            'notifications': [
+                {'message': n.message, 'risk_level': n.risk_level, 'created': n.created.isoformat()}
+                for n in notifications
+            ],
+        }
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+class NotificationDispatcher:
+    """
+    Background delivery of notifications, batched per parent.
+
+    The first notification for a parent opens a window of ``window`` seconds;
+    everything queued for that parent until it closes goes out as one digest.
+    Failed digests are retried with exponential backoff up to ``max_attempts``.
+    Callers only ever enqueue, so request threads never wait on delivery.
+    """
+
+    def __init__(self, backend, window, max_batch, max_attempts, retry_delay, queue_size):
+        self.backend = backend
+        self.window = window
+        self.max_batch = max_batch
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._queue = queue.Queue(queue_size)
+        self._pending = {}
+        self._schedule = []
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        self.metrics = dict.fromkeys([
+            'enqueued', 'dropped', 'delivered', 'digests_sent',
+            'failed_attempts', 'retries', 'abandoned',
+        ], 0)
+
+    def enqueue(self, notification):
+        """Queue a notification; returns False if the queue is full"""
+        self._ensure_worker()
+        try:
+            self._queue.put_nowait(notification)
+        except queue.Full:
+            self._count('dropped')
+            return False
+        self._count('enqueued')
+        return True
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.metrics)
+        stats['queued'] = self._queue.qsize()
+        stats['parents_waiting'] = len(self._pending)
+        return stats
+
+    def stop(self, timeout=10):
+        """Flush every open window, then stop the worker; the next enqueue starts a new one"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stopping.set()
+            try:
+                # Wake the worker rather than wait out its poll
+                self._queue.put_nowait(None)
+            except queue.Full:
+                pass
+            thread.join(timeout)
+            self._stopping.clear()
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.metrics[name] += amount
+
+    def _ensure_worker(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='vigileye-notify', daemon=True)
+                self._thread.start()
+                atexit.unregister(self.stop)
+                atexit.register(self.stop)
+
+    def _run(self):
+        while True:
+            stopping = self._stopping.is_set()
+            timeout = 0 if stopping else 0.5
+            if self._schedule:
+                timeout = min(timeout, max(0, self._schedule[0][0] - time.monotonic()))
+            try:
+                notification = self._queue.get(timeout=timeout) if timeout else self._queue.get_nowait()
+            except queue.Empty:
+                notification = None
+            if notification is not None:
+                self._accept(notification)
+            self._deliver_due(flush_all=stopping)
+            if stopping and self._queue.empty() and not self._schedule:
+                break
+
+    def _accept(self, notification):
+        batch = self._pending.get(notification.parent_id)
+        if batch is None:
+            batch = self._pending[notification.parent_id] = []
+            self._push(time.monotonic() + self.window, notification.parent_id, batch, 1)
+        batch.append(notification)
+
+    def _push(self, due, parent_id, batch, attempt):
+        heapq.heappush(self._schedule, (due, next(self._sequence), parent_id, batch, attempt))
+
+    def _deliver_due(self, flush_all=False):
+        now = time.monotonic()
+        while self._schedule and (flush_all or self._schedule[0][0] <= now):
+            _, _, parent_id, batch, attempt = heapq.heappop(self._schedule)
+            if attempt == 1 and self._pending.get(parent_id) is batch:
+                # The window closes; later notifications open a new one
+                del self._pending[parent_id]
+            for start in range(0, len(batch), self.max_batch):
+                self._send(parent_id, batch[start:start + self.max_batch], attempt, flush_all)
+
+    def _send(self, parent_id, batch, attempt, final):
+        try:
+            self.backend.send_digest(parent_id, batch)
+        except Exception:
+            logger.exception('Notification digest for %s failed (attempt %d)', parent_id, attempt)
+            self._count('failed_attempts')
+            if attempt < self.max_attempts and not final:
+                self._count('retries')
+                delay = self.retry_delay * 2 ** (attempt - 1)
+                self._push(time.monotonic() + delay, parent_id, batch, attempt + 1)
+            else:
+                self._count('abandoned', len(batch))
+            return
+        self._count('digests_sent')
+        self._count('delivered', len(batch))
+
+
+dispatcher = NotificationDispatcher(
+    backend=import_string(settings.VIGILEYE_NOTIFICATION_BACKEND)(),
+    window=settings.VIGILEYE_NOTIFICATION_WINDOW,
+    max_batch=settings.VIGILEYE_NOTIFICATION_MAX_BATCH,
+    max_attempts=settings.VIGILEYE_NOTIFICATION_MAX_ATTEMPTS,
+    retry_delay=settings.VIGILEYE_NOTIFICATION_RETRY_DELAY,
+    queue_size=settings.VIGILEYE_NOTIFICATION_QUEUE_SIZE,
+)
+
+
+@receiver(setting_changed)
+def _use_backend(setting, value, **kwargs):
+    # Lets override_settings swap the backend; digests already queued are
+    # flushed to the backend they were queued for first
+    if setting == 'VIGILEYE_NOTIFICATION_BACKEND':
+        dispatcher.stop()
+        dispatcher.backend = import_string(value)()
+
+
+# Enhanced notification function
+def send_notification(message, risk_level='medium', parent_id='default_parent'):
+    """Queue a notification for a parent; delivery happens in the background"""
+    return dispatcher.enqueue(Notification(parent_id, message, risk_level, timezone.now()))
@@ -0,0 +1,55 @@
+import base64
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q
+
+
+def encode_cursor(timestamp, pk):
+    """Opaque cursor pointing just past the row (timestamp, pk)"""
+    raw = f'{timestamp.isoformat()}|{pk}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor; raises ValueError on malformed input"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        timestamp, pk = raw.rsplit('|', 1)
+        return datetime.fromisoformat(timestamp), int(pk)
+    except (TypeError, ValueError, UnicodeDecodeError) as e:
+        raise ValueError('Invalid cursor') from e
+
+
+def parse_limit(value):
+    """Page size from a query parameter, clamped to the configured maximum"""
+    if not value:
+        return settings.VIGILEYE_API_PAGE_SIZE
+    try:
+        limit = int(value)
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        raise ValueError('limit must be a positive integer')
+    return min(limit, settings.VIGILEYE_API_MAX_PAGE_SIZE)
+
+
+def keyset_page(queryset, fields, limit, after=None):
+    """
+    Return (rows, next_cursor) for the newest-first page of ``queryset``.
+
+    Rows are ordered on (timestamp, id) descending and returned as dicts via
+    ``values(*fields)``; ``fields`` must include 'id' and 'timestamp'. Seeking
+    past ``after`` uses the ordering columns directly, so every page costs the
+    same no matter how deep into the table it is.
+    """
+    queryset = queryset.order_by('-timestamp', '-id')
+    if after:
+        timestamp, pk = decode_cursor(after)
+        queryset = queryset.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=pk))
+    rows = list(queryset.values(*fields)[:limit + 1])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]['timestamp'], rows[-1]['id'])
+    return rows, next_cursor
@@ -0,0 +1,129 @@
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Case, DateTimeField, Value, When
+
+from .devices import devices
+from .models import Device
+from .writer import writes
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceTable:
+    """
+    In-memory record of the latest heartbeat per kindred_id.
+
+    Heartbeats only touch this table; a background flusher periodically
+    writes the newest timestamp of every device that pinged since the last
+    flush with a single UPDATE of ``last_heartbeat``. Liveness reads are
+    answered from memory and fall back to the database for devices that have
+    not pinged since the process started, or whose entry was evicted: only
+    the ``maxsize`` most recently seen devices are remembered.
+    """
+
+    # Devices per UPDATE statement, to stay well inside SQLite's variable limit
+    flush_chunk = 500
+
+    def __init__(self, interval, maxsize):
+        self.interval = interval
+        self.maxsize = maxsize
+        self._seen = OrderedDict()
+        self._dirty = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def beat(self, kindred_id, when):
+        """Record a heartbeat; returns False if the device does not exist"""
+        if devices.get(kindred_id) is None:
+            return False
+
+        with self._lock:
+            self._seen[kindred_id] = when
+            self._seen.move_to_end(kindred_id)
+            while len(self._seen) > self.maxsize:
+                # Its heartbeat stays in _dirty until flushed
+                self._seen.popitem(last=False)
+            self._dirty[kindred_id] = when
+        if self.interval <= 0:
+            writes.run(self.flush)
+        else:
+            self._ensure_flusher()
+        return True
+
+    def last_heartbeat(self, kindred_id):
+        """Latest heartbeat time for a device, or None if it never pinged"""
+        with self._lock:
+            when = self._seen.get(kindred_id) or self._dirty.get(kindred_id)
+        if when is not None:
+            return when
+        device = devices.get(kindred_id)
+        return device.last_heartbeat if device else None
+
+    def forget(self, kindred_id):
+        """Drop a device, e.g. after it has been deleted"""
+        with self._lock:
+            self._seen.pop(kindred_id, None)
+            self._dirty.pop(kindred_id, None)
+
+    def flush(self):
+        """Write pending heartbeats to the database; returns the device count"""
+        with self._lock:
+            pending, self._dirty = self._dirty, {}
+        items = list(pending.items())
+        try:
+            for start in range(0, len(items), self.flush_chunk):
+                chunk = items[start:start + self.flush_chunk]
+                Device.objects.filter(kindred_id__in=[kindred_id for kindred_id, _ in chunk]).update(
+                    last_heartbeat=Case(
+                        *[When(kindred_id=kindred_id, then=Value(when)) for kindred_id, when in chunk],
+                        output_field=DateTimeField(),
+                    )
+                )
+        except Exception:
+            # Put the heartbeats back unless a newer one arrived meanwhile
+            with self._lock:
+                for kindred_id, when in items:
+                    self._dirty.setdefault(kindred_id, when)
+            raise
+        return len(items)
+
+    def _ensure_flusher(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='vigileye-presence', daemon=True)
+                self._thread.start()
+                atexit.unregister(self.stop)
+                atexit.register(self.stop)
+
+    def stop(self):
+        """Flush and stop the flusher; the next beat() starts a new one"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._wakeup.set()
+            thread.join(self.interval + 5)
+            with self._lock:
+                self._wakeup.clear()
+
+    def _run(self):
+        while True:
+            stopping = self._wakeup.wait(self.interval)
+            close_old_connections()
+            try:
+                writes.run(self.flush)
+            except Exception:
+                logger.exception('Heartbeat flush failed')
+            if stopping:
+                break
+
+
+# As many devices as the device cache holds
+presence = PresenceTable(settings.VIGILEYE_HEARTBEAT_FLUSH_INTERVAL, settings.VIGILEYE_DEVICE_CACHE_SIZE)
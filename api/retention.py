@@ -0,0 +1,209 @@
+import gzip
+import json
+import logging
+import os
+import time
+from datetime import timezone as dt_timezone
+from pathlib import Path
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Avg, Count, Max
+from django.db.models.functions import TruncHour
+from django.utils import timezone
+
+from .models import Alert, HourlyRollup, Location, Message
+
+logger = logging.getLogger(__name__)
+
+# Archived table name -> (model, setting holding its retention in days)
+TABLES = {
+    'message': (Message, 'VIGILEYE_RETENTION_MESSAGE_DAYS'),
+    'alert': (Alert, 'VIGILEYE_RETENTION_ALERT_DAYS'),
+    'location': (Location, 'VIGILEYE_RETENTION_LOCATION_DAYS'),
+}
+
+
+def cutoff_for(table, now=None):
+    """Rows of ``table`` older than this are archived; None keeps them forever"""
+    days = getattr(settings, TABLES[table][1])
+    if days is None:
+        return None
+    return (now or timezone.now()) - timezone.timedelta(days=days)
+
+
+def expired(table, cutoff):
+    """Rows of ``table`` due for archiving"""
+    queryset = TABLES[table][0].objects.filter(timestamp__lt=cutoff)
+    if table == 'alert' and settings.VIGILEYE_RETENTION_KEEP_UNACKNOWLEDGED:
+        queryset = queryset.filter(acknowledged=True)
+    return queryset
+
+
+def segment_path(table, day):
+    """Archive file holding one table's rows for one UTC day"""
+    return Path(settings.VIGILEYE_ARCHIVE_DIR) / table / f'{day:%Y-%m-%d}.ndjson.gz'
+
+
+def _utc_hour(timestamp):
+    return timestamp.astimezone(dt_timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+
+def _write_segments(table, rows):
+    """Append rows to their per-day segments, each append a new gzip member"""
+    by_day = {}
+    for row in rows:
+        by_day.setdefault(row['timestamp'].astimezone(dt_timezone.utc).date(), []).append(row)
+    for day, day_rows in by_day.items():
+        path = segment_path(table, day)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'ab') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='ab') as segment:
+                for row in day_rows:
+                    segment.write(json.dumps(row, cls=DjangoJSONEncoder).encode() + b'\n')
+            raw.flush()
+            os.fsync(raw.fileno())
+    return len(by_day)
+
+
+def _merge_rollups(table, rows):
+    """Fold archived rows into the per-device hourly rollups"""
+    totals = {}
+    for row in rows:
+        key = (row['device_id'], _utc_hour(row['timestamp']))
+        total = totals.setdefault(key, {'count': 0, 'max_score': 0, 'latitude': 0.0, 'longitude': 0.0})
+        total['count'] += 1
+        if table == 'message':
+            total['max_score'] = max(total['max_score'], row['risk_score'])
+        elif table == 'location':
+            total['latitude'] += float(row['latitude'])
+            total['longitude'] += float(row['longitude'])
+
+    # One lookup per hour, for exactly the devices seen in that hour; a chunk
+    # of rows seldom spans more than a few hours
+    devices_by_hour = {}
+    for device_id, hour in totals:
+        devices_by_hour.setdefault(hour, set()).add(device_id)
+    existing = {}
+    for hour, device_ids in devices_by_hour.items():
+        for rollup in HourlyRollup.objects.filter(hour=hour, device_id__in=device_ids):
+            existing[(rollup.device_id, rollup.hour)] = rollup
+    created = []
+    for key, total in totals.items():
+        rollup = existing.get(key)
+        if rollup is None:
+            rollup = HourlyRollup(device_id=key[0], hour=key[1])
+            created.append(rollup)
+        if table == 'message':
+            rollup.message_count += total['count']
+            rollup.max_risk_score = max(rollup.max_risk_score, total['max_score'])
+        elif table == 'alert':
+            rollup.alert_count += total['count']
+        else:
+            # Running mean over every fix folded in so far
+            count = rollup.location_count + total['count']
+            rollup.centroid_latitude = ((rollup.centroid_latitude or 0) * rollup.location_count + total['latitude']) / count
+            rollup.centroid_longitude = ((rollup.centroid_longitude or 0) * rollup.location_count + total['longitude']) / count
+            rollup.location_count = count
+    HourlyRollup.objects.bulk_create(created)
+    HourlyRollup.objects.bulk_update(
+        list(existing.values()),
+        ['message_count', 'max_risk_score', 'alert_count', 'location_count', 'centroid_latitude', 'centroid_longitude'],
+    )
+
+
+def archive_table(table, cutoff, chunk_size=None, pause=None):
+    """
+    Archive, roll up and delete every row of ``table`` older than ``cutoff``.
+
+    Rows are walked in primary key order, ``chunk_size`` at a time. Each
+    chunk is appended to its per-day segments and synced to disk first;
+    then its rollups are merged and the rows deleted in one short
+    transaction, with a ``pause`` in between so writers are never locked
+    out for long. A crash between the two steps can only duplicate rows in
+    the archive, never lose them or count them twice in the rollups.
+    Returns counts of rows archived, chunks and segment writes.
+    """
+    model = TABLES[table][0]
+    chunk_size = chunk_size or settings.VIGILEYE_RETENTION_CHUNK_SIZE
+    pause = settings.VIGILEYE_RETENTION_PAUSE if pause is None else pause
+    fields = [field.attname for field in model._meta.concrete_fields] + ['device__kindred_id']
+    stats = {'rows': 0, 'chunks': 0, 'segments': 0}
+    last_id = 0
+    while True:
+        rows = list(expired(table, cutoff).filter(id__gt=last_id).order_by('id').values(*fields)[:chunk_size])
+        if not rows:
+            break
+        last_id = rows[-1]['id']
+        stats['segments'] += _write_segments(table, rows)
+        with transaction.atomic():
+            _merge_rollups(table, rows)
+            model.objects.filter(id__in=[row['id'] for row in rows]).delete()
+        stats['rows'] += len(rows)
+        stats['chunks'] += 1
+        if pause:
+            time.sleep(pause)
+    if stats['rows']:
+        logger.info('Archived %d %s rows older than %s', stats['rows'], table, cutoff.isoformat())
+    return stats
+
+
+def hourly_trend(device_id, since):
+    """
+    Hourly totals for a device since ``since``, oldest first.
+
+    Archived hours come from HourlyRollup and recent ones are aggregated
+    from the raw tables; archived rows are gone from the latter, so the
+    two simply add up.
+    """
+    hours = {}
+
+    def bucket(hour):
+        return hours.setdefault(_utc_hour(hour), {
+            'message_count': 0, 'max_risk_score': 0, 'alert_count': 0,
+            'location_count': 0, 'latitude_sum': 0.0, 'longitude_sum': 0.0,
+        })
+
+    for rollup in HourlyRollup.objects.filter(device_id=device_id, hour__gte=since):
+        entry = bucket(rollup.hour)
+        entry['message_count'] += rollup.message_count
+        entry['max_risk_score'] = max(entry['max_risk_score'], rollup.max_risk_score)
+        entry['alert_count'] += rollup.alert_count
+        entry['location_count'] += rollup.location_count
+        if rollup.location_count:
+            entry['latitude_sum'] += rollup.centroid_latitude * rollup.location_count
+            entry['longitude_sum'] += rollup.centroid_longitude * rollup.location_count
+
+    live = Message.objects.filter(device_id=device_id, timestamp__gte=since).annotate(hour=TruncHour('timestamp'))
+    for row in live.values('hour').annotate(count=Count('id'), max_score=Max('risk_score')).order_by():
+        entry = bucket(row['hour'])
+        entry['message_count'] += row['count']
+        entry['max_risk_score'] = max(entry['max_risk_score'], row['max_score'])
+
+    live = Alert.objects.filter(device_id=device_id, timestamp__gte=since).annotate(hour=TruncHour('timestamp'))
+    for row in live.values('hour').annotate(count=Count('id')).order_by():
+        bucket(row['hour'])['alert_count'] += row['count']
+
+    live = Location.objects.filter(device_id=device_id, timestamp__gte=since).annotate(hour=TruncHour('timestamp'))
+    for row in live.values('hour').annotate(count=Count('id'), lat=Avg('latitude'), lon=Avg('longitude')).order_by():
+        entry = bucket(row['hour'])
+        entry['location_count'] += row['count']
+        entry['latitude_sum'] += float(row['lat']) * row['count']
+        entry['longitude_sum'] += float(row['lon']) * row['count']
+
+    trend = []
+    for hour in sorted(hours):
+        entry = hours[hour]
+        count = entry.pop('location_count')
+        latitude_sum = entry.pop('latitude_sum')
+        longitude_sum = entry.pop('longitude_sum')
+        trend.append(dict(
+            entry,
+            hour=hour.isoformat(),
+            location_count=count,
+            # Rounded to the precision Location stores
+            centroid_latitude=round(latitude_sum / count, 7) if count else None,
+            centroid_longitude=round(longitude_sum / count, 7) if count else None,
+        ))
+    return trend
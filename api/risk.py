@@ -0,0 +1,310 @@
+import re
+
+from .normalize import fold, fold_with_offsets
+
+# Default risk lexicon. Keyword categories score once per listed keyword that
+# appears anywhere in the lowercased message or its fold() (leetspeak, look-alike
+# letters and separators undone); patterns score once per pattern that matches
+# the lowercased message at least once.
+DEFAULT_LEXICON = {
+    'categories': [
+        {
+            # High-risk keywords (score: 5 points each)
+            'name': 'high',
+            'weight': 5,
+            'keywords': [
+                'dont tell', 'meet me', 'come alone', 'keep secret', 'dont tell anyone',
+                'meet up', 'come over', 'send pic', 'send photo', 'send picture',
+                'nude', 'naked', 'sexy', 'hot body', 'send nudes', 'private chat',
+                'my place', 'your place', 'alone together', 'no parents', 'dont tell mom',
+                'dont tell dad', 'meet secretly', 'hidden', 'secret meeting'
+            ],
+        },
+        {
+            # Profanity and inappropriate language (score: 4 points each)
+            'name': 'profanity',
+            'weight': 4,
+            'label': 'profanity',
+            'keywords': [
+                'fuck', 'shit', 'damn', 'hell', 'bitch', 'ass', 'asshole', 'bastard',
+                'piss', 'crap', 'bullshit', 'fucking', 'fucked', 'shitty', 'damned',
+                'bloody', 'freaking', 'screw', 'screwed', 'dammit', 'crap', 'wtf',
+                'omfg', 'stfu', 'goddamn', 'motherfucker', 'son of a bitch'
+            ],
+        },
+        {
+            # Medium-risk keywords (score: 3 points each)
+            'name': 'medium',
+            'weight': 3,
+            'keywords': [
+                'how old are you', 'what grade', 'where do you live', 'what school',
+                'meet', 'alone', 'secret', 'private', 'personal info', 'address',
+                'phone number', 'social media', 'snapchat', 'instagram', 'tiktok',
+                'follow me', 'add me', 'friend request', 'dm me', 'message me'
+            ],
+        },
+        {
+            # Low-risk keywords (score: 1 point each)
+            'name': 'low',
+            'weight': 1,
+            'keywords': [
+                'cute', 'beautiful', 'handsome', 'cool', 'awesome', 'amazing',
+                'love you', 'like you', 'friend', 'buddy', 'pal', 'sweet',
+                'darling', 'honey', 'babe', 'baby', 'cutie'
+            ],
+        },
+    ],
+    # Pattern-based detection
+    'patterns': [
+        # The two digit patterns are \b\d{2,3}\b and \b\d{3}-\d{3}-\d{4}\b written to
+        # start on a digit, which lets the regex engine skip ahead on that character
+        {'pattern': r'\d(?<!\w\d)\d{1,2}\b', 'weight': 2, 'label': 'age_request'},  # Age requests
+        {'pattern': r'\d(?<!\w\d)\d{2}-\d{3}-\d{4}\b', 'weight': 3, 'label': 'phone_request'},  # Phone numbers
+        {'pattern': r'@\w+', 'weight': 2, 'label': 'social_media'},  # Social media handles
+        {'pattern': r'http[s]?://\S+', 'weight': 4, 'label': 'url_share'},  # URLs
+        # The profanity patterns are f+u+c+k+ and so on with the first repeat
+        # dropped: they match the same messages, start on a two-letter literal
+        # and cannot backtrack through a long run of the first letter
+        {'pattern': r'fu+c+k+', 'weight': 4, 'label': 'profanity'},  # Variations of fuck
+        {'pattern': r'sh+i+t+', 'weight': 4, 'label': 'profanity'},  # Variations of shit
+        {'pattern': r'da+m+n+', 'weight': 4, 'label': 'profanity'},  # Variations of damn
+    ],
+}
+
+
+def risk_level_for_score(score):
+    """Map a risk score onto the safe/low/medium/high scale"""
+    if score >= 7:
+        return 'high'
+    elif score >= 4:
+        return 'medium'
+    elif score >= 1:
+        return 'low'
+    return 'safe'
+
+
+def _build_trie(keys):
+    trie = {}
+    for key in keys:
+        node = trie
+        for char in key:
+            node = node.setdefault(char, {})
+        node[''] = {}
+    return trie
+
+
+def _trie_regex(node):
+    """Render a character trie as a regex that matches its longest key"""
+    branches = [
+        re.escape(char) + _trie_regex(child)
+        for char, child in sorted(node.items()) if char
+    ]
+    if not branches:
+        return ''
+    body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+    if '' in node:
+        # Greedy optional: prefer the longer keyword, fall back to this one
+        return '(?:' + body + ')?'
+    return body
+
+
+class _KeywordTrie:
+    """
+    Keys compiled into one trie-shaped regex, found in a single finditer()
+    pass.
+
+    Each match is the longest key starting at its position, and finditer()
+    resumes at its end, so the keys it hides are recovered from tables built
+    here: the keys occurring inside it (its prefixes included), and the
+    offsets inside it where a longer key could start and run past its end.
+    Those are only matched again when the character after the match
+    continues such a key.
+    """
+
+    def __init__(self, keys):
+        # ``keys`` maps each key to the keywords it stands for
+        self.regex = re.compile(_trie_regex(_build_trie(keys)) if keys else '(?!)')
+        self.prefixes = {key[:end] for key in keys for end in range(1, len(key) + 1)}
+        self.inside = {}
+        self.crossing = {}
+        self.keywords = {}
+        for key in keys:
+            self.inside[key] = [
+                (offset, other)
+                for other in keys
+                for offset in range(len(key) - len(other) + 1)
+                if key.startswith(other, offset)
+            ]
+            self.crossing[key] = [
+                offset for offset in range(1, len(key))
+                if any(len(other) > len(key) - offset and other.startswith(key[offset:]) for other in keys)
+            ]
+            self.keywords[key] = {keyword for _, other in self.inside[key] for keyword in keys[other]}
+
+    def find(self, text, keywords):
+        """Add the keywords found in ``text`` to the set ``keywords``"""
+        match_at = self.regex.match
+        prefixes = self.prefixes
+        for match in self.regex.finditer(text):
+            key = match.group()
+            keywords.update(self.keywords[key])
+            start, end = match.span()
+            for offset in self.crossing[key]:
+                if text[start + offset:end + 1] in prefixes:
+                    longer = match_at(text, start + offset)
+                    if longer:
+                        keywords.update(self.keywords[longer.group()])
+
+    def spans(self, text):
+        """(start, end, key) for every occurrence of every key in ``text``"""
+        spans = set()
+        match_at = self.regex.match
+        for match in self.regex.finditer(text):
+            found = [match]
+            start, end = match.span()
+            for offset in self.crossing[match.group()]:
+                if text[start + offset:end + 1] in self.prefixes:
+                    longer = match_at(text, start + offset)
+                    if longer:
+                        found.append(longer)
+            for hit in found:
+                spans.update(
+                    (hit.start() + offset, hit.start() + offset + len(key), key)
+                    for offset, key in self.inside[hit.group()]
+                )
+        return spans
+
+
+class RiskMatcher:
+    """
+    Compiled form of a risk lexicon.
+
+    All keywords are folded into one trie-shaped regex that a single pass
+    over the lowercased text matches, and a second trie of the folded
+    keywords is matched over the folded text, when folding changed
+    anything, to catch obfuscated spellings. Each pattern is compiled on
+    its own; a search stops at its first match.
+    """
+
+    def __init__(self, lexicon):
+        self.lexicon = lexicon
+        self._points = {}
+        self._labels = {}
+        self._rank = {}
+        # What one occurrence of each flagged label is worth, for scoring across messages
+        self.label_weights = {}
+        for category in lexicon['categories']:
+            for keyword in category['keywords']:
+                # Duplicate entries score again, as separate list items always have
+                self._points[keyword] = self._points.get(keyword, 0) + category['weight']
+                labels = self._labels.setdefault(keyword, [])
+                label = category.get('label') or keyword
+                self.label_weights[label] = max(self.label_weights.get(label, 0), category['weight'])
+                if label not in labels:
+                    labels.append(label)
+                self._rank.setdefault(keyword, len(self._rank))
+
+        self._keywords = _KeywordTrie({keyword: [keyword] for keyword in self._points})
+        # Folded keyword -> the keywords matched when it is found in folded text
+        folded = {}
+        for keyword in self._points:
+            if fold(keyword):
+                folded.setdefault(fold(keyword), []).append(keyword)
+        self._folded = _KeywordTrie(folded)
+        self._folded_keys = folded
+
+        self._patterns = []
+        for p in lexicon['patterns']:
+            regex = re.compile(p['pattern'])
+            if regex.groups:
+                raise ValueError('Risk patterns must not use capturing groups: %r' % p['pattern'])
+            self._patterns.append((regex, p['weight'], p['label']))
+            self.label_weights[p['label']] = max(self.label_weights.get(p['label'], 0), p['weight'])
+
+    def scan(self, text, folded=None):
+        """Return (risk_score, flagged_keywords) for lowercased text and, optionally, its fold()"""
+        keywords = set()
+        self._keywords.find(text, keywords)
+        if folded is not None and folded != text:
+            self._folded.find(folded, keywords)
+
+        risk_score = 0
+        flagged_keywords = {}
+        for keyword in sorted(keywords, key=self._rank.__getitem__):
+            risk_score += self._points[keyword]
+            for label in self._labels[keyword]:
+                flagged_keywords[label] = None
+        for regex, weight, label in self._patterns:
+            if regex.search(text):
+                risk_score += weight
+                flagged_keywords[label] = None
+
+        return risk_score, list(flagged_keywords)
+
+    def spans(self, message):
+        """
+        Where the lexicon matches in ``message``, as (start, end, label)
+        triples in offsets of the original text, for highlighting.
+        """
+        spans = set()
+        text = message.lower()
+        # Lowercasing a few characters changes the length; those offsets would be off
+        if len(text) == len(message):
+            for start, end, keyword in self._keywords.spans(text):
+                spans.update((start, end, label) for label in self._labels[keyword])
+            for regex, _, label in self._patterns:
+                spans.update((match.start(), match.end(), label) for match in regex.finditer(text))
+        folded, offsets = fold_with_offsets(message)
+        for start, end, key in self._folded.spans(folded):
+            start, end = offsets[start], offsets[end - 1] + 1
+            for keyword in self._folded_keys[key]:
+                spans.update((start, end, label) for label in self._labels[keyword])
+        return sorted(spans)
+
+
+default_matcher = RiskMatcher(DEFAULT_LEXICON)
+
+
+def compile_lexicon(data):
+    """Validate a lexicon and build its matcher; raises ValueError if malformed"""
+    try:
+        for category in data['categories']:
+            if not isinstance(category['weight'], int) or not all(
+                isinstance(keyword, str) and keyword and keyword == keyword.lower()
+                for keyword in category['keywords']
+            ):
+                raise ValueError('Category %r needs an integer weight and lowercase keywords' % category.get('name'))
+        for p in data['patterns']:
+            if not isinstance(p['weight'], int) or not p['label']:
+                raise ValueError('Pattern %r needs an integer weight and a label' % p.get('pattern'))
+        return RiskMatcher(data)
+    except (KeyError, TypeError, re.error) as e:
+        raise ValueError('Malformed lexicon: %s' % e) from e
+
+
+def detect_risk(message, matcher=None):
+    """
+    Enhanced risk detection function
+    Returns: (risk_score, flagged_keywords, risk_level)
+    Scores with the built-in lexicon unless a compiled ``matcher`` is given.
+    """
+    if not message or not message.strip():
+        return 0, [], 'safe'
+
+    risk_score, flagged_keywords = (matcher or default_matcher).scan(message.lower(), fold(message))
+    return risk_score, flagged_keywords, risk_level_for_score(risk_score)
+
+
+# Matcher of a rescore_messages worker process, see init_scoring_worker
+_worker_matcher = None
+
+
+def init_scoring_worker(lexicon):
+    """Process pool initializer: compile ``lexicon`` once per worker"""
+    global _worker_matcher
+    _worker_matcher = RiskMatcher(lexicon)
+
+
+def score_batch(rows):
+    """Score (id, text) pairs in a worker; returns (id, score, flagged, level) tuples"""
+    return [(pk,) + detect_risk(text, _worker_matcher) for pk, text in rows]
@@ -0,0 +1,78 @@
+import contextvars
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+# Cookie holding the time until which a parent's reads stay on the primary
+STICKY_COOKIE = 'vigileye_primary_until'
+
+# Models kept in process-wide caches (device resolver, geofence index, active
+# lexicon): a stale replica row would outlive the request there, so they are
+# always read from the primary
+PRIMARY_ONLY = {'api.device', 'api.geofence', 'api.risklexicon'}
+
+# Replica alias while a read_only view runs, else None
+_replica = contextvars.ContextVar('vigileye_read_replica', default=None)
+
+
+class ReadReplicaRouter:
+    """
+    Sends the reads of read_only views to VIGILEYE_READ_REPLICA_ALIAS and
+    everything else to the primary. The replica is a copy of the primary
+    and is never migrated itself.
+    """
+
+    def db_for_read(self, model, **hints):
+        alias = _replica.get()
+        if alias is not None and model._meta.label_lower not in PRIMARY_ONLY:
+            return alias
+        return None
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Both aliases hold the same rows
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+def pinned_to_primary(request):
+    """Whether the client wrote recently enough that the replica may not have it yet"""
+    try:
+        return float(request.COOKIES.get(STICKY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def read_only(view):
+    """Serve the view's reads from the replica, unless the client just wrote"""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        alias = settings.VIGILEYE_READ_REPLICA_ALIAS
+        if alias is None or pinned_to_primary(request):
+            return view(request, *args, **kwargs)
+        token = _replica.set(alias)
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            _replica.reset(token)
+    return wrapper
+
+
+def sticky_writes(view):
+    """After the view writes, keep the client's reads on the primary for a while"""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        response = view(request, *args, **kwargs)
+        seconds = settings.VIGILEYE_REPLICA_STICKY_SECONDS
+        if (settings.VIGILEYE_READ_REPLICA_ALIAS is not None and seconds
+                and request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400):
+            response.set_cookie(STICKY_COOKIE, f'{time.time() + seconds:.3f}', max_age=seconds,
+                                httponly=True, samesite='Lax')
+        return response
+    return wrapper
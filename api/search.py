@@ -0,0 +1,172 @@
+import html
+import re
+
+from django.conf import settings
+from django.db import connections, router, transaction
+
+from .models import Message
+
+# Created by migration 0014_message_fts
+FTS_TABLE = 'api_message_fts'
+STATE_TABLE = 'api_message_fts_state'
+FULLY_INDEXED = 2 ** 63 - 1
+
+# Snippet match markers: private-use characters that cannot occur in the
+# escaped text, swapped for <mark> tags after escaping
+_OPEN, _CLOSE = '\ue000', '\ue001'
+SNIPPET_TOKENS = 12
+
+RISK_LEVELS = ('high', 'medium', 'low', 'safe')
+
+MESSAGE_FIELDS = ['id', 'device__kindred_id', 'risk_score', 'risk_level', 'flagged_keywords', 'timestamp']
+
+_TERM = re.compile(r'\w+\*?')
+
+
+def build_match(query):
+    """
+    FTS5 MATCH expression for a user's search: every word must occur, a
+    trailing * matches by prefix. Operators and quotes in the input are
+    treated as plain text. Raises ValueError when no word is left.
+    """
+    terms = []
+    for term in _TERM.findall(query):
+        prefix = term.endswith('*')
+        word = term.rstrip('*')
+        if prefix and len(word) < 2:
+            # One-letter prefixes are not indexed and would scan every token
+            prefix = False
+        terms.append(f'"{word}"*' if prefix else f'"{word}"')
+    if not terms:
+        raise ValueError('q must contain at least one word')
+    return ' '.join(terms)
+
+
+def highlight(snippet):
+    """HTML-escape a snippet and mark its matches with <mark>"""
+    return html.escape(snippet).replace(_OPEN, '<mark>').replace(_CLOSE, '</mark>')
+
+
+def search_messages(query, device_id=None, since=None, until=None, risk_levels=None, limit=20, offset=0):
+    """
+    Messages matching ``query`` as dicts with a highlighted snippet, most
+    relevant (bm25) first. Returns (results, has_more).
+
+    Only the newest VIGILEYE_SEARCH_CANDIDATES matches are ranked, so a
+    common word costs the same as a rare one. The device and risk filters
+    are part of the match; the time window is checked on the joined rows.
+    """
+    alias = router.db_for_read(Message)
+    connection = connections[alias]
+    match = f'message_text : ({build_match(query)})'
+    if device_id is not None:
+        match += f' AND device_id : "{int(device_id)}"'
+    if risk_levels:
+        match += ' AND risk_level : (%s)' % ' OR '.join(f'"{level}"' for level in risk_levels)
+    where = [f'{FTS_TABLE} MATCH %s']
+    params = [match]
+    if since is not None:
+        where.append('m.timestamp >= %s')
+        params.append(connection.ops.adapt_datetimefield_value(since))
+    if until is not None:
+        where.append('m.timestamp <= %s')
+        params.append(connection.ops.adapt_datetimefield_value(until))
+    join = f' JOIN {Message._meta.db_table} m ON m.id = {FTS_TABLE}.rowid' if len(where) > 1 else ''
+    # Newest candidates first: FTS5 walks its doclists in rowid order and
+    # stops at the limit; scoring happens for those rows only
+    sql = (
+        f'SELECT id, score FROM ('
+        f'SELECT {FTS_TABLE}.rowid AS id, bm25({FTS_TABLE}, 1.0, 0.0, 0.0) AS score FROM {FTS_TABLE}{join} '
+        f"WHERE {' AND '.join(where)} ORDER BY {FTS_TABLE}.rowid DESC LIMIT %s"
+        f') ORDER BY score, id DESC LIMIT %s OFFSET %s'
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [*params, settings.VIGILEYE_SEARCH_CANDIDATES, limit + 1, offset])
+        hits = cursor.fetchall()
+        has_more = len(hits) > limit
+        hits = hits[:limit]
+        if not hits:
+            return [], False
+        ids = [pk for pk, _ in hits]
+        cursor.execute(
+            f"SELECT rowid, snippet({FTS_TABLE}, 0, %s, %s, '…', {SNIPPET_TOKENS}) FROM {FTS_TABLE} "
+            f"WHERE {FTS_TABLE} MATCH %s AND rowid IN ({', '.join(['%s'] * len(ids))})",
+            [_OPEN, _CLOSE, match, *ids],
+        )
+        snippets = dict(cursor.fetchall())
+
+    rows = {
+        row['id']: row
+        for row in Message.objects.using(alias).filter(id__in=ids).values(*MESSAGE_FIELDS)
+    }
+    results = []
+    for pk, score in hits:
+        row = rows.get(pk)
+        if row is None:
+            # Deleted since the match
+            continue
+        results.append(dict(row, snippet=highlight(snippets.get(pk, '')), relevance=round(-score, 4)))
+    return results, has_more
+
+
+def index_progress():
+    """Highest message id the index covers, or None when it covers every row"""
+    with connections['default'].cursor() as cursor:
+        cursor.execute(f'SELECT indexed_through FROM {STATE_TABLE}')
+        (indexed_through,) = cursor.fetchone()
+    return None if indexed_through == FULLY_INDEXED else indexed_through
+
+
+def start_rebuild():
+    """
+    Empty the index so index_chunk() can refill it from the start. Until it
+    catches up, writes to messages not indexed yet leave the index alone;
+    the chunks pick those rows up as they are by then.
+    """
+    with transaction.atomic(), connections['default'].cursor() as cursor:
+        cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('delete-all')")
+        cursor.execute(f'UPDATE {STATE_TABLE} SET indexed_through = 0')
+
+
+def index_chunk(chunk_size):
+    """
+    Index the next ``chunk_size`` messages of a rebuild in one short
+    transaction. Returns the number indexed; fewer than ``chunk_size``
+    means the index is complete and the triggers cover every row again.
+    """
+    with transaction.atomic(), connections['default'].cursor() as cursor:
+        cursor.execute(f'SELECT indexed_through FROM {STATE_TABLE}')
+        (start,) = cursor.fetchone()
+        if start == FULLY_INDEXED:
+            return 0
+        cursor.execute(
+            f'SELECT id, message_text, device_id, risk_level FROM {Message._meta.db_table} '
+            f'WHERE id > %s ORDER BY id LIMIT %s',
+            [start, chunk_size],
+        )
+        rows = cursor.fetchall()
+        cursor.executemany(
+            f'INSERT INTO {FTS_TABLE} (rowid, message_text, device_id, risk_level) VALUES (%s, %s, %s, %s)', rows
+        )
+        done = len(rows) < chunk_size
+        cursor.execute(f'UPDATE {STATE_TABLE} SET indexed_through = %s',
+                       [FULLY_INDEXED if done else rows[-1][0]])
+    return len(rows)
+
+
+def merge_step(pages):
+    """
+    Let FTS5 merge up to ``pages`` pages of index segments. Returns False
+    once there was nothing left to merge. Frequent small inserts leave many
+    segments behind, which slows queries down until they are merged.
+    """
+    with transaction.atomic(), connections['default'].cursor() as cursor:
+        before = connections['default'].connection.total_changes
+        cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rank) VALUES ('merge', %s)", [pages])
+        return connections['default'].connection.total_changes - before > 1
+
+
+def check_index():
+    """Raise DatabaseError if the index does not match the messages"""
+    with connections['default'].cursor() as cursor:
+        cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rank) VALUES ('integrity-check', 1)")
@@ -0,0 +1,64 @@
+from django.conf import settings
+from django.db.models import Q
+
+from .geo import GEOHASH_PRECISION, GEOHASH_SENTINEL, bounding_box, covering_cells, haversine_many
+from .models import Location
+
+LOCATION_FIELDS = ['id', 'device__kindred_id', 'latitude', 'longitude', 'accuracy', 'timestamp']
+
+
+def candidate_locations(min_lat, min_lon, max_lat, max_lon, since, until):
+    """
+    Locations in the time window whose geohash cell overlaps the box.
+
+    Small areas list their cells for an equality lookup on the (cell,
+    timestamp) index; areas needing more than VIGILEYE_GEO_MAX_CELLS cells
+    fall back to ranges over coarser prefixes. Either way only rows in
+    those cells are read, never the whole table.
+    """
+    cells = covering_cells(min_lat, min_lon, max_lat, max_lon, settings.VIGILEYE_GEO_MAX_CELLS)
+    if len(cells[0]) == GEOHASH_PRECISION:
+        in_cells = Q(cell__in=cells)
+    else:
+        in_cells = Q()
+        for prefix in cells:
+            in_cells |= Q(cell__gte=prefix, cell__lt=prefix + GEOHASH_SENTINEL)
+    return Location.objects.filter(in_cells, timestamp__gte=since, timestamp__lte=until)
+
+
+def devices_in_area(since, until, box=None, center=None, radius_m=None, parent_id=None):
+    """
+    Latest fix of every device seen inside an area during [since, until].
+
+    The area is either ``box`` (min_lat, min_lon, max_lat, max_lon) or a
+    circle of ``radius_m`` meters around ``center`` (lat, lon). Candidates
+    come from the cell index; the exact box or distance test runs in memory.
+    Returns (results, candidate_count), newest fix first.
+    """
+    if center is not None:
+        box = bounding_box(center[0], center[1], radius_m)
+    min_lat, min_lon, max_lat, max_lon = box
+
+    candidates = candidate_locations(min_lat, min_lon, max_lat, max_lon, since, until)
+    if parent_id:
+        candidates = candidates.filter(device__owner_parent_id=parent_id)
+    rows = list(candidates.order_by('-timestamp', '-id').values(*LOCATION_FIELDS)[:settings.VIGILEYE_GEO_MAX_CANDIDATES])
+
+    latitudes = [float(row['latitude']) for row in rows]
+    longitudes = [float(row['longitude']) for row in rows]
+    if center is not None:
+        distances = haversine_many(center[0], center[1], latitudes, longitudes)
+        inside = [distance <= radius_m for distance in distances]
+    else:
+        distances = [None] * len(rows)
+        inside = [
+            min_lat <= lat <= max_lat and min_lon <= lon <= max_lon
+            for lat, lon in zip(latitudes, longitudes)
+        ]
+
+    results = {}
+    for row, distance, hit in zip(rows, distances, inside):
+        kindred_id = row['device__kindred_id']
+        if hit and kindred_id not in results:
+            results[kindred_id] = dict(row, distance_m=distance)
+    return list(results.values()), len(rows)
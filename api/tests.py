@@ -1,3 +1,1393 @@
-from django.test import TestCase
+import asyncio
+import csv
+import gzip
+import io
+import json
+import random
+import re
+import tempfile
+import threading
+import time
+from datetime import timezone as dt_timezone
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.core.management import call_command
+from django.db import DatabaseError, OperationalError, connection, connections, transaction
+from django.db.models import Count, Q
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from .benchmark import generate_corpus, percentiles, reference_detector
+from .conversation import ConversationTracker, conversations
+from .devices import DeviceResolver, devices
+from .events import alert_payload, broker, publish_alerts, stream_events
+from .export import ExportWorker, exports
+from .geo import haversine_m, simplify_track
+from .geofences import geofences
+from .ingest import IngestQueue, record_messages
+from .lexicon import lexicons
+from .metrics import Histogram, metrics
+from .models import Alert, Device, ExportJob, Geofence, HourlyRollup, Location, Message
+from .normalize import fold, fold_with_offsets
+from .notifications import BaseNotificationBackend, Notification, NotificationDispatcher
+from .presence import PresenceTable, presence
+from .retention import _merge_rollups, hourly_trend
+from .routers import STICKY_COOKIE
+from .search import build_match, index_chunk, index_progress, search_messages, start_rebuild
+from .risk import DEFAULT_LEXICON, RiskMatcher, compile_lexicon, default_matcher, detect_risk
+from .spatial import candidate_locations
+from .writer import writes
+
+
+def naive_detect_risk(message):
+    """The original per-keyword scan, kept as the reference for the matcher"""
+    if not message or not message.strip():
+        return 0, [], 'safe'
+    message_lower = message.lower()
+    message_folded = fold(message)
+    flagged_keywords = []
+    risk_score = 0
+    for category in DEFAULT_LEXICON['categories']:
+        for keyword in category['keywords']:
+            if keyword in message_lower or keyword in message_folded:
+                risk_score += category['weight']
+                flagged_keywords.append(category.get('label') or keyword)
+    patterns = [
+        (r'\b\d{2,3}\b', 2, 'age_request'),
+        (r'\b\d{3}-\d{3}-\d{4}\b', 3, 'phone_request'),
+        (r'@\w+', 2, 'social_media'),
+        (r'http[s]?://\S+', 4, 'url_share'),
+        (r'f+u+c+k+', 4, 'profanity'),
+        (r's+h+i+t+', 4, 'profanity'),
+        (r'd+a+m+n+', 4, 'profanity'),
+    ]
+    for pattern, score, category in patterns:
+        if re.findall(pattern, message_lower):
+            risk_score += score
+            flagged_keywords.append(category)
+    if risk_score >= 7:
+        risk_level = 'high'
+    elif risk_score >= 4:
+        risk_level = 'medium'
+    elif risk_score >= 1:
+        risk_level = 'low'
+    else:
+        risk_level = 'safe'
+    return risk_score, list(set(flagged_keywords)), risk_level
+
+
+class RiskMatcherTests(SimpleTestCase):
+    def test_matches_naive_scan(self):
+        words = [k for c in DEFAULT_LEXICON['categories'] for k in c['keywords']]
+        words += ['hello', 'Meet', 'DONT', '12', '2024', '555-123-4567', 'x555-123-4567',
+                  '@kid', 'https://x.io', 'ffuuck', 'sshhit', 'daamn', 'the', 'a1']
+        rng = random.Random(7)
+        for _ in range(3000):
+            text = rng.choice([' ', '', '.']).join(
+                rng.choice(words) for _ in range(rng.randint(0, 12))
+            )
+            expected = naive_detect_risk(text)
+            score, flagged, level = detect_risk(text)
+            self.assertEqual((score, sorted(flagged), level),
+                             (expected[0], sorted(expected[1]), expected[2]), text)
+
+    def test_finds_keywords_hidden_by_a_longer_match(self):
+        score, flagged, level = detect_risk('come alone together')
+        self.assertEqual(flagged, ['come alone', 'alone together', 'alone'])
+        self.assertEqual(detect_risk('bullshit')[1], ['profanity'])
+        self.assertEqual(detect_risk('bullshit')[0], 4 + 4 + 4)
+        spans = default_matcher.spans('come alone together')
+        self.assertIn((5, 19, 'alone together'), spans)
+
+    def test_matches_obfuscated_keywords(self):
+        for text, keyword in [('m33t m3 after school', 'meet me'), ('s.e.n.d  p.i.c', 'send pic'),
+                              ('ᴍᴇᴇᴛ me', 'meet me'), ('meeeeet me', 'meet me'), ('ｍｅｅｔ ｍｅ', 'meet me'),
+                              ('m\u0435et m\u0435', 'meet me'), ('s e n d pic', 'send pic'),
+                              ("don't tell", 'dont tell')]:
+            self.assertIn(keyword, detect_risk(text)[1], text)
+        score, flagged, level = detect_risk('N.U.D.3 pl$')
+        self.assertIn('nude', flagged)
+        # Patterns still see the original digits
+        self.assertEqual(detect_risk('i am 13')[1], ['age_request'])
+
+    def test_leet_only_in_words_with_letters(self):
+        self.assertEqual(fold('M33T me at 5:00'), 'meet me at 500')
+        self.assertEqual(fold('h0w 0ld, 13?'), 'how old 13?')
+        # Room 455 is not "ass"
+        self.assertNotIn('profanity', detect_risk('see you in room 455')[1])
+        self.assertIn('profanity', detect_risk('what an 455h0le')[1])
+
+    def test_matches_reference_scan(self):
+        # Same score and labels as one substring test per keyword; how much
+        # faster it is is measured by bench_risk --reference
+        reference = reference_detector(DEFAULT_LEXICON)
+        for kind in ('short', 'long', 'adversarial'):
+            for text in generate_corpus(kind, 300):
+                score, labels, level = detect_risk(text)
+                expected_score, expected_labels, expected_level = reference(text)
+                self.assertEqual((score, set(labels), level),
+                                 (expected_score, set(expected_labels), expected_level), text)
+
+    def test_fold_offsets_point_into_original(self):
+        rng = random.Random(3)
+        alphabet = 'aeMt 3$.-é\u0435\u200bｍ!'
+        for _ in range(500):
+            text = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 20)))
+            folded, offsets = fold_with_offsets(text)
+            self.assertEqual(folded, fold(text), text)
+            self.assertEqual(len(offsets), len(folded))
+            self.assertEqual(offsets, sorted(offsets))
+        message = 'ok M.3.3.T me later'
+        start, end, label = [span for span in default_matcher.spans(message) if span[2] == 'meet me'][0]
+        self.assertEqual(message[start:end], 'M.3.3.T me')
+
+    def test_rejects_capturing_groups(self):
+        with self.assertRaises(ValueError):
+            RiskMatcher({'categories': [], 'patterns': [
+                {'pattern': r'(a)b', 'weight': 1, 'label': 'x'},
+            ]})
+
+
+# Digests of the alerts raised here go nowhere
+@override_settings(VIGILEYE_NOTIFICATION_BACKEND='api.notifications.NullBackend')
+class AnalyzeBatchTests(TestCase):
+    def setUp(self):
+        conversations.clear()
+        # Not due for a version check during the test
+        lexicons.current()
+
+    def test_batch_stores_messages_and_alerts(self):
+        Device.objects.create(kindred_id='KID-1', owner_parent_id='p')
+        Device.objects.create(kindred_id='KID-2', owner_parent_id='p')
+        payload = {'messages': [
+            {'kindredId': 'KID-1', 'text': 'dont tell anyone, meet me'},
+            {'kindredId': 'KID-2', 'text': 'see you at school'},
+            {'kindredId': 'KID-1'},
+        ]}
+        # Device lookup, recent copies, conversation windows, savepoint, message insert,
+        # alert insert, release
+        with self.assertNumQueries(7):
+            response = self.client.post('/api/analyze/batch/', json.dumps(payload),
+                                        content_type='application/json')
+        results = response.json()['results']
+        self.assertEqual([r['success'] for r in results], [True, True, False])
+        self.assertEqual(results[0]['risk_level'], 'high')
+        self.assertIsNotNone(results[0]['alert_id'])
+        self.assertIsNone(results[1]['alert_id'])
+        self.assertEqual(Message.objects.count(), 2)
+        self.assertEqual(Alert.objects.get().risk_level, 'high')
+
+    def test_rejects_items_that_are_not_strings(self):
+        payload = {'messages': [
+            {'kindredId': 'KID-1', 'text': 'see you at school'},
+            {'kindredId': 'KID-1', 'text': ['dont', 'tell']},
+        ]}
+        response = self.client.post('/api/analyze/batch/', json.dumps(payload), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], 'messages[1]: text and kindredId must be strings')
+        self.assertEqual(Message.objects.count(), 0)
+
+    def test_repeats_are_counted_not_stored(self):
+        text = 'add me on snapchat, dont tell anyone'
+        payload = {'messages': [{'kindredId': 'KID-1', 'text': text}] * 3
+                   + [{'kindredId': 'KID-2', 'text': text}]}
+        results = self.client.post('/api/analyze/batch/', json.dumps(payload),
+                                   content_type='application/json').json()['results']
+        self.assertEqual([r['duplicate'] for r in results], [False, True, True, False])
+        self.assertEqual(results[1]['message_id'], results[0]['message_id'])
+        self.client.post('/api/analyze/', json.dumps({'kindredId': 'KID-1', 'text': text}),
+                         content_type='application/json')
+
+        self.assertEqual(Message.objects.count(), 2)
+        message = Message.objects.get(device__kindred_id='KID-1')
+        self.assertEqual(message.duplicate_count, 3)
+        alert = Alert.objects.get(message=message)
+        self.assertEqual(alert.occurrences, 4)
+        self.assertIsNotNone(alert.last_seen)
+
+        # Outside the window the text is stored again
+        Message.objects.update(timestamp=timezone.now() - timezone.timedelta(hours=1))
+        self.client.post('/api/analyze/', json.dumps({'kindredId': 'KID-1', 'text': text}),
+                         content_type='application/json')
+        self.assertEqual(Message.objects.count(), 3)
+
+    def test_highlights_only_when_asked(self):
+        payload = json.dumps({'kindredId': 'KID-1', 'text': 'ok M.3.3.T me at 5:00'})
+        response = self.client.post('/api/analyze/', payload, content_type='application/json').json()
+        self.assertNotIn('highlights', response)
+        response = self.client.post('/api/analyze/?highlights=1', payload, content_type='application/json').json()
+        self.assertIn({'start': 3, 'end': 13, 'label': 'meet me'}, response['highlights'])
+
+
+@override_settings(VIGILEYE_INGEST_MODE='queue', VIGILEYE_NOTIFICATION_BACKEND='api.notifications.NullBackend')
+class IngestQueueTests(TransactionTestCase):
+    def setUp(self):
+        conversations.clear()
+        # Devices cached by earlier tests are gone from the flushed database
+        devices.clear()
+
+    def tearDown(self):
+        writes.stop()
+
+    def start_queue(self, **options):
+        """Swap in a fresh ingest queue; workers=0 leaves draining it to the test"""
+        ingest_queue = IngestQueue(**dict(dict(maxsize=100, workers=1, batch_size=50, linger=0, history=100),
+                                          **options))
+        patcher = mock.patch('api.ingest._ingest_queue', ingest_queue)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(ingest_queue.stop, timeout=5)
+        return ingest_queue
+
+    def analyze(self, text):
+        return self.client.post('/api/analyze/', json.dumps({'kindredId': 'KID-1', 'text': text}),
+                                content_type='application/json')
+
+    def ticket_status(self, ticket):
+        return self.client.get('/api/analyze/ticket/', {'ticket': ticket})
+
+    def test_queued_message_gets_a_ticket_then_a_result(self):
+        ingest_queue = self.start_queue()
+        response = self.analyze('dont tell anyone, meet me')
+        self.assertEqual(response.status_code, 202)
+        ticket = response.json()['ticket']
+        wait_until(lambda: ingest_queue.status(ticket)['status'] != 'queued')
+        state = self.ticket_status(ticket).json()
+        self.assertEqual((state['status'], state['risk_level']), ('done', 'high'))
+        self.assertEqual(Message.objects.get().id, state['message_id'])
+        self.assertEqual(self.ticket_status('unknown').status_code, 404)
+
+    def test_full_queue_answers_503(self):
+        self.start_queue(maxsize=1, workers=0)
+        self.assertEqual(self.analyze('first').status_code, 202)
+        response = self.analyze('second')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+
+    def test_worker_writes_a_batch_at_once(self):
+        ingest_queue = self.start_queue(workers=0)
+        tickets = [ingest_queue.submit('KID-1', text) for text in ['meet me', 'hello', 'come alone']]
+        with mock.patch('api.ingest.record_messages', wraps=record_messages) as recorded:
+            ingest_queue._write(ingest_queue._next_batch())
+        recorded.assert_called_once_with([('KID-1', 'meet me'), ('KID-1', 'hello'), ('KID-1', 'come alone')])
+        self.assertEqual([ingest_queue.status(ticket)['status'] for ticket in tickets], ['done'] * 3)
+        self.assertEqual(Message.objects.count(), 3)
+
+    def test_locked_database_is_retried(self):
+        ingest_queue = self.start_queue(workers=0)
+        ticket = ingest_queue.submit('KID-1', 'meet me')
+        calls = []
+
+        def locked_once(pairs):
+            calls.append(pairs)
+            if len(calls) == 1:
+                raise OperationalError('database is locked')
+            return record_messages(pairs)
+
+        with mock.patch('api.ingest.record_messages', locked_once), self.assertLogs('api.ingest', 'WARNING'):
+            ingest_queue._write(ingest_queue._next_batch())
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(ingest_queue.status(ticket)['status'], 'done')
+
+    def test_failed_batch_is_reported_on_its_tickets(self):
+        ingest_queue = self.start_queue(workers=0)
+        broken = ingest_queue.submit('KID-1', 'meet me')
+        with mock.patch('api.ingest.record_messages', side_effect=ValueError('bad row')), \
+                self.assertLogs('api.ingest', 'ERROR'):
+            ingest_queue._write(ingest_queue._next_batch())
+        self.assertEqual(self.ticket_status(broken).json(),
+                         {'status': 'failed', 'error': 'bad row', 'ticket': broken})
+
+        locked = ingest_queue.submit('KID-1', 'meet me')
+        with mock.patch('api.ingest.record_messages', side_effect=OperationalError('database is locked')), \
+                self.assertLogs('api.ingest', 'WARNING'):
+            ingest_queue._write(ingest_queue._next_batch(), attempts=2)
+        self.assertEqual(self.ticket_status(locked).json()['error'], 'database unavailable')
+        self.assertFalse(Message.objects.exists())
+
+class DeviceResolverTests(TransactionTestCase):
+    # Devices are only cached once committed, so these run outside a test transaction
+    def setUp(self):
+        devices.clear()
+        for kindred_id in ['KID-1', 'KID-2', 'KID-3']:
+            Device.objects.create(kindred_id=kindred_id, owner_parent_id='p')
+
+    def tearDown(self):
+        writes.stop()
+
+    def test_counts_hits_and_misses(self):
+        resolver = DeviceResolver(maxsize=10, ttl=60)
+        with self.assertNumQueries(1):
+            self.assertEqual(set(resolver.get_many(['KID-1', 'KID-2', 'unknown'])), {'KID-1', 'KID-2'})
+        with self.assertNumQueries(0):
+            self.assertEqual(resolver.get('KID-1').kindred_id, 'KID-1')
+        stats = resolver.stats()
+        self.assertEqual((stats['size'], stats['hits'], stats['misses']), (2, 1, 3))
+        self.assertEqual(stats['hit_rate'], 0.25)
+
+    def test_entries_expire_after_ttl(self):
+        resolver = DeviceResolver(maxsize=10, ttl=30)
+        with mock.patch('api.devices.time.monotonic', return_value=1000):
+            resolver.get('KID-1')
+        with mock.patch('api.devices.time.monotonic', return_value=1029), self.assertNumQueries(0):
+            resolver.get('KID-1')
+        with mock.patch('api.devices.time.monotonic', return_value=1031), self.assertNumQueries(1):
+            resolver.get('KID-1')
+
+    def test_evicts_least_recently_used(self):
+        resolver = DeviceResolver(maxsize=2, ttl=60)
+        resolver.get('KID-1')
+        resolver.get('KID-2')
+        resolver.get('KID-1')
+        resolver.get('KID-3')
+        self.assertEqual(list(resolver._entries), ['KID-1', 'KID-3'])
+        self.assertEqual(resolver.stats()['evictions'], 1)
+
+    def test_not_cached_until_committed(self):
+        resolver = DeviceResolver(maxsize=10, ttl=60)
+        with transaction.atomic():
+            resolver.get_or_create('KID-4')
+            self.assertEqual(resolver.stats()['size'], 0)
+        self.assertEqual(resolver.stats()['size'], 1)
+
+        with self.assertRaises(ValueError), transaction.atomic():
+            resolver.get_or_create('KID-5')
+            raise ValueError('rolled back')
+        self.assertIsNone(resolver.get('KID-5'))
+
+    def status(self, kindred_id):
+        return self.client.get('/api/location/status/', {'kindredId': kindred_id})
+
+    def test_toggle_and_reset_invalidate(self):
+        self.assertFalse(self.status('KID-1').json()['tracking_enabled'])
+        self.client.post('/api/location/toggle/', json.dumps({'kindredId': 'KID-1', 'enabled': True}),
+                         content_type='application/json')
+        self.assertTrue(self.status('KID-1').json()['tracking_enabled'])
+
+        self.client.post('/device/reset/', json.dumps({'kindredId': 'KID-1'}), content_type='application/json')
+        self.assertEqual(self.status('KID-1').status_code, 404)
+
+    def test_saves_made_elsewhere_invalidate(self):
+        devices.get('KID-2')
+        device = Device.objects.get(kindred_id='KID-2')
+        device.location_tracking_enabled = True
+        device.save()
+        self.assertTrue(devices.get('KID-2').location_tracking_enabled)
+
+class PresenceTests(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+        for kindred_id in ['KID-1', 'KID-2', 'KID-3']:
+            Device.objects.create(kindred_id=kindred_id, owner_parent_id='p')
+
+    def table(self, maxsize=100):
+        table = PresenceTable(interval=60, maxsize=maxsize)
+        # Flushed by the test instead of the background thread
+        patcher = mock.patch.object(table, '_ensure_flusher')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return table
+
+    def heartbeats(self):
+        return dict(Device.objects.values_list('kindred_id', 'last_heartbeat'))
+
+    def test_heartbeats_are_flushed_in_one_update(self):
+        table = self.table()
+        self.assertFalse(table.beat('unknown', self.now))
+        for offset, kindred_id in enumerate(['KID-1', 'KID-2', 'KID-1']):
+            self.assertTrue(table.beat(kindred_id, self.now + timezone.timedelta(seconds=offset)))
+        self.assertEqual(table.last_heartbeat('KID-1'), self.now + timezone.timedelta(seconds=2))
+        self.assertIsNone(table.last_heartbeat('KID-3'))
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(table.flush(), 2)
+        self.assertEqual(len(queries), 1)
+        # One CASE over the pinged devices, and no other column written
+        sql = queries[0]['sql']
+        self.assertTrue(sql.startswith('UPDATE "api_device" SET "last_heartbeat" = CASE'))
+        self.assertEqual(sql.count(' = CASE'), 1)
+        self.assertEqual(self.heartbeats(), {'KID-1': self.now + timezone.timedelta(seconds=2),
+                                             'KID-2': self.now + timezone.timedelta(seconds=1), 'KID-3': None})
+        self.assertEqual(table.flush(), 0)
+
+    def test_failed_flush_is_requeued(self):
+        table = self.table()
+        table.beat('KID-1', self.now)
+        table.beat('KID-2', self.now)
+        with mock.patch('api.presence.Device.objects.filter', side_effect=DatabaseError('database is locked')):
+            with self.assertRaises(DatabaseError):
+                table.flush()
+        # A newer heartbeat wins over the re-queued one
+        table.beat('KID-1', self.now + timezone.timedelta(seconds=5))
+        self.assertEqual(table.flush(), 2)
+        self.assertEqual(self.heartbeats()['KID-1'], self.now + timezone.timedelta(seconds=5))
+        self.assertEqual(self.heartbeats()['KID-2'], self.now)
+
+    def test_flusher_restarts_after_stop(self):
+        table = PresenceTable(interval=0.01, maxsize=100)
+        # Flushed inline: the writer cannot write past this test's transaction
+        with mock.patch.object(table, 'flush') as flush, \
+                mock.patch.object(writes, 'run', side_effect=lambda func: func()):
+            table.beat('KID-1', self.now)
+            wait_until(lambda: flush.called)
+            table.stop()
+            flush.reset_mock()
+            table.beat('KID-2', self.now)
+            wait_until(lambda: flush.called)
+            table.stop()
+
+    def test_remembers_only_the_latest_devices(self):
+        table = self.table(maxsize=2)
+        for kindred_id in ['KID-1', 'KID-2', 'KID-3']:
+            table.beat(kindred_id, self.now)
+        self.assertEqual(list(table._seen), ['KID-2', 'KID-3'])
+        # Until flushed, the evicted heartbeat is still known
+        self.assertEqual(table.last_heartbeat('KID-1'), self.now)
+        table.flush()
+        self.assertEqual(table.last_heartbeat('KID-1'), self.now)
+
+class BulkLocationTests(TestCase):
+    def track(self):
+        start = timezone.now() - timezone.timedelta(hours=1)
+        fixes = []
+        # Two minutes standing still with a few meters of GPS noise
+        for i in range(12):
+            fixes.append({'latitude': 40.0 + (i % 3) * 1e-5, 'longitude': -74.0, 'accuracy': 8,
+                          'timestamp': int((start + timezone.timedelta(seconds=10 * i)).timestamp() * 1000)})
+        # Then a straight walk north with one turn east
+        for i in range(1, 11):
+            latitude, longitude = (40.0 + i * 5e-4, -74.0) if i <= 5 else (40.0025, -74.0 + (i - 5) * 5e-4)
+            fixes.append({'latitude': latitude, 'longitude': longitude, 'accuracy': 8,
+                          'timestamp': int((start + timezone.timedelta(seconds=120 + 30 * i)).timestamp() * 1000)})
+        return fixes
+
+    def test_drops_jitter_and_collinear_points(self):
+        fixes = self.track()
+        body = gzip.compress(json.dumps({'kindredId': 'walker', 'fixes': fixes}).encode())
+        response = self.client.post('/api/location/bulk/', body, content_type='application/json',
+                                    headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['received'], 22)
+
+        stored = list(Location.objects.order_by('timestamp').values_list('latitude', 'longitude', 'timestamp'))
+        # Only the start, the corner and the end of the walk survive
+        self.assertEqual(len(stored), 3)
+        self.assertEqual(stored[-1][2].timestamp() * 1000, fixes[-1]['timestamp'])
+        self.assertAlmostEqual(float(stored[1][0]), 40.0025)
+        self.assertLess(haversine_m(float(stored[0][0]), float(stored[0][1]), 40.0, -74.0), 5)
+
+        # Re-sending the last fix stores nothing new
+        response = self.client.post('/api/location/bulk/', {'kindredId': 'walker', 'fixes': fixes[-1:]},
+                                    content_type='application/json')
+        self.assertEqual(response.json()['stored'], 0)
+
+    def test_stationary_device_reports_after_max_gap(self):
+        start = timezone.now()
+        fixes = [{'latitude': 51.5, 'longitude': 0.0, 'accuracy': 20, 'timestamp': start + timezone.timedelta(minutes=m)}
+                 for m in range(0, 31)]
+        kept = simplify_track(fixes, tolerance_m=15, min_jitter_m=10, max_gap_s=600)
+        self.assertEqual(kept, [fixes[0], fixes[11], fixes[22]])
+
+    def test_rejects_bad_fix(self):
+        response = self.client.post('/api/location/bulk/', {'kindredId': 'walker', 'fixes': [{'latitude': 95}]},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_rejects_timestamps_out_of_range(self):
+        now = timezone.now()
+        for timestamp, error in [
+            (10 ** 20, 'timestamp is out of range'),
+            ((now + timezone.timedelta(hours=1)).isoformat(), 'timestamp is in the future'),
+        ]:
+            response = self.client.post(
+                '/api/location/bulk/',
+                {'kindredId': 'walker', 'fixes': [{'latitude': 40, 'longitude': -74, 'timestamp': timestamp}]},
+                content_type='application/json',
+            )
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()['error'], error)
+        # A clock slightly ahead of the server's is tolerated
+        response = self.client.post(
+            '/api/location/bulk/',
+            {'kindredId': 'walker', 'fixes': [{'latitude': 40, 'longitude': -74,
+                                               'timestamp': int(now.timestamp() * 1000) + 60000}]},
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 200)
+
+
+class NearbyDevicesTests(TestCase):
+    def test_radius_and_box_queries(self):
+        now = timezone.now()
+        spots = {'home': (40.0, -74.0), 'school': (40.004, -74.0), 'far': (41.0, -74.0)}
+        for kindred_id, (latitude, longitude) in spots.items():
+            device = Device.objects.create(kindred_id=kindred_id, owner_parent_id='p')
+            Location.objects.create(device=device, latitude=latitude, longitude=longitude)
+        stale = Device.objects.create(kindred_id='stale', owner_parent_id='p')
+        Location.objects.create(device=stale, latitude=40.0, longitude=-74.0,
+                                timestamp=now - timezone.timedelta(days=2))
+
+        response = self.client.get('/api/locations/nearby/', {'lat': 40.0, 'lon': -74.0, 'radius': 500})
+        found = {row['kindred_id']: row for row in response.json()['devices']}
+        # 'school' is ~445 m away
+        self.assertEqual(set(found), {'home', 'school'})
+        self.assertAlmostEqual(found['school']['distance_m'], 444.8, delta=1)
+
+        response = self.client.get('/api/locations/nearby/', {'lat': 40.0, 'lon': -74.0, 'radius': 100})
+        self.assertEqual([row['kindred_id'] for row in response.json()['devices']], ['home'])
+
+        response = self.client.get('/api/locations/nearby/', {
+            'min_lat': 40.5, 'min_lon': -74.5, 'max_lat': 41.5, 'max_lon': -73.5,
+        })
+        self.assertEqual([row['kindred_id'] for row in response.json()['devices']], ['far'])
+
+        response = self.client.get('/api/locations/nearby/', {'lat': 40.0, 'lon': -74.0})
+        self.assertEqual(response.status_code, 400)
+
+
+class GeofenceTests(TestCase):
+    def setUp(self):
+        geofences.clear()
+        self.device = Device.objects.create(kindred_id='kid', owner_parent_id='p')
+
+    def test_enter_and_exit_raise_alerts(self):
+        response = self.client.post('/api/geofences/', {
+            'kindredId': 'kid', 'name': 'School', 'kind': 'circle',
+            'center': {'latitude': 40.0, 'longitude': -74.0}, 'radius': 200,
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.client.post('/api/geofences/', {
+            'kindredId': 'kid', 'name': 'Park', 'kind': 'polygon',
+            'vertices': [[40.01, -74.01], [40.01, -74.005], [40.015, -74.005], [40.015, -74.01]],
+        }, content_type='application/json')
+
+        start = timezone.now() - timezone.timedelta(hours=1)
+        path = [(40.005, -74.0), (40.0, -74.0), (40.0005, -74.0), (40.012, -74.007), (40.02, -74.0)]
+        fixes = [{'latitude': lat, 'longitude': lon, 'accuracy': 5,
+                  'timestamp': (start + timezone.timedelta(minutes=i)).isoformat()} for i, (lat, lon) in enumerate(path)]
+        response = self.client.post('/api/location/bulk/', {'kindredId': 'kid', 'fixes': fixes},
+                                    content_type='application/json')
+        self.assertEqual(len(response.json()['geofence_alerts']), 4)
+        self.assertEqual(
+            list(Alert.objects.order_by('id').values_list('excerpt', flat=True)),
+            ["Entered geofence 'School'", "Left geofence 'School'", "Entered geofence 'Park'", "Left geofence 'Park'"],
+        )
+        self.assertEqual(set(Alert.objects.values_list('source', flat=True)), {'geofence'})
+        # Not counted as medium chat risk on the dashboard
+        context = self.client.get('/dashboard/').context
+        self.assertEqual((context['medium_risk_count'], context['geofence_count']), (0, 4))
+        self.assertEqual(list(Geofence.objects.values_list('inside', flat=True)), [False, False])
+
+        # Back at school through the single-fix endpoint
+        response = self.client.post('/api/location/update/', {'kindredId': 'kid', 'latitude': 40.0, 'longitude': -74.0},
+                                    content_type='application/json')
+        self.assertEqual(len(response.json()['geofence_alerts']), 1)
+
+    def test_many_fences_cost_no_queries_without_transitions(self):
+        Geofence.objects.bulk_create([
+            Geofence(device=self.device, name=f'f{i}', kind='circle', center_latitude=40 + i * 0.001,
+                     center_longitude=-74.0, radius_m=50, min_latitude=40 + i * 0.001 - 0.001,
+                     max_latitude=40 + i * 0.001 + 0.001, min_longitude=-74.001, max_longitude=-73.999, inside=False)
+            for i in range(2000)
+        ])
+        fixes = [{'latitude': 39.0 + i * 1e-4, 'longitude': -75.0} for i in range(500)]
+        geofences.evaluate(self.device.id, 'kid', fixes[:1])
+        with self.assertNumQueries(0):
+            self.assertEqual(geofences.evaluate(self.device.id, 'kid', fixes), [])
+
+
+class RetentionTests(TestCase):
+    def test_archives_rolls_up_and_deletes(self):
+        device = Device.objects.create(kindred_id='kid', owner_parent_id='p')
+        old = timezone.now() - timezone.timedelta(days=40)
+        for score in [0, 3, 8]:
+            Message.objects.create(device=device, message_text=f'score {score}', risk_score=score)
+        Message.objects.create(device=device, message_text='recent')
+        Message.objects.exclude(message_text='recent').update(timestamp=old)
+        Alert.objects.create(device=device, excerpt='seen', score=8, acknowledged=True)
+        Alert.objects.create(device=device, excerpt='unseen', score=8)
+        Alert.objects.update(timestamp=timezone.now() - timezone.timedelta(days=100))
+        for latitude in [40.0, 40.002]:
+            Location.objects.create(device=device, latitude=latitude, longitude=-74.0, timestamp=old)
+
+        since = old - timezone.timedelta(days=70)
+        before = hourly_trend(device.id, since)
+        with tempfile.TemporaryDirectory() as archive, self.settings(VIGILEYE_ARCHIVE_DIR=archive):
+            call_command('apply_retention', chunk_size=2, stdout=io.StringIO())
+            segment = Path(archive) / 'message' / f"{old.astimezone(dt_timezone.utc):%Y-%m-%d}.ndjson.gz"
+            with gzip.open(segment, 'rt') as f:
+                archived = [json.loads(line) for line in f]
+
+        self.assertEqual(sorted(row['risk_score'] for row in archived), [0, 3, 8])
+        self.assertEqual(archived[0]['device__kindred_id'], 'kid')
+        self.assertEqual(list(Message.objects.values_list('message_text', flat=True)), ['recent'])
+        self.assertEqual(list(Alert.objects.values_list('excerpt', flat=True)), ['unseen'])
+        self.assertFalse(Location.objects.exists())
+
+        rollup = HourlyRollup.objects.get(message_count__gt=0)
+        self.assertEqual((rollup.message_count, rollup.max_risk_score, rollup.location_count), (3, 8, 2))
+        self.assertAlmostEqual(rollup.centroid_latitude, 40.001)
+        # Trend totals are unchanged by archiving
+        self.assertEqual(hourly_trend(device.id, since), before)
+
+    def test_merges_only_the_rollups_of_archived_rows(self):
+        first = Device.objects.create(kindred_id='kid-1', owner_parent_id='p')
+        second = Device.objects.create(kindred_id='kid-2', owner_parent_id='p')
+        hour = timezone.now().astimezone(dt_timezone.utc).replace(minute=0, second=0, microsecond=0)
+        next_hour = hour + timezone.timedelta(hours=1)
+        for device in [first, second]:
+            for start in [hour, next_hour]:
+                HourlyRollup.objects.create(device=device, hour=start, message_count=1)
+        rows = [
+            {'device_id': first.id, 'timestamp': hour + timezone.timedelta(minutes=5), 'risk_score': 3},
+            {'device_id': second.id, 'timestamp': next_hour + timezone.timedelta(minutes=5), 'risk_score': 8},
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            _merge_rollups('message', rows)
+
+        counts = {(rollup.device_id, rollup.hour): (rollup.message_count, rollup.max_risk_score)
+                  for rollup in HourlyRollup.objects.all()}
+        self.assertEqual(counts, {(first.id, hour): (2, 3), (first.id, next_hour): (1, 0),
+                                  (second.id, hour): (1, 0), (second.id, next_hour): (2, 8)})
+        # Only the two matching rollups were rewritten: six columns, one WHEN per rollup each
+        update = next(query['sql'] for query in queries if query['sql'].startswith('UPDATE'))
+        self.assertEqual(update.count(' WHEN '), 2 * 6)
+
+
+# Digests of the alerts raised here go nowhere
+@override_settings(VIGILEYE_NOTIFICATION_BACKEND='api.notifications.NullBackend')
+class ConversationTests(TestCase):
+    def setUp(self):
+        conversations.clear()
+
+    def analyze(self, text, kindred_id='kid'):
+        return self.client.post('/api/analyze/', {'kindredId': kindred_id, 'text': text},
+                                content_type='application/json').json()
+
+    def test_split_pattern_escalates_once(self):
+        self.assertEqual(self.analyze('wanna meet later?')['risk_level'], 'low')
+        self.assertEqual(self.analyze('are you alone')['conversation_score'], 6)
+        self.assertEqual(self.analyze('ok, where to meet')['conversation_score'], 6)
+        result = self.analyze('dont tell your mom')
+        self.assertEqual(result['risk_level'], 'medium')
+        self.assertEqual(result['conversation_score'], 11)
+        escalation = Alert.objects.get(id=result['escalation_alert_id'])
+        self.assertEqual((escalation.score, escalation.risk_level), (11, 'high'))
+        # Still above the threshold: no second escalation
+        self.assertIsNone(self.analyze('its a secret')['escalation_alert_id'])
+        # Another device has its own window
+        self.assertEqual(self.analyze('are you alone', kindred_id='other')['conversation_score'], 3)
+
+    def test_window_reloads_from_messages(self):
+        self.analyze('wanna meet later?')
+        self.analyze('are you alone')
+        conversations.clear()
+        self.assertEqual(self.analyze('dont tell your mom')['conversation_score'], 11)
+
+        # Messages older than the window no longer count
+        Message.objects.update(timestamp=timezone.now() - timezone.timedelta(hours=1))
+        conversations.clear()
+        self.assertEqual(self.analyze('its a secret')['conversation_score'], 3)
+
+    def test_reload_fetches_only_the_last_messages(self):
+        first = Device.objects.create(kindred_id='kid-1', owner_parent_id='p')
+        second = Device.objects.create(kindred_id='kid-2', owner_parent_id='p')
+        for device in [first, second]:
+            for n in range(5):
+                Message.objects.create(device=device, message_text=f'{n}', flagged_keywords=[f'label {n}'])
+        tracker = ConversationTracker(span=1800, max_messages=2, threshold=7, maxsize=10, weights={})
+        recent = tracker._recent([first.id, second.id], timezone.now())
+        self.assertEqual({device_id: [labels for _, _, labels in rows] for device_id, rows in recent.items()},
+                         {first.id: [['label 3'], ['label 4']], second.id: [['label 3'], ['label 4']]})
+
+    def test_friendly_chat_does_not_escalate(self):
+        for text in ['you are so cool', 'awesome, love you buddy', 'thanks friend, you are sweet',
+                     'haha cutie', 'you look beautiful, honey']:
+            result = self.analyze(text)
+            self.assertEqual(result['conversation_score'], 0)
+            self.assertIsNone(result['escalation_alert_id'])
+        self.assertFalse(Alert.objects.filter(source='conversation').exists())
+
+
+# Digests of the alerts raised here go nowhere
+@override_settings(VIGILEYE_NOTIFICATION_BACKEND='api.notifications.NullBackend')
+class LexiconTests(TestCase):
+    def setUp(self):
+        lexicons.expire()
+
+    def tearDown(self):
+        lexicons.expire()
+
+    def analyze(self, text):
+        return self.client.post('/api/analyze/', {'kindredId': 'kid', 'text': text},
+                                content_type='application/json').json()
+
+    def test_publish_and_activate_versions(self):
+        self.assertEqual(self.analyze('sleepover at mine?')['risk_score'], 0)
+
+        lexicon = json.loads(json.dumps(DEFAULT_LEXICON))
+        lexicon['categories'][0]['keywords'].append('sleepover')
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+            json.dump(lexicon, f)
+        call_command('lexicon', 'publish', f.name, '--activate', stdout=io.StringIO())
+        Path(f.name).unlink()
+
+        version, matcher = lexicons.current()
+        self.assertEqual(version, 1)
+        # Compiled once per version
+        self.assertIs(lexicons.current().matcher, matcher)
+        self.assertEqual(self.analyze('sleepover at mine?')['flagged_keywords'], ['sleepover'])
+
+        call_command('lexicon', 'activate', '0', stdout=io.StringIO())
+        self.assertEqual(self.analyze('sleepover at yours?')['risk_score'], 0)
+        self.assertEqual(list(Message.objects.order_by('id').values_list('lexicon_version', flat=True)), [0, 1, 0])
+
+    def test_rejects_invalid_lexicon(self):
+        with self.assertRaises(ValueError):
+            compile_lexicon({'categories': [{'name': 'x', 'weight': 2, 'keywords': ['Upper']}], 'patterns': []})
+        with self.assertRaises(ValueError):
+            compile_lexicon({'categories': [], 'patterns': [{'pattern': '(', 'weight': 1, 'label': 'x'}]})
+
+
+class BenchmarkTests(TestCase):
+    def test_corpus_is_reproducible(self):
+        self.assertEqual(generate_corpus('adversarial', 50, seed=1), generate_corpus('adversarial', 50, seed=1))
+        self.assertNotEqual(generate_corpus('short', 50, seed=1), generate_corpus('short', 50, seed=2))
+        self.assertEqual(percentiles(list(range(1, 101)))['p90'], 91)
+
+    def test_bench_risk_writes_report(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / 'bench.json'
+            call_command('bench_risk', messages=20, rounds=1, corpus=['short', 'long'],
+                         report=str(path), stdout=io.StringIO())
+            report = json.loads(path.read_text())
+            self.assertEqual(sorted(report['corpora']), ['long', 'short'])
+            self.assertGreater(report['corpora']['short']['messages_per_second'], 0)
+            # Comparing a run with itself passes
+            call_command('bench_risk', messages=20, rounds=1, corpus=['short'], baseline=str(path),
+                         max_regression=0.99, stdout=io.StringIO())
+
+
+# Digests of the alerts raised here go nowhere
+@override_settings(VIGILEYE_NOTIFICATION_BACKEND='api.notifications.NullBackend')
+class MetricsTests(TestCase):
+    def setUp(self):
+        metrics.clear()
+
+    def test_histogram_quantiles(self):
+        histogram = Histogram(scale=1e6)
+        rng = random.Random(5)
+        samples = sorted(rng.expovariate(100) for _ in range(5000))
+        for sample in samples:
+            histogram.record(sample)
+        for q in (0.5, 0.9, 0.99):
+            exact = samples[int(q * len(samples)) - 1]
+            self.assertAlmostEqual(histogram.quantile(q) / exact, 1, delta=0.07)
+
+    def test_requests_are_recorded_per_route(self):
+        self.client.post('/api/analyze/', {'kindredId': 'kid', 'text': 'meet me'}, content_type='application/json')
+        body = self.client.get('/metrics').content.decode()
+        self.assertIn('vigileye_request_duration_seconds_count{route="analyze_chat"} 1', body)
+        self.assertIn('vigileye_requests_total{route="analyze_chat",status="2xx"} 1', body)
+        self.assertIn('vigileye_device_cache_size ', body)
+        queries = re.search(r'vigileye_request_queries_sum\{route="analyze_chat"\} (\d+)', body)
+        self.assertGreater(int(queries.group(1)), 0)
+        risk = re.search(r'vigileye_request_risk_seconds_sum\{route="analyze_chat"\} (\S+)', body)
+        self.assertGreater(float(risk.group(1)), 0)
+
+    def test_slow_requests_are_profiled(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(VIGILEYE_PROFILE_SAMPLE_RATE=1.0, VIGILEYE_PROFILE_SLOW_MS=0,
+                                   VIGILEYE_PROFILE_DIR=directory):
+                self.client.get('/alerts/')
+            self.assertEqual([path.name.split('-')[0] for path in Path(directory).iterdir()], ['get_alerts'])
+
+
+class WriteFunnelTests(TransactionTestCase):
+    def tearDown(self):
+        writes.stop()
+
+    def test_concurrent_writes_share_the_writer(self):
+        def create(n):
+            if n == 3:
+                Device.objects.create(kindred_id='KID-3', owner_parent_id='p')
+                raise ValueError('rolled back')
+            return Device.objects.create(kindred_id=f'KID-{n}', owner_parent_id='p').id
+
+        outcomes = {}
+
+        def submit(n):
+            try:
+                outcomes[n] = writes.run(create, n)
+            except ValueError as e:
+                outcomes[n] = str(e)
+
+        threads = [threading.Thread(target=submit, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(outcomes[3], 'rolled back')
+        # Only the failing function's own writes were undone
+        self.assertEqual(sorted(Device.objects.values_list('kindred_id', flat=True)),
+                         [f'KID-{n}' for n in range(8) if n != 3])
+        self.assertEqual(Device.objects.get(kindred_id='KID-5').id, outcomes[5])
+
+    def test_failed_location_write_forgets_fence_state(self):
+        geofences.clear()
+        device = Device.objects.create(kindred_id='KID-1', owner_parent_id='p')
+        Geofence.objects.create(device=device, name='School', kind='circle', center_latitude=40.0,
+                                center_longitude=-74.0, radius_m=200)
+        self.client.post('/api/location/update/', {'kindredId': 'KID-1', 'latitude': 40.1, 'longitude': -74.0},
+                         content_type='application/json')
+        fix = {'kindredId': 'KID-1', 'latitude': 40.0, 'longitude': -74.0}
+        evaluate = geofences.evaluate
+
+        def evaluate_then_fail(*args):
+            evaluate(*args)
+            raise OperationalError('disk I/O error')
+
+        with mock.patch.object(geofences, 'evaluate', side_effect=evaluate_then_fail), \
+                self.assertLogs('api.views', 'ERROR'):
+            response = self.client.post('/api/location/update/', fix, content_type='application/json')
+        self.assertEqual(response.status_code, 500)
+        self.assertFalse(Alert.objects.exists())
+        # The entry was rolled back, so it is raised by the next fix
+        response = self.client.post('/api/location/update/', fix, content_type='application/json')
+        self.assertEqual(len(response.json()['geofence_alerts']), 1)
+
+    def test_device_and_geofence_writes_use_the_writer(self):
+        devices.clear()
+        geofences.clear()
+        Device.objects.create(kindred_id='KID-1', owner_parent_id='p')
+
+        def post(path, data):
+            return self.client.post(path, json.dumps(data), content_type='application/json')
+
+        with mock.patch.object(writes, 'run', wraps=writes.run) as run, \
+                mock.patch.object(presence, 'interval', 0):
+            post('/api/location/toggle/', {'kindredId': 'KID-1', 'enabled': True})
+            post('/heartbeat/', {'kindredId': 'KID-1'})
+            fence_id = post('/api/geofences/', {
+                'kindredId': 'KID-1', 'name': 'School', 'kind': 'circle',
+                'center': {'latitude': 40.0, 'longitude': -74.0}, 'radius': 200,
+            }).json()['geofence']['id']
+            post(f'/api/geofences/{fence_id}/', {'active': False})
+            self.client.delete(f'/api/geofences/{fence_id}/')
+            post('/device/reset/', {'kindredId': 'KID-1'})
+        self.assertEqual(run.call_count, 6)
+        self.assertFalse(Device.objects.exists())
+
+
+def wait_until(condition, timeout=5):
+    """Poll ``condition`` until it holds; fail the test if it never does"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('Timed out waiting for the background thread')
+        time.sleep(0.005)
+
+
+class FakeBackend(BaseNotificationBackend):
+    """Records digests; fails the first ``failures`` sends, blocks while ``gate`` is closed"""
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.digests = []
+        self.entered = threading.Event()
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def send_digest(self, parent_id, notifications):
+        self.entered.set()
+        self.gate.wait()
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('backend down')
+        self.digests.append((parent_id, [n.message for n in notifications]))
+
+
+class NotificationDispatcherTests(SimpleTestCase):
+    def dispatcher(self, backend, **options):
+        options = dict(dict(window=0.05, max_batch=50, max_attempts=3, retry_delay=0.01, queue_size=100), **options)
+        dispatcher = NotificationDispatcher(backend, **options)
+        self.addCleanup(dispatcher.stop)
+        return dispatcher
+
+    def notify(self, dispatcher, parent_id, message):
+        return dispatcher.enqueue(Notification(parent_id, message, 'high', timezone.now()))
+
+    def test_one_digest_per_parent_per_window(self):
+        backend = FakeBackend()
+        dispatcher = self.dispatcher(backend)
+        for parent_id, message in [('p1', 'a'), ('p2', 'b'), ('p1', 'c'), ('p1', 'd')]:
+            self.assertTrue(self.notify(dispatcher, parent_id, message))
+        wait_until(lambda: dispatcher.stats()['delivered'] == 4)
+        self.assertEqual(sorted(backend.digests), [('p1', ['a', 'c', 'd']), ('p2', ['b'])])
+        # The window closed; the next notification opens a new one
+        self.notify(dispatcher, 'p1', 'e')
+        wait_until(lambda: dispatcher.stats()['digests_sent'] == 3)
+        self.assertEqual(backend.digests[-1], ('p1', ['e']))
+
+    def test_retries_then_gives_up(self):
+        backend = FakeBackend(failures=1)
+        dispatcher = self.dispatcher(backend)
+        with self.assertLogs('api.notifications', 'ERROR'):
+            self.notify(dispatcher, 'p1', 'a')
+            wait_until(lambda: dispatcher.stats()['delivered'] == 1)
+        self.assertEqual(backend.digests, [('p1', ['a'])])
+        self.assertEqual(dispatcher.stats()['retries'], 1)
+
+        backend.failures = 10
+        with self.assertLogs('api.notifications', 'ERROR'):
+            self.notify(dispatcher, 'p2', 'b')
+            wait_until(lambda: dispatcher.stats()['abandoned'] == 1)
+        stats = dispatcher.stats()
+        # One failure above plus max_attempts here
+        self.assertEqual((stats['failed_attempts'], stats['retries']), (4, 3))
+        self.assertEqual(backend.failures, 7)
+
+    def test_stop_flushes_and_the_next_notification_restarts(self):
+        backend = FakeBackend()
+        dispatcher = self.dispatcher(backend, window=60)
+        self.notify(dispatcher, 'p1', 'a')
+        dispatcher.stop()
+        self.assertEqual(backend.digests, [('p1', ['a'])])
+        self.notify(dispatcher, 'p1', 'b')
+        dispatcher.stop()
+        self.assertEqual(backend.digests[-1], ('p1', ['b']))
+
+    def test_drops_when_the_queue_is_full(self):
+        backend = FakeBackend()
+        backend.gate.clear()
+        dispatcher = self.dispatcher(backend, window=0, queue_size=2)
+        self.notify(dispatcher, 'p1', 'a')
+        # The worker is stuck delivering the first one
+        backend.entered.wait(5)
+        self.assertTrue(self.notify(dispatcher, 'p1', 'b'))
+        self.assertTrue(self.notify(dispatcher, 'p1', 'c'))
+        self.assertFalse(self.notify(dispatcher, 'p1', 'd'))
+        self.assertEqual(dispatcher.stats()['dropped'], 1)
+        backend.gate.set()
+        wait_until(lambda: dispatcher.stats()['delivered'] == 3)
+
+    def test_stop_flushes_open_windows(self):
+        backend = FakeBackend()
+        dispatcher = self.dispatcher(backend, window=60)
+        self.notify(dispatcher, 'p1', 'a')
+        self.notify(dispatcher, 'p1', 'b')
+        dispatcher.stop()
+        self.assertEqual(backend.digests, [('p1', ['a', 'b'])])
+
+def parse_sse(chunk):
+    """(event, payload id, event id) of one Server-Sent Event"""
+    fields = dict(line.split(': ', 1) for line in chunk.strip().split('\n'))
+    return fields['event'], json.loads(fields['data'])['id'], fields['id']
+
+
+# Digests of the alerts raised here go nowhere
+@override_settings(VIGILEYE_NOTIFICATION_BACKEND='api.notifications.NullBackend')
+class EventStreamTests(TransactionTestCase):
+    def setUp(self):
+        conversations.clear()
+        self.device = Device.objects.create(kindred_id='kid', owner_parent_id='p')
+
+    def tearDown(self):
+        writes.stop()
+
+    def alert(self, excerpt='meet me'):
+        return Alert.objects.create(device=self.device, excerpt=excerpt, score=5, risk_level='medium')
+
+    def publish(self, *alerts):
+        publish_alerts([
+            alert_payload(alert.id, 'kid', alert.excerpt, alert.score, alert.risk_level, alert.timestamp)
+            for alert in alerts
+        ])
+
+    async def next_event(self, stream):
+        return parse_sse(await asyncio.wait_for(stream.__anext__(), 5))
+
+    async def test_fans_out_to_every_subscriber(self):
+        subscriptions = [broker.subscribe(), broker.subscribe()]
+        try:
+            alert = await sync_to_async(self.alert)()
+            await sync_to_async(self.publish)(alert)
+            for subscription in subscriptions:
+                kind, payload = await asyncio.wait_for(subscription.queue.get(), 5)
+                self.assertEqual((kind, payload['id']), ('alert', alert.id))
+        finally:
+            for subscription in subscriptions:
+                broker.unsubscribe(subscription)
+
+    async def test_publishes_on_commit_only(self):
+        subscription = broker.subscribe()
+        try:
+            def rolled_back():
+                with transaction.atomic():
+                    self.publish(self.alert('rolled back'))
+                    transaction.set_rollback(True)
+
+            await sync_to_async(rolled_back)()
+            # Stored by the write funnel inside its transaction, published when that commits
+            result = (await sync_to_async(record_messages)([('kid', 'dont tell anyone, meet me')]))[0]
+            kind, payload = await asyncio.wait_for(subscription.queue.get(), 5)
+            self.assertEqual((kind, payload['id']), ('alert', result['alert_id']))
+            while not subscription.queue.empty():
+                self.assertNotEqual(subscription.queue.get_nowait()[1]['excerpt'], 'rolled back')
+        finally:
+            broker.unsubscribe(subscription)
+
+    async def test_replays_after_last_event_id_without_repeating_live_events(self):
+        seen = await sync_to_async(self.alert)()
+        missed = await sync_to_async(self.alert)()
+        location = await Location.objects.acreate(device=self.device, latitude=1, longitude=2)
+        stream = stream_events(f'{seen.id}-0')
+        try:
+            self.assertTrue((await stream.__anext__()).startswith('retry:'))
+            # The missed alert also arrives live, as when its commit races the reconnect
+            await sync_to_async(self.publish)(missed)
+            replayed = [await self.next_event(stream) for _ in range(2)]
+            self.assertEqual(sorted(event[:2] for event in replayed), [('alert', missed.id), ('location', location.id)])
+
+            live = await sync_to_async(self.alert)()
+            await sync_to_async(self.publish)(live)
+            self.assertEqual(await self.next_event(stream), ('alert', live.id, f'{live.id}-{location.id}'))
+        finally:
+            await stream.aclose()
+
+    async def test_overflow_resyncs_from_the_database(self):
+        queue_size, broker.queue_size = broker.queue_size, 1
+        stream = stream_events(None)
+        try:
+            self.assertTrue((await stream.__anext__()).startswith('retry:'))
+            alerts = [await sync_to_async(self.alert)() for _ in range(3)]
+            # Only the first fits the client's queue
+            await sync_to_async(self.publish)(*alerts)
+            events = [await self.next_event(stream) for _ in range(3)]
+            self.assertEqual([event[1] for event in events], [alert.id for alert in alerts])
+        finally:
+            await stream.aclose()
+            broker.queue_size = queue_size
+
+@override_settings(VIGILEYE_READ_REPLICA_ALIAS='replica', VIGILEYE_WRITE_FUNNEL=False)
+class ReadReplicaTests(TransactionTestCase):
+    def setUp(self):
+        # A second connection to the test database stands in for the replica
+        primary = connections['default']
+        connections['replica'] = primary.__class__(dict(primary.settings_dict), alias='replica')
+        device = Device.objects.create(kindred_id='kid', owner_parent_id='p')
+        message = Message.objects.create(device=device, message_text='meet me', risk_score=8)
+        self.alert = Alert.objects.create(device=device, message=message, excerpt='meet me', score=8)
+
+    def tearDown(self):
+        connections['replica'].close()
+        del connections['replica']
+
+    def get_alerts(self):
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections['replica']) as replica:
+            response = self.client.get('/alerts/')
+        self.assertEqual(response.status_code, 200)
+        return response.json()['alerts'], len(primary), len(replica)
+
+    def test_read_only_views_read_from_the_replica(self):
+        alerts, primary, replica = self.get_alerts()
+        self.assertEqual([alert['id'] for alert in alerts], [self.alert.id])
+        self.assertEqual((primary, replica), (0, 1))
+        with CaptureQueriesContext(connections['replica']) as replica:
+            self.assertEqual(self.client.get('/dashboard/').status_code, 200)
+        self.assertTrue(replica)
+
+    def test_own_write_pins_reads_to_the_primary(self):
+        response = self.client.post('/api/acknowledge/', json.dumps({'alert_id': self.alert.id}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(STICKY_COOKIE, response.cookies)
+        _, primary, replica = self.get_alerts()
+        self.assertEqual((primary, replica), (1, 0))
+        # Another parent, without the cookie, still reads from the replica
+        self.client.cookies.clear()
+        _, primary, replica = self.get_alerts()
+        self.assertEqual((primary, replica), (0, 1))
+        # Failed writes do not pin
+        response = self.client.post('/api/acknowledge/', json.dumps({'alert_id': self.alert.id + 1}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+        self.assertNotIn(STICKY_COOKIE, response.cookies)
+
+
+class MessageSearchTests(TestCase):
+    def setUp(self):
+        self.kid = Device.objects.create(kindred_id='kid', owner_parent_id='p')
+        other = Device.objects.create(kindred_id='other', owner_parent_id='p')
+        self.meet = Message.objects.create(device=self.kid, message_text='Can we meet at the café <after> school?',
+                                           risk_score=8)
+        Message.objects.create(device=self.kid, message_text='meeting moved to friday')
+        Message.objects.create(device=other, message_text='meet me at the park', risk_score=8)
+
+    def search(self, **params):
+        response = self.client.get('/api/messages/search/', params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()['results']
+
+    def test_search_ranks_filters_and_highlights(self):
+        results = self.search(q='cafe school', kindredId='kid')
+        self.assertEqual([row['id'] for row in results], [self.meet.id])
+        self.assertEqual(results[0]['snippet'],
+                         'Can we meet at the <mark>café</mark> &lt;after&gt; <mark>school</mark>?')
+        self.assertEqual(len(self.search(q='meet*')), 3)
+        self.assertEqual(len(self.search(q='meet*', risk='high')), 2)
+        self.assertEqual(len(self.search(q='meet', kindredId='kid')), 1)
+        self.assertEqual(self.search(q='meet', until=(timezone.now() - timezone.timedelta(hours=1)).isoformat()), [])
+        # Query syntax in the input is searched as plain words
+        self.assertEqual(build_match('meet" OR NEAR(x'), '"meet" "OR" "NEAR" "x"')
+        self.assertEqual(self.client.get('/api/messages/search/', {'q': '*'}).status_code, 400)
+
+    def test_index_follows_updates_and_deletes(self):
+        Message.objects.filter(id=self.meet.id).update(message_text='see you at the library')
+        self.assertEqual(self.search(q='cafe'), [])
+        self.assertEqual(len(self.search(q='library')), 1)
+        Message.objects.filter(device__kindred_id='other').delete()
+        self.assertEqual(len(self.search(q='meet*')), 1)
+
+    def test_incremental_rebuild(self):
+        start_rebuild()
+        self.assertEqual(search_messages('meet')[0], [])
+        self.assertEqual(index_chunk(1), 1)
+        self.assertEqual(index_progress(), self.meet.id)
+        # Rows beyond the rebuild's progress change without touching the index
+        Message.objects.filter(message_text__startswith='meeting').delete()
+        Message.objects.create(device=self.kid, message_text='meet after practice')
+        call_command('search_index', chunk_size=1, pause=0, merge=True, check=True, stdout=io.StringIO(),
+                     stderr=io.StringIO())
+        self.assertIsNone(index_progress())
+        self.assertEqual(len(self.search(q='meet')), 3)
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        self.kid = Device.objects.create(kindred_id='kid', owner_parent_id='p')
+        other = Device.objects.create(kindred_id='other', owner_parent_id='p')
+        Message.objects.create(device=self.kid, message_text='meet me, "alone"', risk_score=8,
+                               flagged_keywords=['meet me', 'alone'])
+        Message.objects.create(device=self.kid, message_text='good night')
+        Message.objects.create(device=other, message_text='hello')
+        Location.objects.create(device=self.kid, latitude='40.7128000', longitude='-74.0060000', accuracy=5)
+
+    def export(self, **params):
+        response = self.client.get('/api/export/', params)
+        self.assertEqual(response.status_code, 200, getattr(response, 'content', b''))
+        self.assertTrue(response.streaming)
+        return gzip.decompress(b''.join(response.streaming_content)).decode()
+
+    def test_streams_gzipped_csv_and_ndjson(self):
+        rows = list(csv.reader(io.StringIO(self.export(table='messages', kindredId='kid'))))
+        self.assertEqual(rows[0][:3], ['id', 'kindred_id', 'message_text'])
+        self.assertEqual([row[2] for row in rows[1:]], ['meet me, "alone"', 'good night'])
+        self.assertEqual(json.loads(rows[1][5]), ['meet me', 'alone'])
+
+        lines = self.export(table='locations', format='ndjson').splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(json.loads(lines[0])['latitude'], 40.7128)
+
+        since = (timezone.now() + timezone.timedelta(minutes=1)).isoformat()
+        self.assertEqual(self.export(table='alerts', since=since).splitlines(),
+                         ['id,kindred_id,score,risk_level,excerpt,acknowledged,occurrences,last_seen,timestamp'])
+
+    def test_rejects_bad_requests_and_large_streams(self):
+        self.assertEqual(self.client.get('/api/export/', {'table': 'users'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/export/', {'table': 'alerts', 'kindredId': 'nobody'}).status_code, 404)
+        with override_settings(VIGILEYE_EXPORT_STREAM_MAX_ROWS=2):
+            self.assertEqual(self.client.get('/api/export/', {'table': 'messages'}).status_code, 413)
+
+
+class ExportJobTests(TransactionTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.settings = override_settings(VIGILEYE_EXPORT_DIR=self.directory.name, VIGILEYE_EXPORT_CHUNK_SIZE=2)
+        self.settings.enable()
+        device = Device.objects.create(kindred_id='kid', owner_parent_id='p')
+        Message.objects.bulk_create([Message(device=device, message_text=f'message {n}') for n in range(5)])
+
+    def tearDown(self):
+        exports.stop()
+        self.settings.disable()
+        self.directory.cleanup()
+
+    def test_background_export_is_written_and_downloadable(self):
+        response = self.client.post('/api/exports/', json.dumps({'table': 'messages', 'format': 'ndjson',
+                                                                  'kindredId': 'kid'}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+        job_id = response.json()['export']['id']
+        exports.join()
+
+        job = self.client.get(f'/api/exports/{job_id}/').json()['export']
+        self.assertEqual((job['status'], job['rows']), ('done', 5))
+        response = self.client.get(job['download_url'])
+        self.assertEqual(response.status_code, 200)
+        lines = gzip.decompress(b''.join(response.streaming_content)).decode().splitlines()
+        self.assertEqual([json.loads(line)['message_text'] for line in lines], [f'message {n}' for n in range(5)])
+        # A job already claimed is not written again
+        exports.submit(job_id)
+        exports.join()
+        self.assertEqual(ExportJob.objects.get(id=job_id).finished_at.isoformat(), job['finished_at'])
+
+    def test_pending_job_is_queued_once(self):
+        job = ExportJob.objects.create(table='messages', format='csv')
+        worker = ExportWorker()
+        self.addCleanup(worker.stop)
+        with mock.patch('api.export.run_job') as run_job:
+            # Submitted before the worker starts and finds it pending too
+            worker._put(job.id)
+            worker.submit(job.id)
+            worker.join()
+        run_job.assert_called_once_with(job.id)
+
+
+class RescoreMessagesTests(TestCase):
+    def setUp(self):
+        device = Device.objects.create(kindred_id='kid', owner_parent_id='p')
+        # Scored by an older lexicon that missed 'alone'
+        self.stale = Message.objects.create(device=device, message_text='come alone', risk_score=0, lexicon_version=1)
+        self.alert = Alert.objects.create(device=device, message=self.stale, excerpt='come alone', score=1)
+        Message.objects.create(device=device, message_text='good morning', risk_score=0, lexicon_version=1)
+        Message.objects.create(device=device, message_text='meet me', risk_score=8, flagged_keywords=['meet me', 'meet'])
+        self.checkpoint = Path(tempfile.mkdtemp()) / 'checkpoint.json'
+
+    def rescore(self, *args):
+        out = io.StringIO()
+        call_command('rescore_messages', '--lexicon-version', '0', '--chunk-size', '1',
+                     '--checkpoint', str(self.checkpoint), *args, stdout=out, stderr=io.StringIO())
+        return out.getvalue()
+
+    def test_dry_run_then_rescore(self):
+        out = self.rescore('--dry-run', '--workers', '0')
+        self.assertIn(f'#{self.stale.id}: 0 safe [] -> 8 high', out)
+        self.assertEqual(Message.objects.get(id=self.stale.id).risk_score, 0)
+        self.assertFalse(self.checkpoint.exists())
+
+        out = self.rescore('--workers', '2')
+        self.assertIn('2 messages scanned, 1 changed', out)
+        stale = Message.objects.get(id=self.stale.id)
+        self.assertEqual((stale.risk_score, stale.risk_level, stale.lexicon_version), (8, 'high', 0))
+        self.alert.refresh_from_db()
+        self.assertEqual((self.alert.score, self.alert.risk_level), (8, 'high'))
+        self.assertFalse(Message.objects.exclude(lexicon_version=0).exists())
+
+    def test_alerts_follow_the_threshold(self):
+        device = Device.objects.get(kindred_id='kid')
+        Alert.objects.all().delete()
+        Message.objects.all().delete()
+        # Now flagged, without an alert; no longer flagged; flagged with an alert from before alerts were linked
+        raised = Message.objects.create(device=device, message_text='come alone', risk_score=0, lexicon_version=1,
+                                        duplicate_count=2)
+        resolved = Message.objects.create(device=device, message_text='good morning', risk_score=5,
+                                          risk_level='medium', lexicon_version=1)
+        Alert.objects.create(device=device, message=resolved, excerpt='good morning', score=5)
+        legacy = Message.objects.create(device=device, message_text='dont tell your mom', risk_score=1,
+                                        lexicon_version=1)
+        unlinked = Alert.objects.create(device=device, excerpt='dont tell your mom', score=1)
+        geofence = Alert.objects.create(device=device, source='geofence', excerpt='dont tell your mom', score=4)
+
+        out = self.rescore('--dry-run', '--workers', '0')
+        self.assertIn(f'#{raised.id}: 0 safe [] -> 8 high', out)
+        self.assertIn('(alert raised)', out)
+        self.assertIn(f'#{resolved.id}: 5 medium [] -> 0 safe [] (alert resolved)', out)
+        self.assertIn('2 alerts updated, 1 raised, 1 resolved', out)
+        self.assertEqual(Alert.objects.count(), 3)
+
+        self.rescore('--workers', '0')
+        alert = Alert.objects.get(message=raised)
+        self.assertEqual((alert.score, alert.risk_level, alert.occurrences, alert.source), (8, 'high', 3, 'message'))
+        self.assertEqual(Alert.objects.filter(message=resolved).values_list('score', 'acknowledged').get(), (0, True))
+        unlinked.refresh_from_db()
+        self.assertEqual(unlinked.message_id, legacy.id)
+        self.assertEqual(unlinked.score, Message.objects.get(id=legacy.id).risk_score)
+        geofence.refresh_from_db()
+        self.assertEqual((geofence.message_id, geofence.score), (None, 4))
+
+    def test_label_order_is_not_a_change(self):
+        Message.objects.filter(message_text='meet me').update(flagged_keywords=['meet', 'meet me'])
+        out = self.rescore('--workers', '0', '--all', '--start-id', str(self.stale.id))
+        self.assertIn('2 messages scanned, 0 changed, 0 alerts updated', out)
+
+    def test_resume_skips_committed_chunks(self):
+        self.checkpoint.write_text(json.dumps({'lexicon_version': 0, 'last_id': self.stale.id}))
+        out = self.rescore('--resume', '--workers', '0', '--all')
+        self.assertIn('2 messages scanned, 0 changed', out)
+        self.assertEqual(Message.objects.get(id=self.stale.id).risk_score, 0)
+
+
+class KeysetPaginationTests(TestCase):
+    def test_alert_pages_cover_every_row_once(self):
+        device = Device.objects.create(kindred_id='KID-1', owner_parent_id='p')
+        created = [Alert.objects.create(device=device, excerpt=str(i), score=i % 9) for i in range(7)]
+        seen = []
+        after = ''
+        while True:
+            with self.assertNumQueries(1):
+                data = self.client.get('/alerts/', {'limit': 3, 'after': after}).json()
+            seen += [alert['id'] for alert in data['alerts']]
+            after = data['next_cursor']
+            if not after:
+                break
+        self.assertEqual(seen, [alert.id for alert in reversed(created)])
+
+    def test_rejects_bad_cursor(self):
+        response = self.client.get('/api/locations/', {'after': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 400)
+
+
+class QueryPlanTests(TestCase):
+    """The hot read paths must be served by indexes, never by a table scan"""
+
+    def explain(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def assertIndexed(self, queryset, sorted_by_index=True):
+        plan = self.explain(queryset)
+        for step in plan:
+            self.assertNotRegex(step, r'^SCAN api_\w+$', plan)
+            if sorted_by_index:
+                self.assertNotIn('TEMP B-TREE', step, plan)
+
+    def test_alert_paths(self):
+        newest = Alert.objects.order_by('-timestamp', '-id')
+        self.assertIndexed(newest[:51])
+        self.assertIndexed(newest.filter(
+            Q(timestamp__lt=timezone.now()) | Q(timestamp=timezone.now(), id__lt=10)
+        )[:51])
+        self.assertIndexed(Alert.objects.filter(score__gte=7).order_by('-timestamp')[:20])
+        self.assertIndexed(Alert.objects.filter(score__gte=7, acknowledged=False).order_by('-timestamp')[:20])
+        self.assertIndexed(Alert.objects.filter(score__gte=4, score__lt=7).order_by('-timestamp')[:10],
+                           sorted_by_index=False)
+        self.assertIndexed(Alert.objects.values('score').annotate(n=Count('id')).order_by('score'))
+
+    def test_location_and_message_paths(self):
+        self.assertIndexed(Location.objects.order_by('-timestamp', '-id')[:50])
+        self.assertIndexed(Location.objects.filter(device_id=1).order_by('-timestamp', '-id')[:50])
+        self.assertIndexed(Message.objects.filter(device_id=1).order_by('-timestamp', '-id')[:50])
+
+    def test_area_query_uses_cell_index(self):
+        now = timezone.now()
+        plan = self.explain(candidate_locations(40.0, -74.01, 40.01, -74.0, now - timezone.timedelta(hours=1), now))
+        self.assertTrue(any('location_cell_timestamp_idx (cell=? AND timestamp>? AND timestamp<?)' in step
+                            for step in plan), plan)
+
+    def test_dashboard_queries(self):
+        for risk in ['all', 'high', 'medium']:
+            with CaptureQueriesContext(connection) as captured:
+                self.client.get('/dashboard/', {'risk': risk})
+            for query in captured.captured_queries:
+                with connection.cursor() as cursor:
+                    cursor.execute('EXPLAIN QUERY PLAN ' + query['sql'])
+                    plan = [row[-1] for row in cursor.fetchall()]
+                for step in plan:
+                    self.assertNotRegex(step, r'^SCAN api_\w+$', (query['sql'], plan))
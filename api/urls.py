@@ -8,13 +8,27 @@ urlpatterns = [
     path('dashboard/', views.dashboard, name='dashboard'),
     path('text-input/', views.text_input_view, name='text_input'),
     path('api/analyze/', views.analyze_chat, name='analyze_chat'),
+    path('api/analyze/batch/', views.analyze_chat_batch, name='analyze_chat_batch'),
+    path('api/analyze/ticket/', views.analyze_ticket_status, name='analyze_ticket_status'),
     path('api/acknowledge/', views.acknowledge_alert, name='acknowledge_alert'),
     path('api/location/update/', views.update_location, name='update_location'),
+    path('api/location/bulk/', views.bulk_update_locations, name='bulk_update_locations'),
     path('api/location/status/', views.get_location_tracking_status, name='get_location_tracking_status'),
     path('api/location/status', views.get_location_tracking_status, name='get_location_tracking_status_no_slash'),
     path('api/location/toggle/', views.toggle_location_tracking, name='toggle_location_tracking'),
     path('api/locations/', views.get_locations, name='get_locations'),
+    path('api/locations/nearby/', views.get_nearby_devices, name='get_nearby_devices'),
+    path('api/geofences/', views.geofence_list, name='geofence_list'),
+    path('api/geofences/<int:fence_id>/', views.geofence_detail, name='geofence_detail'),
+    path('api/messages/search/', views.search_messages_view, name='search_messages'),
+    path('api/export/', views.export_data, name='export_data'),
+    path('api/exports/', views.export_jobs, name='export_jobs'),
+    path('api/exports/<int:job_id>/', views.export_job_detail, name='export_job_detail'),
+    path('api/exports/<int:job_id>/download/', views.export_job_download, name='export_job_download'),
+    path('api/trends/', views.get_device_trend, name='get_device_trend'),
+    path('api/stream/', views.event_stream, name='event_stream'),
     path('heartbeat/', views.device_heartbeat, name='device_heartbeat'),
     path('device/reset/', views.reset_device, name='reset_device'),
     path('alerts/', views.get_alerts, name='get_alerts'),
+    path('metrics', views.metrics_view, name='metrics'),
 ]
\ No newline at end of file
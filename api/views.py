@@ -1,122 +1,52 @@
 import json
 import hashlib
-import re
+import logging
+import queue
+import zlib
 from datetime import datetime
-from django.http import JsonResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect
 from django.views.decorators.csrf import csrf_exempt
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.core.paginator import Paginator
+from django.db.models import Count, Q
+from django.conf import settings
 from django.contrib import messages
-from .models import Device, Alert, Message, Location
+from .models import Device, Alert, Location, Geofence, ExportJob
+from .devices import devices
+from .geofences import geofences, validate_fence
+from .geo import geohash_encode, parse_fix, simplify_track
+from .export import ENCODERS, EXPORTS, FORMATS, export_path, export_rows, exports, gzip_chunks, parquet_available
+from .events import broker, location_payload, publish_locations, stream_events
+from .ingest import get_ingest_queue, ingest_enabled, record_messages
+from .lexicon import lexicons
+from .metrics import metrics
+from .notifications import dispatcher
+from .pagination import keyset_page, parse_limit
+from .presence import presence
+from .retention import hourly_trend
+from .routers import read_only, sticky_writes
+from .search import RISK_LEVELS, search_messages
+from .spatial import devices_in_area
+from .writer import writes
+
+logger = logging.getLogger(__name__)
 
 # Helper function to generate a cryptographic Kindred ID
 def generate_kindred_id(data):
     return hashlib.sha256(data.encode()).hexdigest()
 
-def detect_risk(message):
-    """
-    Enhanced risk detection function
-    Returns: (risk_score, flagged_keywords, risk_level)
-    """
-    if not message or not message.strip():
-        return 0, [], 'safe'
-    
-    message_lower = message.lower()
-    flagged_keywords = []
-    risk_score = 0
-    
-    # High-risk keywords (score: 5 points each)
-    high_risk_keywords = [
-        'dont tell', 'meet me', 'come alone', 'keep secret', 'dont tell anyone',
-        'meet up', 'come over', 'send pic', 'send photo', 'send picture',
-        'nude', 'naked', 'sexy', 'hot body', 'send nudes', 'private chat',
-        'my place', 'your place', 'alone together', 'no parents', 'dont tell mom',
-        'dont tell dad', 'meet secretly', 'hidden', 'secret meeting'
-    ]
-    
-    # Profanity and inappropriate language (score: 4 points each)
-    profanity_keywords = [
-        'fuck', 'shit', 'damn', 'hell', 'bitch', 'ass', 'asshole', 'bastard',
-        'piss', 'crap', 'bullshit', 'fucking', 'fucked', 'shitty', 'damned',
-        'bloody', 'freaking', 'screw', 'screwed', 'dammit', 'crap', 'wtf',
-        'omfg', 'stfu', 'goddamn', 'motherfucker', 'son of a bitch'
-    ]
-    
-    # Medium-risk keywords (score: 3 points each)
-    medium_risk_keywords = [
-        'how old are you', 'what grade', 'where do you live', 'what school',
-        'meet', 'alone', 'secret', 'private', 'personal info', 'address',
-        'phone number', 'social media', 'snapchat', 'instagram', 'tiktok',
-        'follow me', 'add me', 'friend request', 'dm me', 'message me'
-    ]
-    
-    # Low-risk keywords (score: 1 point each)
-    low_risk_keywords = [
-        'cute', 'beautiful', 'handsome', 'cool', 'awesome', 'amazing',
-        'love you', 'like you', 'friend', 'buddy', 'pal', 'sweet',
-        'darling', 'honey', 'babe', 'baby', 'cutie'
-    ]
-    
-    # Check for high-risk keywords
-    for keyword in high_risk_keywords:
-        if keyword in message_lower:
-            risk_score += 5
-            flagged_keywords.append(keyword)
-    
-    # Check for profanity
-    for keyword in profanity_keywords:
-        if keyword in message_lower:
-            risk_score += 4
-            flagged_keywords.append('profanity')
-    
-    # Check for medium-risk keywords
-    for keyword in medium_risk_keywords:
-        if keyword in message_lower:
-            risk_score += 3
-            flagged_keywords.append(keyword)
-    
-    # Check for low-risk keywords
-    for keyword in low_risk_keywords:
-        if keyword in message_lower:
-            risk_score += 1
-            flagged_keywords.append(keyword)
-    
-    # Pattern-based detection
-    patterns = [
-        (r'\b\d{2,3}\b', 2, 'age_request'),  # Age requests
-        (r'\b\d{3}-\d{3}-\d{4}\b', 3, 'phone_request'),  # Phone numbers
-        (r'@\w+', 2, 'social_media'),  # Social media handles
-        (r'http[s]?://\S+', 4, 'url_share'),  # URLs
-        (r'f+u+c+k+', 4, 'profanity'),  # Variations of fuck
-        (r's+h+i+t+', 4, 'profanity'),  # Variations of shit
-        (r'd+a+m+n+', 4, 'profanity'),  # Variations of damn
-    ]
-    
-    for pattern, score, category in patterns:
-        matches = re.findall(pattern, message_lower)
-        if matches:
-            risk_score += score
-            flagged_keywords.append(category)
-    
-    # Determine risk level
-    if risk_score >= 7:
-        risk_level = 'high'
-    elif risk_score >= 4:
-        risk_level = 'medium'
-    elif risk_score >= 1:
-        risk_level = 'low'
-    else:
-        risk_level = 'safe'
-    
-    return risk_score, list(set(flagged_keywords)), risk_level
-
-# Enhanced notification function
-def send_notification(message, risk_level='medium'):
-    """Send notification for risky messages"""
-    notification_msg = f"[{risk_level.upper()} RISK] {message}"
-    print(f"Notification: {notification_msg}")
-    # In a real app, this would send to parents via email/SMS/push notification
+# Helper function to decode a JSON body, inflating it if sent gzip-compressed
+def load_json_body(request):
+    body = request.body
+    if request.headers.get('Content-Encoding', '').lower() == 'gzip':
+        inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        body = inflater.decompress(body, settings.VIGILEYE_MAX_INFLATED_BODY)
+        if inflater.unconsumed_tail:
+            raise ValueError('Decompressed body is too large')
+    return json.loads(body)
 
 @csrf_exempt
 def analyze_chat(request):
@@ -130,53 +60,114 @@ def analyze_chat(request):
             if not text or not kindred_id:
                 return JsonResponse({'error': 'Text and kindredId are required'}, status=400)
 
-            # Use enhanced risk detection
-            risk_score, flagged_keywords, risk_level = detect_risk(text)
+            # In queue mode, hand the message to the background writers
+            if ingest_enabled():
+                try:
+                    ticket = get_ingest_queue().submit(kindred_id, text)
+                except queue.Full:
+                    response = JsonResponse({'error': 'Ingest queue is full, retry later'}, status=503)
+                    response['Retry-After'] = '1'
+                    return response
+                return JsonResponse({
+                    'success': True,
+                    'ticket': ticket,
+                    'status': 'queued',
+                    'message': 'Message queued for analysis'
+                }, status=202)
+
+            # Score and store the message
+            result = record_messages([(kindred_id, text)])[0]
+
+            response = {
+                'success': True,
+                'message_id': result['message_id'],
+                'alert_id': result['alert_id'],
+                'risk_score': result['risk_score'],
+                'risk_level': result['risk_level'],
+                'flagged_keywords': result['flagged_keywords'],
+                'conversation_score': result['conversation_score'],
+                'escalation_alert_id': result['escalation_alert_id'],
+                'duplicate': result['duplicate'],
+                'message': 'Message analyzed successfully'
+            }
+            # Where each label matched, as offsets into the submitted text; this
+            # matches the lexicon a second time, so only when asked for
+            if request.GET.get('highlights') == '1':
+                response['highlights'] = [
+                    {'start': start, 'end': end, 'label': label}
+                    for start, end, label in lexicons.current().matcher.spans(text)
+                ]
+            return JsonResponse(response)
             
-            # Get or create device
-            device, created = Device.objects.get_or_create(
-                kindred_id=kindred_id, 
-                defaults={'owner_parent_id': 'default_parent'}
-            )
+        except json.JSONDecodeError:
+            return JsonResponse({'error': 'Invalid JSON'}, status=400)
+        except Exception as e:
+            return JsonResponse({'error': f'Server error: {str(e)}'}, status=500)
+    
+    return JsonResponse({'error': 'Only POST requests are allowed'}, status=405)
 
-            # Store the message
-            message = Message.objects.create(
-                device=device,
-                message_text=text,
-                risk_score=risk_score,
-                flagged_keywords=flagged_keywords
-            )
+@csrf_exempt
+def analyze_chat_batch(request):
+    """Analyze a batch of chat messages buffered by a child device"""
+    if request.method == 'POST':
+        try:
+            data = load_json_body(request)
+            items = data.get('messages') if isinstance(data, dict) else data
 
-            # Create alert if risky
-            alert = None
-            if risk_score > 0:
-                alert = Alert.objects.create(
-                    device=device,
-                    excerpt=text,
-                    score=risk_score
-                )
-                
-                # Send notification for high-risk messages
-                if risk_level == 'high':
-                    send_notification(f"High-risk alert for device {kindred_id}: {text}", risk_level)
+            if not isinstance(items, list) or not items:
+                return JsonResponse({'error': 'A non-empty array of messages is required'}, status=400)
+            if len(items) > settings.VIGILEYE_BATCH_MAX_ITEMS:
+                return JsonResponse({'error': f'At most {settings.VIGILEYE_BATCH_MAX_ITEMS} messages per batch'}, status=400)
+
+            # Validate every item, keeping errors per item
+            valid = []
+            results = []
+            for index, item in enumerate(items):
+                text = item.get('text', '') if isinstance(item, dict) else ''
+                kindred_id = item.get('kindredId', '') if isinstance(item, dict) else ''
+                if not isinstance(text, str) or not isinstance(kindred_id, str):
+                    return JsonResponse({'error': f'messages[{index}]: text and kindredId must be strings'}, status=400)
+                if not text or not kindred_id:
+                    results.append({'success': False, 'error': 'Text and kindredId are required'})
+                    continue
+                valid.append((len(results), (kindred_id, text)))
+                results.append(None)
+
+            if valid:
+                recorded = record_messages([pair for _, pair in valid])
+                for (index, _), result in zip(valid, recorded):
+                    results[index] = dict(result, success=True)
 
             return JsonResponse({
                 'success': True,
-                'message_id': message.id,
-                'alert_id': alert.id if alert else None,
-                'risk_score': risk_score,
-                'risk_level': risk_level,
-                'flagged_keywords': flagged_keywords,
-                'message': 'Message analyzed successfully'
+                'results': results,
+                'message': f'{len(valid)} of {len(items)} messages analyzed'
             })
-            
+
         except json.JSONDecodeError:
             return JsonResponse({'error': 'Invalid JSON'}, status=400)
+        except (ValueError, zlib.error) as e:
+            return JsonResponse({'error': f'Invalid request body: {e}'}, status=400)
         except Exception as e:
             return JsonResponse({'error': f'Server error: {str(e)}'}, status=500)
-    
+
     return JsonResponse({'error': 'Only POST requests are allowed'}, status=405)
 
+def analyze_ticket_status(request):
+    """Report the outcome of a message queued by analyze_chat"""
+    if request.method == 'GET':
+        ticket = request.GET.get('ticket', '')
+
+        if not ticket:
+            return JsonResponse({'error': 'ticket is required'}, status=400)
+
+        state = get_ingest_queue().status(ticket) if ingest_enabled() else None
+        if state is None:
+            return JsonResponse({'error': 'Ticket not found'}, status=404)
+        return JsonResponse(dict(state, ticket=ticket))
+
+    return JsonResponse({'error': 'Only GET requests are allowed'}, status=405)
+
 @csrf_exempt
 def device_heartbeat(request):
     if request.method == 'POST':
@@ -184,18 +175,16 @@ def device_heartbeat(request):
             data = json.loads(request.body)
             kindred_id = data.get('kindredId', '')
             
-            try:
-                device = Device.objects.get(kindred_id=kindred_id)
-                device.last_heartbeat = timezone.now()
-                device.save()
+            # Recorded in memory and written to the database in bulk
+            if presence.beat(kindred_id, timezone.now()):
                 return JsonResponse({'status': 'heartbeat updated'})
-            except Device.DoesNotExist:
-                return JsonResponse({'error': 'Device not found'}, status=404)
+            return JsonResponse({'error': 'Device not found'}, status=404)
         except json.JSONDecodeError:
             return JsonResponse({'error': 'Invalid JSON'}, status=400)
     return JsonResponse({'error': 'Only POST requests are allowed'}, status=405)
 
 @csrf_exempt
+@sticky_writes
 def reset_device(request):
     if request.method == 'POST':
         try:
@@ -204,7 +193,9 @@ def reset_device(request):
 
             try:
                 device = Device.objects.get(kindred_id=kindred_id)
-                device.delete()
+                writes.run(device.delete)
+                devices.invalidate(kindred_id)
+                presence.forget(kindred_id)
                 return JsonResponse({'status': 'device deleted'})
             except Device.DoesNotExist:
                 return JsonResponse({'error': 'Device not found'}, status=404)
@@ -221,43 +212,59 @@ def login(request):
 def register(request):
     return render(request, 'register.html')
 
+@read_only
 def dashboard(request):
     risk_filter = request.GET.get('risk', 'all')
-    alerts = Alert.objects.all().order_by('-timestamp')
+    alerts = Alert.objects.select_related('device').order_by('-timestamp')
+    
+    # Get statistics in a single conditional-aggregation query; geofence
+    # alerts are counted apart from the chat risk levels
+    chat = ~Q(source='geofence')
+    stats = Alert.objects.aggregate(
+        total_alerts=Count('id'),
+        high_risk_count=Count('id', filter=chat & Q(score__gte=7)),
+        medium_risk_count=Count('id', filter=chat & Q(score__gte=4, score__lt=7)),
+        low_risk_count=Count('id', filter=chat & Q(score__gte=1, score__lt=4)),
+        geofence_count=Count('id', filter=~chat),
+    )
     
     # Filter alerts by risk level
+    filtered_count = stats['total_alerts']
     if risk_filter == 'high':
-        alerts = alerts.filter(score__gte=7)
+        alerts = alerts.filter(chat, score__gte=7)
+        filtered_count = stats['high_risk_count']
     elif risk_filter == 'medium':
-        alerts = alerts.filter(score__gte=4, score__lt=7)
+        alerts = alerts.filter(chat, score__gte=4, score__lt=7)
+        filtered_count = stats['medium_risk_count']
     elif risk_filter == 'low':
-        alerts = alerts.filter(score__gte=1, score__lt=4)
+        alerts = alerts.filter(chat, score__gte=1, score__lt=4)
+        filtered_count = stats['low_risk_count']
+    elif risk_filter == 'geofence':
+        alerts = alerts.filter(source='geofence')
+        filtered_count = stats['geofence_count']
     
     paginator = Paginator(alerts, 10)
+    # The statistics already counted these rows, skip the paginator's COUNT
+    paginator.count = filtered_count
     page_number = request.GET.get('page')
     page_obj = paginator.get_page(page_number)
     
-    # Get critical alerts (high risk)
-    critical_alerts = Alert.objects.filter(score__gte=7).order_by('-timestamp')
-    
-    # Get statistics
-    total_alerts = Alert.objects.count()
-    high_risk_count = Alert.objects.filter(score__gte=7).count()
-    medium_risk_count = Alert.objects.filter(score__gte=4, score__lt=7).count()
-    low_risk_count = Alert.objects.filter(score__gte=1, score__lt=4).count()
+    # Get the most recent critical alerts (high risk)
+    critical_alerts = (
+        Alert.objects.filter(chat, score__gte=7)
+        .select_related('device')
+        .order_by('-timestamp')[:settings.VIGILEYE_DASHBOARD_CRITICAL_LIMIT]
+    )
     
     # Get recent locations
-    recent_locations = Location.objects.all().order_by('-timestamp')[:10]
+    recent_locations = Location.objects.select_related('device').order_by('-timestamp')[:10]
     
     context = {
         'page_obj': page_obj,
         'critical_alerts': critical_alerts,
         'risk_filter': risk_filter,
-        'total_alerts': total_alerts,
-        'high_risk_count': high_risk_count,
-        'medium_risk_count': medium_risk_count,
-        'low_risk_count': low_risk_count,
         'recent_locations': recent_locations,
+        **stats,
     }
     return render(request, 'dashboard.html', context)
 
@@ -268,33 +275,20 @@ def text_input_view(request):
         message_text = request.POST.get('message_text', '')
         
         if message_text:
-            # Analyze the message
-            risk_score, flagged_keywords, risk_level = detect_risk(message_text)
-            
-            # Get or create device
-            device, created = Device.objects.get_or_create(
-                kindred_id=kindred_id,
-                defaults={'owner_parent_id': 'default_parent'}
-            )
-            
-            # Store message
-            message = Message.objects.create(
-                device=device,
-                message_text=message_text,
-                risk_score=risk_score,
-                flagged_keywords=flagged_keywords
-            )
-            
-            # Create alert if risky
-            if risk_score > 0:
-                Alert.objects.create(
-                    device=device,
-                    excerpt=message_text,
-                    score=risk_score
-                )
-                
-                if risk_level == 'high':
-                    send_notification(f"High-risk message detected: {message_text}", risk_level)
+            # In queue mode, analysis happens in the background
+            if ingest_enabled():
+                try:
+                    get_ingest_queue().submit(kindred_id, message_text)
+                    messages.info(request, "Message queued for analysis")
+                except queue.Full:
+                    messages.error(request, "Too many messages right now, please try again")
+                return redirect('text_input')
+
+            # Analyze and store the message
+            result = record_messages([(kindred_id, message_text)])[0]
+            risk_score = result['risk_score']
+            risk_level = result['risk_level']
+            flagged_keywords = result['flagged_keywords']
             
             # Add message to Django messages
             if risk_score > 0:
@@ -307,6 +301,7 @@ def text_input_view(request):
     return render(request, 'text_input.html')
 
 @csrf_exempt
+@sticky_writes
 def acknowledge_alert(request):
     """Acknowledge an alert"""
     if request.method == 'POST':
@@ -315,9 +310,8 @@ def acknowledge_alert(request):
             alert_id = data.get('alert_id')
             
             if alert_id:
-                alert = Alert.objects.get(id=alert_id)
-                alert.acknowledged = True
-                alert.save()
+                if not writes.run(Alert.objects.filter(id=alert_id).update, acknowledged=True):
+                    raise Alert.DoesNotExist
                 return JsonResponse({'success': True, 'message': 'Alert acknowledged'})
             else:
                 return JsonResponse({'error': 'Alert ID required'}, status=400)
@@ -328,11 +322,31 @@ def acknowledge_alert(request):
     
     return JsonResponse({'error': 'Only POST requests allowed'}, status=405)
 
+def _write_locations(store, device, *args):
+    """Run a location store function through the writer"""
+    try:
+        return writes.run(store, device, *args)
+    except Exception:
+        # The fence index may hold enter/exit state that was rolled back
+        geofences.invalidate(device.id)
+        raise
+
+def _store_location(device, latitude, longitude, accuracy):
+    location = Location.objects.create(
+        device_id=device.id,
+        latitude=latitude,
+        longitude=longitude,
+        accuracy=accuracy
+    )
+    fence_alerts = geofences.evaluate(
+        device.id, device.kindred_id,
+        [{'latitude': float(location.latitude), 'longitude': float(location.longitude)}]
+    )
+    return location, fence_alerts
+
 @csrf_exempt
 def update_location(request):
     """Update device location"""
-    print(f"Location update request: {request.method} {request.path}")
-    
     if request.method == 'POST':
         try:
             data = json.loads(request.body)
@@ -341,32 +355,29 @@ def update_location(request):
             longitude = data.get('longitude')
             accuracy = data.get('accuracy')
             
-            print(f"Location data: {data}")
-            
             if not kindred_id or latitude is None or longitude is None:
                 return JsonResponse({'error': 'kindredId, latitude, and longitude are required'}, status=400)
             
             # Get or create device
-            device, created = Device.objects.get_or_create(
-                kindred_id=kindred_id,
+            device, created = devices.get_or_create(
+                kindred_id,
                 defaults={'owner_parent_id': 'default_parent', 'location_tracking_enabled': True}
             )
             
-            print(f"Device: {device}, Created: {created}")
-            
-            # Store location
-            location = Location.objects.create(
-                device=device,
-                latitude=latitude,
-                longitude=longitude,
-                accuracy=accuracy
-            )
-            
-            print(f"Location created: {location}")
-            
+            # Store location and raise enter/exit alerts for the device's geofences
+            location, fence_alerts = _write_locations(_store_location, device, latitude, longitude, accuracy)
+
+            logger.debug('location_update kindred_id=%s location_id=%s device_created=%s latitude=%s longitude=%s',
+                         device.kindred_id, location.id, created, latitude, longitude)
+            publish_locations([location_payload(
+                location.id, device.kindred_id, location.latitude, location.longitude,
+                location.accuracy, location.timestamp
+            )])
+
             return JsonResponse({
                 'success': True,
                 'location_id': location.id,
+                'geofence_alerts': [alert.id for alert in fence_alerts],
                 'message': 'Location updated successfully',
                 'google_maps_url': location.get_google_maps_url()
             })
@@ -374,37 +385,119 @@ def update_location(request):
         except json.JSONDecodeError:
             return JsonResponse({'error': 'Invalid JSON'}, status=400)
         except Exception as e:
-            print(f"Location update error: {str(e)}")
+            logger.exception('location_update_failed')
             return JsonResponse({'error': f'Server error: {str(e)}'}, status=500)
     
     return JsonResponse({'error': 'Only POST requests allowed'}, status=405)
 
+def _store_fixes(device, kept, fixes):
+    locations = Location.objects.bulk_create([
+        Location(device_id=device.id, cell=geohash_encode(fix['latitude'], fix['longitude']), **fix)
+        for fix in kept
+    ])
+    # Every fix is tested, not just the stored ones, so short visits are not missed
+    fence_alerts = geofences.evaluate(device.id, device.kindred_id, fixes)
+    return locations, fence_alerts
+
 @csrf_exempt
+def bulk_update_locations(request):
+    """Store a batch of timestamped fixes, dropping redundant points"""
+    if request.method == 'POST':
+        try:
+            data = load_json_body(request)
+            kindred_id = data.get('kindredId', '') if isinstance(data, dict) else ''
+            items = data.get('fixes') if isinstance(data, dict) else None
+
+            if not kindred_id or not isinstance(items, list) or not items:
+                return JsonResponse({'error': 'kindredId and a non-empty array of fixes are required'}, status=400)
+            if len(items) > settings.VIGILEYE_LOCATION_BULK_MAX_FIXES:
+                return JsonResponse({'error': f'At most {settings.VIGILEYE_LOCATION_BULK_MAX_FIXES} fixes per request'}, status=400)
+
+            try:
+                fixes = sorted((parse_fix(item) for item in items), key=lambda fix: fix['timestamp'])
+            except ValueError as e:
+                return JsonResponse({'error': str(e)}, status=400)
+
+            # Get or create device
+            device, created = devices.get_or_create(
+                kindred_id,
+                defaults={'owner_parent_id': 'default_parent', 'location_tracking_enabled': True}
+            )
+
+            # Compare against the last stored fix so a resent position is not stored twice
+            previous = None
+            if not created:
+                previous = Location.objects.filter(device_id=device.id).order_by('-timestamp', '-id').values(
+                    'latitude', 'longitude', 'accuracy', 'timestamp'
+                ).first()
+            if previous is not None and previous['timestamp'] <= fixes[0]['timestamp']:
+                previous.update(latitude=float(previous['latitude']), longitude=float(previous['longitude']))
+            else:
+                previous = None
+
+            kept = simplify_track(
+                fixes,
+                tolerance_m=settings.VIGILEYE_LOCATION_SIMPLIFY_TOLERANCE,
+                min_jitter_m=settings.VIGILEYE_LOCATION_MIN_JITTER,
+                max_gap_s=settings.VIGILEYE_LOCATION_MAX_GAP,
+                previous=previous,
+            )
+            locations, fence_alerts = _write_locations(_store_fixes, device, kept, fixes)
+            publish_locations([
+                location_payload(
+                    location.id, device.kindred_id, location.latitude, location.longitude,
+                    location.accuracy, location.timestamp
+                )
+                for location in locations
+            ])
+
+            return JsonResponse({
+                'success': True,
+                'received': len(fixes),
+                'stored': len(locations),
+                'location_ids': [location.id for location in locations],
+                'geofence_alerts': [alert.id for alert in fence_alerts],
+                'message': f'{len(locations)} of {len(fixes)} fixes stored'
+            })
+
+        except json.JSONDecodeError:
+            return JsonResponse({'error': 'Invalid JSON'}, status=400)
+        except (ValueError, zlib.error) as e:
+            return JsonResponse({'error': f'Invalid request body: {e}'}, status=400)
+        except Exception as e:
+            return JsonResponse({'error': f'Server error: {str(e)}'}, status=500)
+
+    return JsonResponse({'error': 'Only POST requests allowed'}, status=405)
+
+@csrf_exempt
+@read_only
 def get_location_tracking_status(request):
     """Get location tracking status for a device"""
-    print(f"Location status request: {request.method} {request.path}")
-    print(f"Query params: {request.GET}")
-    
     if request.method == 'GET':
         kindred_id = request.GET.get('kindredId', '')
         
         if not kindred_id:
             return JsonResponse({'error': 'kindredId is required'}, status=400)
         
-        try:
-            device = Device.objects.get(kindred_id=kindred_id)
-            print(f"Device found: {device.kindred_id}, tracking: {device.location_tracking_enabled}")
-            return JsonResponse({
-                'kindred_id': kindred_id,
-                'tracking_enabled': device.location_tracking_enabled
-            })
-        except Device.DoesNotExist:
-            print(f"Device not found: {kindred_id}")
+        # Served from the device cache
+        device = devices.get(kindred_id)
+        if device is None:
+            logger.debug('location_status kindred_id=%s found=False', kindred_id)
             return JsonResponse({'error': 'Device not found'}, status=404)
+
+        logger.debug('location_status kindred_id=%s found=True tracking=%s',
+                     kindred_id, device.location_tracking_enabled)
+        last_heartbeat = presence.last_heartbeat(kindred_id)
+        return JsonResponse({
+            'kindred_id': kindred_id,
+            'tracking_enabled': device.location_tracking_enabled,
+            'last_heartbeat': last_heartbeat.isoformat() if last_heartbeat else None
+        })
     
     return JsonResponse({'error': 'Only GET requests allowed'}, status=405)
 
 @csrf_exempt
+@sticky_writes
 def toggle_location_tracking(request):
     """Toggle location tracking for a device"""
     if request.method == 'POST':
@@ -417,19 +510,16 @@ def toggle_location_tracking(request):
                 return JsonResponse({'error': 'kindredId is required'}, status=400)
             
             # Get or create device
-            device, created = Device.objects.get_or_create(
-                kindred_id=kindred_id,
-                defaults={'owner_parent_id': 'default_parent'}
-            )
+            device, created = devices.get_or_create(kindred_id)
             
             # Update tracking status
-            device.location_tracking_enabled = enabled
-            device.save()
+            writes.run(Device.objects.filter(id=device.id).update, location_tracking_enabled=enabled)
+            devices.invalidate(kindred_id)
             
             return JsonResponse({
                 'success': True,
                 'kindred_id': kindred_id,
-                'tracking_enabled': device.location_tracking_enabled,
+                'tracking_enabled': enabled,
                 'message': f'Location tracking {"enabled" if enabled else "disabled"}'
             })
             
@@ -440,48 +530,437 @@ def toggle_location_tracking(request):
     
     return JsonResponse({'error': 'Only POST requests allowed'}, status=405)
 
+@read_only
 def get_locations(request):
-    """Get all locations for dashboard display"""
+    """Get locations for dashboard display, newest first, one page at a time"""
     if request.method == 'GET':
         kindred_id = request.GET.get('kindredId', '')
         
+        try:
+            limit = parse_limit(request.GET.get('limit'))
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        
         if kindred_id:
             # Get locations for specific device
+            device = devices.get(kindred_id)
+            if device is None:
+                return JsonResponse({'error': 'Device not found'}, status=404)
+            locations = Location.objects.filter(device_id=device.id)
+        else:
+            # Get all recent locations
+            locations = Location.objects.all()
+        
+        try:
+            rows, next_cursor = keyset_page(
+                locations,
+                ['id', 'device__kindred_id', 'latitude', 'longitude', 'accuracy', 'timestamp'],
+                limit,
+                request.GET.get('after'),
+            )
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        
+        locations_data = [{
+            'id': row['id'],
+            'kindred_id': row['device__kindred_id'],
+            'latitude': float(row['latitude']),
+            'longitude': float(row['longitude']),
+            'accuracy': row['accuracy'],
+            'timestamp': row['timestamp'].isoformat(),
+            'google_maps_url': Location.google_maps_url(row['latitude'], row['longitude'])
+        } for row in rows]
+        
+        return JsonResponse({'locations': locations_data, 'next_cursor': next_cursor})
+    
+    return JsonResponse({'error': 'Only GET requests allowed'}, status=405)
+
+def _float_param(params, name):
+    try:
+        return float(params[name])
+    except (KeyError, ValueError):
+        raise ValueError(f'{name} must be a number')
+
+def _time_param(params, name, default):
+    value = params.get(name)
+    if not value:
+        return default
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ValueError(f'{name} must be an ISO 8601 datetime')
+    return parsed if timezone.is_aware(parsed) else timezone.make_aware(parsed)
+
+@read_only
+def get_nearby_devices(request):
+    """Devices seen within a radius or bounding box during a time window"""
+    if request.method == 'GET':
+        params = request.GET
+        try:
+            until = _time_param(params, 'until', timezone.now())
+            since = _time_param(params, 'since', until - timezone.timedelta(seconds=settings.VIGILEYE_GEO_DEFAULT_WINDOW))
+            if 'radius' in params:
+                center = (_float_param(params, 'lat'), _float_param(params, 'lon'))
+                radius = _float_param(params, 'radius')
+                if not (-90 <= center[0] <= 90 and -180 <= center[1] <= 180) or not 0 < radius <= settings.VIGILEYE_GEO_MAX_RADIUS:
+                    raise ValueError(f'lat/lon out of range or radius not in (0, {settings.VIGILEYE_GEO_MAX_RADIUS}] meters')
+                area = {'center': center, 'radius_m': radius}
+            else:
+                box = tuple(_float_param(params, name) for name in ('min_lat', 'min_lon', 'max_lat', 'max_lon'))
+                if not (-90 <= box[0] <= box[2] <= 90 and -180 <= box[1] <= box[3] <= 180):
+                    raise ValueError('Bounding box out of range, or crossing the antimeridian')
+                area = {'box': box}
+        except ValueError as e:
+            return JsonResponse({'error': f'{e}; pass lat, lon and radius, or min_lat, min_lon, max_lat and max_lon'}, status=400)
+
+        results, candidates = devices_in_area(since, until, parent_id=params.get('parentId'), **area)
+
+        return JsonResponse({
+            'devices': [{
+                'kindred_id': row['device__kindred_id'],
+                'location_id': row['id'],
+                'latitude': float(row['latitude']),
+                'longitude': float(row['longitude']),
+                'accuracy': row['accuracy'],
+                'timestamp': row['timestamp'].isoformat(),
+                'distance_m': row['distance_m'],
+                'google_maps_url': Location.google_maps_url(row['latitude'], row['longitude'])
+            } for row in results],
+            'candidates': candidates,
+            'since': since.isoformat(),
+            'until': until.isoformat(),
+        })
+
+    return JsonResponse({'error': 'Only GET requests allowed'}, status=405)
+
+def _geofence_data(fence):
+    return {
+        'id': fence.id,
+        'kindred_id': fence.device.kindred_id,
+        'name': fence.name,
+        'kind': fence.kind,
+        'center': {'latitude': fence.center_latitude, 'longitude': fence.center_longitude} if fence.kind == 'circle' else None,
+        'radius': fence.radius_m,
+        'vertices': fence.vertices if fence.kind == 'polygon' else None,
+        'active': fence.active,
+        'inside': fence.inside,
+        'created_at': fence.created_at.isoformat(),
+    }
+
+@csrf_exempt
+@sticky_writes
+def geofence_list(request):
+    """List a device's geofences (GET) or create one (POST)"""
+    if request.method == 'GET':
+        kindred_id = request.GET.get('kindredId', '')
+        if not kindred_id:
+            return JsonResponse({'error': 'kindredId is required'}, status=400)
+        fences = Geofence.objects.filter(device__kindred_id=kindred_id).select_related('device').order_by('id')
+        return JsonResponse({'geofences': [_geofence_data(fence) for fence in fences]})
+    
+    if request.method == 'POST':
+        try:
+            data = json.loads(request.body)
+            kindred_id = data.get('kindredId', '') if isinstance(data, dict) else ''
+            if not kindred_id:
+                return JsonResponse({'error': 'kindredId is required'}, status=400)
+            try:
+                fields = validate_fence(data)
+            except ValueError as e:
+                return JsonResponse({'error': str(e)}, status=400)
+            
             try:
                 device = Device.objects.get(kindred_id=kindred_id)
-                locations = Location.objects.filter(device=device).order_by('-timestamp')
             except Device.DoesNotExist:
                 return JsonResponse({'error': 'Device not found'}, status=404)
-        else:
-            # Get all recent locations
-            locations = Location.objects.all().order_by('-timestamp')
+            
+            fence = writes.run(Geofence.objects.create, device=device, **fields)
+            return JsonResponse({'success': True, 'geofence': _geofence_data(fence)}, status=201)
         
-        locations_data = []
-        for location in locations[:50]:  # Limit to 50 most recent
-            locations_data.append({
-                'id': location.id,
-                'kindred_id': location.device.kindred_id,
-                'latitude': float(location.latitude),
-                'longitude': float(location.longitude),
-                'accuracy': location.accuracy,
-                'timestamp': location.timestamp.isoformat(),
-                'google_maps_url': location.get_google_maps_url()
-            })
+        except json.JSONDecodeError:
+            return JsonResponse({'error': 'Invalid JSON'}, status=400)
+        except Exception as e:
+            return JsonResponse({'error': f'Server error: {str(e)}'}, status=500)
+    
+    return JsonResponse({'error': 'Only GET and POST requests allowed'}, status=405)
+
+@csrf_exempt
+@sticky_writes
+def geofence_detail(request, fence_id):
+    """Show (GET), rename or (de)activate (POST) or delete (DELETE) a geofence"""
+    try:
+        fence = Geofence.objects.select_related('device').get(id=fence_id)
+    except Geofence.DoesNotExist:
+        return JsonResponse({'error': 'Geofence not found'}, status=404)
+    
+    if request.method == 'GET':
+        return JsonResponse({'geofence': _geofence_data(fence)})
+    
+    if request.method == 'POST':
+        try:
+            data = json.loads(request.body)
+        except json.JSONDecodeError:
+            return JsonResponse({'error': 'Invalid JSON'}, status=400)
+        if not isinstance(data, dict):
+            return JsonResponse({'error': 'A JSON object is required'}, status=400)
+        if 'name' in data:
+            fence.name = str(data['name']).strip()[:100] or fence.name
+        if 'active' in data:
+            fence.active = bool(data['active'])
+            # The device may have moved while the fence was off
+            fence.inside = None
+        writes.run(fence.save)
+        return JsonResponse({'success': True, 'geofence': _geofence_data(fence)})
+    
+    if request.method == 'DELETE':
+        writes.run(fence.delete)
+        return JsonResponse({'success': True, 'message': 'Geofence deleted'})
+    
+    return JsonResponse({'error': 'Only GET, POST and DELETE requests allowed'}, status=405)
+
+@read_only
+def get_device_trend(request):
+    """Hourly message, alert and location totals for a device, archived hours included"""
+    if request.method == 'GET':
+        kindred_id = request.GET.get('kindredId', '')
+        if not kindred_id:
+            return JsonResponse({'error': 'kindredId is required'}, status=400)
+        try:
+            hours = int(request.GET.get('hours') or 24 * 7)
+        except ValueError:
+            hours = 0
+        if not 0 < hours <= settings.VIGILEYE_TREND_MAX_HOURS:
+            return JsonResponse({'error': f'hours must be between 1 and {settings.VIGILEYE_TREND_MAX_HOURS}'}, status=400)
         
-        return JsonResponse({'locations': locations_data})
+        device = devices.get(kindred_id)
+        if device is None:
+            return JsonResponse({'error': 'Device not found'}, status=404)
+        
+        since = timezone.now().replace(minute=0, second=0, microsecond=0) - timezone.timedelta(hours=hours - 1)
+        return JsonResponse({'kindred_id': kindred_id, 'hours': hourly_trend(device.id, since)})
     
     return JsonResponse({'error': 'Only GET requests allowed'}, status=405)
 
+def metrics_view(request):
+    """Request histograms and cache/queue gauges of this process, in Prometheus text format"""
+    if not settings.VIGILEYE_METRICS_ENABLED:
+        raise Http404
+    cache = devices.stats()
+    gauges = [
+        ('device_cache_size', 'Devices held in the resolver cache', cache['size']),
+        ('device_cache_hits', 'Device lookups served from the cache', cache['hits']),
+        ('device_cache_misses', 'Device lookups that went to the database', cache['misses']),
+        ('device_cache_evictions', 'Devices evicted from the cache', cache['evictions']),
+        ('stream_subscribers', 'Connected dashboard event streams', broker.subscriber_count()),
+        ('lexicon_version', 'Active risk lexicon version', lexicons.current().version),
+    ]
+    gauges += [
+        (f'notifications_{name}', f'Notification dispatcher: {name.replace("_", " ")}', value)
+        for name, value in sorted(dispatcher.stats().items())
+    ]
+    if ingest_enabled():
+        gauges.append(('ingest_queue_pending', 'Messages waiting in the ingest queue', get_ingest_queue().pending()))
+    return HttpResponse(metrics.render(gauges), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@read_only
 def get_alerts(request):
+    """Get alerts newest first, one page at a time"""
     if request.method == 'GET':
-        alerts = Alert.objects.all().order_by('-timestamp')
+        try:
+            limit = parse_limit(request.GET.get('limit'))
+            rows, next_cursor = keyset_page(
+                Alert.objects.all(),
+                ['id', 'device__kindred_id', 'excerpt', 'score', 'occurrences', 'last_seen', 'timestamp'],
+                limit,
+                request.GET.get('after'),
+            )
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
         alerts_data = [{
-            'id': alert.id,
-            'device_kindred_id': alert.device.kindred_id,
-            'excerpt': alert.excerpt,
-            'score': alert.score,
-            'timestamp': alert.timestamp.isoformat()
-        } for alert in alerts]
-        return JsonResponse({'alerts': alerts_data})
+            'id': row['id'],
+            'device_kindred_id': row['device__kindred_id'],
+            'excerpt': row['excerpt'],
+            'score': row['score'],
+            'occurrences': row['occurrences'],
+            'last_seen': row['last_seen'].isoformat() if row['last_seen'] else None,
+            'timestamp': row['timestamp'].isoformat()
+        } for row in rows]
+        return JsonResponse({'alerts': alerts_data, 'next_cursor': next_cursor})
     return JsonResponse({'error': 'Only GET requests are allowed'}, status=405)
-    
+
+@read_only
+def search_messages_view(request):
+    """Full-text search over stored messages, most relevant first"""
+    if request.method != 'GET':
+        return JsonResponse({'error': 'Only GET requests are allowed'}, status=405)
+    params = request.GET
+    query = params.get('q', '').strip()
+    if not query:
+        return JsonResponse({'error': 'q is required'}, status=400)
+    try:
+        limit = parse_limit(params.get('limit'))
+        offset = int(params.get('offset') or 0)
+        if offset < 0:
+            raise ValueError('offset must not be negative')
+        since = _time_param(params, 'since', None)
+        until = _time_param(params, 'until', None)
+        risk_levels = [level for level in params.get('risk', '').split(',') if level]
+        if not set(risk_levels) <= set(RISK_LEVELS):
+            raise ValueError(f"risk must be a comma-separated list of {', '.join(RISK_LEVELS)}")
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    device_id = None
+    kindred_id = params.get('kindredId', '')
+    if kindred_id:
+        device = devices.get(kindred_id)
+        if device is None:
+            return JsonResponse({'error': 'Device not found'}, status=404)
+        device_id = device.id
+
+    try:
+        results, has_more = search_messages(query, device_id, since, until, risk_levels, limit, offset)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({
+        'results': [{
+            'id': row['id'],
+            'kindred_id': row['device__kindred_id'],
+            'snippet': row['snippet'],
+            'relevance': row['relevance'],
+            'risk_score': row['risk_score'],
+            'risk_level': row['risk_level'],
+            'flagged_keywords': row['flagged_keywords'],
+            'timestamp': row['timestamp'].isoformat(),
+        } for row in results],
+        'next_offset': offset + limit if has_more else None,
+    })
+
+def _export_params(params):
+    """(table, format, device, since, until) of an export request; raises ValueError"""
+    table = params.get('table', '')
+    if table not in EXPORTS:
+        raise ValueError(f"table must be one of {', '.join(EXPORTS)}")
+    export_format = params.get('format') or 'csv'
+    if export_format not in FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+    if export_format == 'parquet' and not parquet_available():
+        raise ValueError('Parquet exports need pyarrow installed on the server')
+    since = _time_param(params, 'since', None)
+    until = _time_param(params, 'until', None)
+    device = None
+    kindred_id = params.get('kindredId', '')
+    if kindred_id:
+        device = devices.get(kindred_id)
+        if device is None:
+            raise Device.DoesNotExist
+    return table, export_format, device, since, until
+
+def _export_job_data(job):
+    return {
+        'id': job.id,
+        'table': job.table,
+        'format': job.format,
+        'kindred_id': job.device.kindred_id if job.device_id else None,
+        'since': job.since.isoformat() if job.since else None,
+        'until': job.until.isoformat() if job.until else None,
+        'status': job.status,
+        'rows': job.rows,
+        'size_bytes': job.size_bytes,
+        'error': job.error or None,
+        'download_url': f'/api/exports/{job.id}/download/' if job.status == 'done' else None,
+        'created_at': job.created_at.isoformat(),
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+@read_only
+def export_data(request):
+    """Stream one table for a device and time window as gzipped CSV or NDJSON"""
+    if request.method != 'GET':
+        return JsonResponse({'error': 'Only GET requests are allowed'}, status=405)
+    try:
+        table, export_format, device, since, until = _export_params(request.GET)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except Device.DoesNotExist:
+        return JsonResponse({'error': 'Device not found'}, status=404)
+    if export_format not in ENCODERS:
+        return JsonResponse({'error': f'{export_format} is only available as a background export'}, status=400)
+
+    device_id = device.id if device else None
+    model = EXPORTS[table][0]
+    filters = {'device_id': device_id, 'timestamp__gte': since, 'timestamp__lte': until}
+    rows = model.objects.filter(**{name: value for name, value in filters.items() if value is not None}).count()
+    if rows > settings.VIGILEYE_EXPORT_STREAM_MAX_ROWS:
+        return JsonResponse({
+            'error': f'{rows} rows is more than {settings.VIGILEYE_EXPORT_STREAM_MAX_ROWS} served directly; '
+                     'POST the same parameters to /api/exports/ to export them in the background',
+        }, status=413)
+
+    # The queryset is bound to its database here; rows are read while streaming
+    chunks = gzip_chunks(ENCODERS[export_format](table, export_rows(table, device_id, since, until)))
+    response = StreamingHttpResponse(chunks, content_type=FORMATS[export_format][1])
+    name = f"{table}-{device.kindred_id if device else 'all'}-{timezone.now():%Y%m%d%H%M%S}.{FORMATS[export_format][0]}"
+    response['Content-Disposition'] = f'attachment; filename="{name}"'
+    response['X-Export-Rows'] = str(rows)
+    return response
+
+@csrf_exempt
+@sticky_writes
+@read_only
+def export_jobs(request):
+    """List recent background exports (GET) or start one (POST)"""
+    if request.method == 'GET':
+        jobs = ExportJob.objects.select_related('device').order_by('-id')[:50]
+        return JsonResponse({'exports': [_export_job_data(job) for job in jobs]})
+
+    if request.method == 'POST':
+        try:
+            data = json.loads(request.body)
+            if not isinstance(data, dict):
+                raise ValueError('A JSON object is required')
+            table, export_format, device, since, until = _export_params(data)
+        except json.JSONDecodeError:
+            return JsonResponse({'error': 'Invalid JSON'}, status=400)
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        except Device.DoesNotExist:
+            return JsonResponse({'error': 'Device not found'}, status=404)
+
+        job = writes.run(ExportJob.objects.create, table=table, format=export_format,
+                         device_id=device.id if device else None, since=since, until=until)
+        exports.submit(job.id)
+        return JsonResponse({'success': True, 'export': _export_job_data(job)}, status=202)
+
+    return JsonResponse({'error': 'Only GET and POST requests allowed'}, status=405)
+
+@read_only
+def export_job_detail(request, job_id):
+    """Status of a background export"""
+    try:
+        job = ExportJob.objects.select_related('device').get(id=job_id)
+    except ExportJob.DoesNotExist:
+        return JsonResponse({'error': 'Export not found'}, status=404)
+    return JsonResponse({'export': _export_job_data(job)})
+
+def export_job_download(request, job_id):
+    """The file of a finished background export"""
+    try:
+        job = ExportJob.objects.get(id=job_id, status='done')
+        return FileResponse(open(export_path(job), 'rb'), as_attachment=True, filename=job.file_name,
+                            content_type=FORMATS[job.format][1])
+    except (ExportJob.DoesNotExist, FileNotFoundError):
+        return JsonResponse({'error': 'Export not found or not finished'}, status=404)
+
+async def event_stream(request):
+    """Push new alerts and locations to a parent dashboard (Server-Sent Events)"""
+    if request.method != 'GET':
+        return JsonResponse({'error': 'Only GET requests are allowed'}, status=405)
+    if not isinstance(request, ASGIRequest):
+        # A WSGI worker would be tied up for the life of the connection
+        return JsonResponse({'error': 'Streaming requires the ASGI server'}, status=503)
+
+    last_event_id = request.headers.get('Last-Event-ID') or request.GET.get('lastEventId')
+    response = StreamingHttpResponse(stream_events(last_event_id), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
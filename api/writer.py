@@ -0,0 +1,134 @@
+import atexit
+import contextvars
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, close_old_connections, connections, transaction
+
+from .metrics import current_stats
+
+logger = logging.getLogger(__name__)
+
+
+class WriteFunnel:
+    """
+    One thread that runs the small write transactions of this process.
+
+    SQLite has a single write lock; request threads contending for it each
+    wait for it and pay a commit of their own. Instead, callers hand their
+    write function to run(), and the writer takes every function queued
+    within ``linger`` seconds (up to ``max_batch``), runs each in its own
+    savepoint and commits them together, so a burst of writes costs one
+    commit. A caller gets its function's result, or exception, once that
+    commit is done. Reads stay on the callers' own connections and run in
+    parallel with the writer under WAL.
+
+    Callers already inside a transaction run their function inline on their
+    own connection, as do all callers while VIGILEYE_WRITE_FUNNEL is off.
+    """
+
+    def __init__(self, max_batch, linger):
+        self.max_batch = max_batch
+        self.linger = linger
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def run(self, func, *args, **kwargs):
+        """Run func(*args, **kwargs) in a shared write transaction and return its result"""
+        if (not settings.VIGILEYE_WRITE_FUNNEL
+                or connections[DEFAULT_DB_ALIAS].in_atomic_block
+                or threading.current_thread() is self._thread):
+            return func(*args, **kwargs)
+        future = Future()
+        self._ensure_writer()
+        self._queue.put((future, contextvars.copy_context(), func, args, kwargs))
+        return future.result()
+
+    def stop(self, timeout=10):
+        """Finish what is queued and stop the writer; the next run() starts a new one"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is None:
+                return
+            self._stopping.set()
+        thread.join(timeout)
+        self._stopping.clear()
+
+    def _ensure_writer(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='vigileye-writer', daemon=True)
+                self._thread.start()
+                atexit.register(self.stop)
+
+    def _next_batch(self):
+        try:
+            batch = [self._queue.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.linger
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        try:
+            while not (self._stopping.is_set() and self._queue.empty()):
+                batch = self._next_batch()
+                if batch:
+                    self._commit(batch)
+                    close_old_connections()
+        finally:
+            connections.close_all()
+
+    def _commit(self, batch):
+        done = []
+        failed = []
+        try:
+            with transaction.atomic():
+                for future, context, func, args, kwargs in batch:
+                    try:
+                        with transaction.atomic():
+                            result = context.run(self._call, func, args, kwargs)
+                    except Exception as e:
+                        # Only this function's savepoint is rolled back
+                        failed.append((future, e))
+                    else:
+                        done.append((future, result))
+        except Exception as e:
+            # The commit failed, so nothing of the batch was stored
+            logger.warning('Write batch of %d failed: %s', len(batch), e)
+            failed.extend((future, e) for future, _ in done)
+            done = []
+        # Callers hear back only once the transaction is over, failed or not
+        for future, e in failed:
+            future.set_exception(e)
+        for future, result in done:
+            future.set_result(result)
+
+    @staticmethod
+    def _call(func, args, kwargs):
+        # Charge the queries to the request that submitted them
+        stats = current_stats()
+        if stats is None:
+            return func(*args, **kwargs)
+        with connections[DEFAULT_DB_ALIAS].execute_wrapper(stats.execute):
+            return func(*args, **kwargs)
+
+
+writes = WriteFunnel(settings.VIGILEYE_WRITE_BATCH_SIZE, settings.VIGILEYE_WRITE_LINGER)